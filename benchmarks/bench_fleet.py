@@ -0,0 +1,269 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import calculate_storage
+from fake_github import FakeGitHubServer
+
+REPO_NAME = "bench/fleet"
+ISSUE_NUMBER = 1
+TOTAL = 100 * 1024 ** 3
+
+# --mode main で 1 ホスト分を動かすプロセス
+# ホスト名と probe_drives だけを差し替えて、それ以外は本物の main() を通す
+MAIN_WORKER_CODE = """
+import json, os, sys, time
+sys.path.insert(0, sys.argv[1])
+import calculate_storage
+hostname, usages, issue_number, start_at = sys.argv[2], json.loads(sys.argv[3]), sys.argv[4], float(sys.argv[5])
+
+def probe_drives(drives, drive_timeout=None, total_timeout=None, max_workers=None):
+  probes = []
+  for drive in drives:
+    probe = calculate_storage.DriveProbe(drive)
+    probe.elapsed = 0.0
+    if drive in usages:
+      probe.status = "ok"
+      probe.usage = calculate_storage.ReportedUsage(**usages[drive])
+    else:
+      probe.status = "error"
+      probe.error = "not simulated"
+    probes.append(probe)
+  return probes
+
+calculate_storage.get_real_hostname = lambda: hostname
+calculate_storage.probe_drives = probe_drives
+time.sleep(max(0.0, start_at - time.time()))
+start = time.perf_counter()
+calculate_storage.main([issue_number])
+elapsed = time.perf_counter() - start
+# 反映できなかった結果は spool に残る
+failed = len(calculate_storage.ResultSpool(os.environ.get("CALCULATE_STORAGE_SPOOL_DIR", "spool")).load()) > 0
+print(json.dumps({"elapsed": elapsed, "failed": failed}))
+"""
+
+
+def host_name(index):
+  return f"host{index:04d}"
+
+
+def drive_name(index):
+  return f"/mnt/disk{index}"
+
+
+def make_body(hosts, drives_per_host):
+  lines = [
+    "# Storage",
+    "",
+    "| Status | Computer | Drive | Used | Size |",
+    "| :-: | :-: | :-: | :-: | :-: |",
+  ]
+  for host in range(hosts):
+    for drive in range(drives_per_host):
+      computer_name = host_name(host)
+      lines.append(f"| ✅ | {computer_name} | {drive_name(drive)} | 1.00 GB (1%) | 100.00 GB (HDD) | <!-- calculate-storage#{computer_name}#{drive_name(drive)} -->")
+  lines.append("")
+  return "\n".join(lines)
+
+
+def make_usages(host, drives_per_host):
+  # ホストとドライブごとに違う値を書かせて、最後の本文に残っているかで lost update を数える
+  usages = {}
+  for drive in range(drives_per_host):
+    percent = (host * drives_per_host + drive) % 97 + 2
+    used = percent * TOTAL // 100
+    usages[drive_name(drive)] = {"total": TOTAL, "used": used, "free": TOTAL - used, "percent": percent}
+  return usages
+
+
+def expected_used(usage):
+  return f"{calculate_storage.get_human_readable_size(usage['used'])} ({usage['percent']}%)"
+
+
+def run_thread_host(url, host, drives_per_host, barrier):
+  hostname = host_name(host)
+  usages = make_usages(host, drives_per_host)
+  client = calculate_storage.GitHubClient("bench_token", api_url=url)
+  barrier.wait()
+  start = time.perf_counter()
+  try:
+    issue = calculate_storage.GitHubIssue(REPO_NAME, ISSUE_NUMBER, "bench_token", client=client, cache=calculate_storage.IssueBodyCache())
+    for drive, usage in usages.items():
+      issue.update_storage_row(hostname, drive, calculate_storage.ReportedUsage(**usage))
+    issue.update_issue_body()
+    failed = False
+    conflicts = issue.metrics["conflicts"]
+  except Exception:
+    failed = True
+    conflicts = 0
+  finally:
+    client.close()
+  return {"host": host, "elapsed": time.perf_counter() - start, "failed": failed, "conflicts": conflicts}
+
+
+def run_threads(url, hosts, drives_per_host):
+  outcomes = [None] * hosts
+  barrier = threading.Barrier(hosts)
+
+  def worker(host):
+    outcomes[host] = run_thread_host(url, host, drives_per_host, barrier)
+
+  threads = [threading.Thread(target=worker, args=(host,)) for host in range(hosts)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return outcomes
+
+
+def run_main_processes(url, hosts, drives_per_host, workdir):
+  # ホストごとに作業ディレクトリ (results / spool / cache / logs / data) を分ける
+  start_at = time.time() + 1.0 + hosts * 0.02
+  processes = []
+  for host in range(hosts):
+    cwd = os.path.join(workdir, host_name(host))
+    os.makedirs(os.path.join(cwd, "data"))
+    with open(os.path.join(cwd, "data", "github_token.txt"), "w", encoding="utf-8") as f:
+      f.write("bench_token\n")
+    env = dict(os.environ)
+    env.update({
+      "GITHUB_REPOSITORY": REPO_NAME,
+      "CALCULATE_STORAGE_GITHUB_API_URL": url,
+      "CALCULATE_STORAGE_LOG_DIR": os.path.join(cwd, "logs"),
+      "CALCULATE_STORAGE_SPREAD": "0",
+      "CALCULATE_STORAGE_DISCOVER": "0"
+    })
+    processes.append(subprocess.Popen(
+      [sys.executable, "-c", MAIN_WORKER_CODE, ROOT_DIR, host_name(host), json.dumps(make_usages(host, drives_per_host)), str(ISSUE_NUMBER), str(start_at)],
+      cwd=cwd,
+      env=env,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.DEVNULL,
+      text=True
+    ))
+
+  outcomes = []
+  for host, process in enumerate(processes):
+    stdout, _ = process.communicate()
+    try:
+      outcome = json.loads(stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+      outcome = {"elapsed": 0.0, "failed": True}
+    outcome.update({"host": host, "conflicts": None})
+    outcomes.append(outcome)
+  return outcomes
+
+
+def count_lost_updates(body, outcomes, drives_per_host):
+  # 成功したと返したのに、最後の本文に自分の値が残っていない行を数える
+  rows = {}
+  for line in body.split("\n"):
+    m = calculate_storage.GitHubIssue.row_regex.match(line)
+    if m is not None:
+      rows[(m.group("computer_name"), m.group("drive"))] = line
+  lost = 0
+  for outcome in outcomes:
+    if outcome["failed"]:
+      continue
+    hostname = host_name(outcome["host"])
+    for drive, usage in make_usages(outcome["host"], drives_per_host).items():
+      if f"| {expected_used(usage)} |" not in rows.get((hostname, drive), ""):
+        lost += 1
+  return lost
+
+
+def percentile(values, p):
+  # nearest-rank
+  if len(values) == 0:
+    return 0.0
+  values = sorted(values)
+  index = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+  return values[index]
+
+
+def run(args, hosts):
+  server = FakeGitHubServer(
+    {(REPO_NAME, ISSUE_NUMBER): make_body(hosts, args.drives_per_host)},
+    latency=args.latency,
+    jitter=args.jitter,
+    error_rate=args.error_rate,
+    reset_rate=args.reset_rate,
+    rate_limit=args.rate_limit,
+    rate_limit_window=args.rate_limit_window,
+    seed=0
+  )
+  with server, tempfile.TemporaryDirectory() as workdir:
+    start = time.perf_counter()
+    if args.mode == "threads":
+      outcomes = run_threads(server.url, hosts, args.drives_per_host)
+    else:
+      outcomes = run_main_processes(server.url, hosts, args.drives_per_host, workdir)
+    wall = time.perf_counter() - start
+    body = server.get_body(REPO_NAME, ISSUE_NUMBER)
+    stats = dict(server.stats)
+
+  latencies = [outcome["elapsed"] for outcome in outcomes if not outcome["failed"]]
+  conflicts = [outcome["conflicts"] for outcome in outcomes if outcome["conflicts"] is not None]
+  return {
+    "mode": args.mode,
+    "hosts": hosts,
+    "wall_seconds": wall,
+    "throughput_hosts_per_second": len(latencies) / wall if wall > 0 else 0.0,
+    "p50_seconds": percentile(latencies, 50),
+    "p99_seconds": percentile(latencies, 99),
+    "failed_hosts": sum(1 for outcome in outcomes if outcome["failed"]),
+    "lost_updates": count_lost_updates(body, outcomes, args.drives_per_host),
+    "conflicts": sum(conflicts) if len(conflicts) > 0 else None,
+    "requests": stats.get("GET requests", 0) + stats.get("PATCH requests", 0),
+    "server": stats
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Run a fleet of simulated hosts against a fake GitHub Issues API and report throughput, latency and lost updates")
+  parser.add_argument("--hosts", type=int, nargs="+", default=[10, 50])
+  parser.add_argument("--drives-per-host", type=int, default=2)
+  parser.add_argument("--mode", choices=("threads", "main"), default="threads", help="threads: GitHubIssue per thread in this process; main: one main() process per host")
+  parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every API response")
+  parser.add_argument("--jitter", type=float, default=0.05)
+  parser.add_argument("--error-rate", type=float, default=0.0)
+  parser.add_argument("--reset-rate", type=float, default=0.0)
+  parser.add_argument("--rate-limit", type=int, default=5000)
+  parser.add_argument("--rate-limit-window", type=float, default=3600.0)
+  parser.add_argument("--verify-delay", type=float, help="override CALCULATE_STORAGE_VERIFY_DELAY for the simulated hosts")
+  parser.add_argument("--json", action="store_true", help="print one JSON object per fleet size")
+  args = parser.parse_args()
+
+  if args.verify_delay is not None:
+    os.environ["CALCULATE_STORAGE_VERIFY_DELAY"] = str(args.verify_delay)
+  # 失敗したホストの数で見るので、リトライの警告は出さない
+  calculate_storage.logging.disable(calculate_storage.logging.CRITICAL)
+
+  failed = False
+  for hosts in args.hosts:
+    result = run(args, hosts)
+    if args.json:
+      print(json.dumps(result))
+    else:
+      conflicts = "" if result["conflicts"] is None else f", {result['conflicts']} conflicts"
+      print(
+        f"mode={result['mode']} hosts={hosts}: {result['wall_seconds']:.2f}s, {result['throughput_hosts_per_second']:.1f} hosts/s, "
+        f"p50={result['p50_seconds'] * 1000:.0f}ms p99={result['p99_seconds'] * 1000:.0f}ms, "
+        f"{result['requests']} requests{conflicts}, {result['failed_hosts']} failed, {result['lost_updates']} lost updates"
+      )
+    failed = failed or result["lost_updates"] > 0
+  return 1 if failed else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,44 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import calculate_storage
+
+
+def make_series(drives, samples):
+  # 1 時間ごとの測定を samples 回分、ドライブごとにランダムな増加率で作る
+  rng = random.Random(0)
+  start = 1700000000.0
+  total = 1000 * 1024 ** 3
+  series = {}
+  for i in range(drives):
+    slope = rng.uniform(-1, 4) * 1024 ** 2
+    base = rng.uniform(0.1, 0.8) * total
+    series[f"/mnt/disk{i}"] = [
+      (start + j * 3600, base + slope * j + rng.uniform(-1, 1) * 1024 ** 2, total)
+      for j in range(samples)
+    ]
+  return series
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark forecast_days_to_full on synthetic usage series")
+  parser.add_argument("--drives", type=int, nargs="+", default=[100, 1000, 5000])
+  parser.add_argument("--samples", type=int, default=24 * 30, help="samples per drive (default: hourly for 30 days)")
+  args = parser.parse_args()
+
+  for drives in args.drives:
+    series = make_series(drives, args.samples)
+    start = time.perf_counter()
+    forecasts = calculate_storage.forecast_days_to_full(series)
+    elapsed = time.perf_counter() - start
+    filling = sum(1 for days in forecasts.values() if days is not None)
+    print(f"drives={drives} samples={args.samples}: {elapsed * 1000:.1f}ms ({filling} filling)")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,276 @@
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import calculate_storage
+from fake_github import FakeGitHubServer
+
+BASELINE_PATH = os.path.join(BENCH_DIR, "hot_paths_baseline.json")
+REPO_NAME = "bench/hot-paths"
+ISSUE_NUMBER = 1
+
+DiskUsage = namedtuple("DiskUsage", "total used free percent")
+
+
+def make_fleet(hosts, rng):
+  # Windows (ドライブレター) と Linux (マウントポイント) が混ざった、ホストごとにドライブ数の違う構成
+  fleet = []
+  for host in range(hosts):
+    if host % 3 == 0:
+      drives = ["C", "D", "E", "F"][:rng.randint(1, 4)]
+    else:
+      drives = ["/"] + [f"/mnt/disk{i}" for i in range(rng.randint(0, 5))]
+    fleet.append((f"host{host:05d}", drives))
+  return fleet
+
+
+def make_usage(rng):
+  total = rng.choice((128, 256, 512, 1024, 2048, 4096, 16384)) * 1024 ** 3
+  used = int(total * rng.uniform(0.01, 0.99))
+  return DiskUsage(total, used, total - used, round(used / total * 100, 1))
+
+
+def make_body(fleet, rng):
+  # 見出し・表・表の後の文章がある、実際の issue に近い本文
+  lines = [
+    "# Storage",
+    "",
+    "Updated by calculate_storage.py on each host.",
+    "",
+  ] + calculate_storage.GitHubIssue.table_header
+  for computer_name, drives in fleet:
+    for drive in drives:
+      usage = make_usage(rng)
+      storage_row = calculate_storage.StorageRow(
+        computer_name,
+        drive,
+        "🔴" if usage.percent > 90 else "✅",
+        computer_name,
+        drive,
+        f"{calculate_storage.get_human_readable_size(usage.used)} ({usage.percent}%)",
+        calculate_storage.get_human_readable_size(usage.total),
+        rng.choice(("SSD", "HDD", "NVMe", "nfs")),
+        ""
+      )
+      storage_row.raw = storage_row.render()
+      lines.append(storage_row.render_line())
+  lines += ["", "## Notes", "", "Rows are matched by the trailing comment; edit the other columns freely."]
+  return "\n".join(lines)
+
+
+def measure(func, min_time, repeat):
+  # timeit と同じく、1 回が min_time 以上になるまで回数を増やし、repeat 回のうち最小の 1 回あたりの時間を取る
+  number = 1
+  while True:
+    start = time.perf_counter()
+    for _ in range(number):
+      func()
+    elapsed = time.perf_counter() - start
+    if elapsed >= min_time:
+      break
+    number *= 2
+  best = elapsed / number
+  for _ in range(repeat - 1):
+    start = time.perf_counter()
+    for _ in range(number):
+      func()
+    best = min(best, (time.perf_counter() - start) / number)
+  return best, number
+
+
+def bench_scale(hosts, min_time, repeat):
+  rng = random.Random(hosts)
+  fleet = make_fleet(hosts, rng)
+  body = make_body(fleet, rng)
+  rows = sum(len(drives) for _, drives in fleet)
+  usages = [make_usage(rng) for _ in range(256)]
+  results = {}
+
+  def record(name, func, per_call=1):
+    seconds, number = measure(func, min_time, repeat)
+    results[f"{name}/hosts={hosts}"] = {"seconds": seconds / per_call, "calls": number * per_call, "rows": rows, "body_chars": len(body)}
+
+  server = FakeGitHubServer({(REPO_NAME, ISSUE_NUMBER): body})
+  with server:
+    client = calculate_storage.GitHubClient("bench_token", api_url=server.url)
+    try:
+      issue = calculate_storage.GitHubIssue(REPO_NAME, ISSUE_NUMBER, "bench_token", client=client, cache=calculate_storage.IssueBodyCache())
+      record("get_storage_rows", issue._GitHubIssue__get_storage_rows)
+
+      keys = list(issue.storage_rows)
+
+      def update_all_rows():
+        # 1 回で全ホストの全ドライブを更新する (collector の flush と同じ)
+        for index, (computer_name, drive) in enumerate(keys):
+          issue.update_storage_row(computer_name, drive, usages[index % len(usages)])
+
+      record("update_storage_row", update_all_rows, per_call=len(keys))
+      issue.dirty_rows.clear()
+
+      # 1 ホスト分の行を変えて、GET → PATCH → GET (確認) を通す
+      computer_name, drives = fleet[len(fleet) // 2]
+      usage_cycle = itertools.cycle(usages)
+
+      def update_issue_body():
+        for drive in drives:
+          issue.update_storage_row(computer_name, drive, next(usage_cycle))
+        issue.update_issue_body()
+
+      record("update_issue_body", update_issue_body)
+    finally:
+      client.close()
+  return results
+
+
+def bench_fixed(min_time, repeat):
+  # 本文の大きさに依存しないもの
+  rng = random.Random(0)
+  usages = [make_usage(rng) for _ in range(1000)]
+  sizes = [value for usage in usages for value in (usage.used, usage.total)]
+  results = {}
+
+  def human_readable_sizes():
+    for size in sizes:
+      calculate_storage.get_human_readable_size(size)
+
+  seconds, number = measure(human_readable_sizes, min_time, repeat)
+  results["get_human_readable_size"] = {"seconds": seconds / len(sizes), "calls": number * len(sizes)}
+
+  # 1 ホスト分の結果 (make_result の形式) を results/ に追記する
+  host_results = []
+  for drive, usage in zip(("C", "D", "/", "/mnt/disk0"), usages):
+    probe = calculate_storage.DriveProbe(drive)
+    probe.status = "ok"
+    probe.usage = usage
+    probe.elapsed = 0.01
+    result = calculate_storage.make_result(probe)
+    result["days_to_full"] = None
+    host_results.append(result)
+  cwd = os.getcwd()
+  with tempfile.TemporaryDirectory() as workdir:
+    os.chdir(workdir)
+    try:
+      seconds, number = measure(lambda: calculate_storage.save_results("host00000", host_results), min_time, repeat)
+    finally:
+      os.chdir(cwd)
+  results[f"save_results/records={len(host_results)}"] = {"seconds": seconds, "calls": number}
+  return results
+
+
+def run(hosts_scales, min_time, repeat, runs=1):
+  # runs 回測って中央値を取る (負荷の揺れで、基準値が 1 回の速い・遅い実行に引きずられないように)
+  os.environ["CALCULATE_STORAGE_VERIFY_DELAY"] = "0"
+  calculate_storage.logging.disable(calculate_storage.logging.CRITICAL)
+  measured = []
+  for _ in range(max(1, runs)):
+    benchmarks = bench_fixed(min_time, repeat)
+    for hosts in hosts_scales:
+      benchmarks.update(bench_scale(hosts, min_time, repeat))
+    measured.append(benchmarks)
+  benchmarks = measured[0]
+  for name, benchmark in benchmarks.items():
+    benchmark["seconds"] = statistics.median(run_benchmarks[name]["seconds"] for run_benchmarks in measured)
+  return {
+    "created": datetime.datetime.now().isoformat(timespec="seconds"),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "benchmarks": benchmarks
+  }
+
+
+def compare(baseline, current, tolerance, out=None):
+  # current が baseline より tolerance (割合) を超えて遅くなったものを返す
+  if out is None:
+    out = sys.stdout
+  regressions = []
+  for name in sorted(baseline["benchmarks"].keys() | current["benchmarks"].keys()):
+    before = baseline["benchmarks"].get(name)
+    after = current["benchmarks"].get(name)
+    if before is None:
+      out.write(f"{name}: {after['seconds'] * 1e6:.2f}us (new)\n")
+      continue
+    if after is None:
+      out.write(f"{name}: missing (baseline {before['seconds'] * 1e6:.2f}us)\n")
+      continue
+    change = after["seconds"] / before["seconds"] - 1 if before["seconds"] > 0 else 0.0
+    status = "REGRESSION" if change > tolerance else "ok"
+    out.write(f"{name}: {after['seconds'] * 1e6:.2f}us vs {before['seconds'] * 1e6:.2f}us ({change:+.0%}) {status}\n")
+    if status != "ok":
+      regressions.append(name)
+  return regressions
+
+
+def load(path):
+  with open(path, "r", encoding="utf-8") as f:
+    return json.load(f)
+
+
+def save(path, data):
+  with open(path, "w", encoding="utf-8") as f:
+    json.dump(data, f, indent=2)
+    f.write("\n")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Time the parse/update/render hot paths at several scales and compare them against a tracked JSON baseline")
+  subparsers = parser.add_subparsers(dest="command", required=True)
+
+  def add_run_arguments(subparser):
+    subparser.add_argument("--hosts", type=int, nargs="+", default=[10, 100, 1000], help="fleet sizes (hosts with 1-6 drives each)")
+    subparser.add_argument("--min-time", type=float, default=0.2, help="seconds per timing loop (default: 0.2)")
+    subparser.add_argument("--repeat", type=int, default=7)
+    subparser.add_argument("--runs", type=int, default=1, help="run the whole suite this many times and keep the median (use 3 or more for a baseline)")
+
+  run_parser = subparsers.add_parser("run", help="measure and write the results as JSON")
+  add_run_arguments(run_parser)
+  run_parser.add_argument("--output", help="write to this file instead of stdout")
+
+  compare_parser = subparsers.add_parser("compare", help="compare two result files; exit 1 if any benchmark regressed")
+  compare_parser.add_argument("baseline")
+  compare_parser.add_argument("current")
+  compare_parser.add_argument("--tolerance", type=float, default=1.0, help="allowed slowdown as a fraction (default: 1.0, i.e. twice as slow)")
+
+  check_parser = subparsers.add_parser("check", help=f"measure and compare against {os.path.relpath(BASELINE_PATH, ROOT_DIR)}")
+  add_run_arguments(check_parser)
+  check_parser.add_argument("--tolerance", type=float, default=1.0, help="allowed slowdown as a fraction (default: 1.0, i.e. twice as slow)")
+  check_parser.add_argument("--update", action="store_true", help="write the measured values as the new baseline (timings depend on the machine, so update it where the check runs)")
+  args = parser.parse_args()
+
+  if args.command == "compare":
+    regressions = compare(load(args.baseline), load(args.current), args.tolerance)
+  else:
+    current = run(args.hosts, args.min_time, args.repeat, args.runs)
+    if args.command == "run":
+      if args.output:
+        save(args.output, current)
+      else:
+        print(json.dumps(current, indent=2))
+      return 0
+    if args.update:
+      save(BASELINE_PATH, current)
+      print(f"Updated {BASELINE_PATH}")
+      return 0
+    regressions = compare(load(BASELINE_PATH), current, args.tolerance)
+
+  if len(regressions) > 0:
+    print(f"FAIL: {len(regressions)} benchmarks regressed by more than {args.tolerance:.0%}")
+    return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,101 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import calculate_storage
+
+DiskUsage = namedtuple("DiskUsage", "total used free percent")
+
+DRIVES_PER_COMPUTER = 4
+# GitHub の issue 本文の上限 (文字数)
+GITHUB_BODY_LIMIT = 65536
+
+
+def make_body(size, text_fraction):
+  # 表の行と、表以外の文章 (説明やスキャン結果の <details>) で size 文字になる本文を作る
+  lines = [
+    "# Storage",
+    "",
+    "| Status | Computer | Drive | Used | Size |",
+    "| :-: | :-: | :-: | :-: | :-: |",
+  ]
+  length = sum(len(line) + 1 for line in lines)
+  table_size = size * (1 - text_fraction)
+  i = 0
+  while length < table_size:
+    computer_name = f"host{i // DRIVES_PER_COMPUTER:05d}"
+    drive = f"/mnt/disk{i % DRIVES_PER_COMPUTER}"
+    line = f"| ✅ | {computer_name} | {drive} | 1.00 GB (1.0%) | 100.00 GB (HDD) | <!-- calculate-storage#{computer_name}#{drive} -->"
+    lines.append(line)
+    length += len(line) + 1
+    i += 1
+  lines.append("")
+  j = 0
+  while length < size:
+    line = f"Notes for the storage table, paragraph {j}: " + "lorem ipsum dolor sit amet " * 10
+    lines.append(line)
+    length += len(line) + 1
+    j += 1
+  return "\n".join(lines)[:size], i
+
+
+def measure(func, repeat):
+  # 1 回あたりの時間 (最小値) とピークメモリ
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  tracemalloc.start()
+  func()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return best, peak
+
+
+def run(size, text_fraction, repeat):
+  body, rows = make_body(size, text_fraction)
+  usage = DiskUsage(total=100 * 1024 ** 3, used=50 * 1024 ** 3, free=50 * 1024 ** 3, percent=50.0)
+
+  with patch.object(calculate_storage.GitHubIssue, "_GitHubIssue__get_issue_body", return_value=body):
+    issue = calculate_storage.GitHubIssue("bench/repo", 1, "token", client=object())
+  # 1 ホスト分 (DRIVES_PER_COMPUTER 行) を更新した状態で差し込む
+  computer_name = "host00000"
+  for drive in issue.get_computer_drives(computer_name):
+    issue.update_storage_row(computer_name, drive, usage)
+  splice = issue._GitHubIssue__splice_storage_rows
+  get_storage_rows = issue._GitHubIssue__get_storage_rows
+
+  results = {}
+  for name, func in (
+    ("parse", get_storage_rows),
+    ("splice", lambda: splice(body)),
+  ):
+    results[name] = measure(func, repeat)
+  return len(body), rows, results
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark parsing and splicing issue bodies up to the GitHub size limit")
+  parser.add_argument("--size", type=int, nargs="+", default=[GITHUB_BODY_LIMIT // 4, GITHUB_BODY_LIMIT])
+  parser.add_argument("--text-fraction", type=float, nargs="+", default=[0.0, 0.5], help="fraction of the body that is non-table text")
+  parser.add_argument("--repeat", type=int, default=500)
+  args = parser.parse_args()
+
+  calculate_storage.logging.disable(calculate_storage.logging.INFO)
+  for size in args.size:
+    for text_fraction in args.text_fraction:
+      length, rows, results = run(size, text_fraction, args.repeat)
+      summary = ", ".join(f"{name}={seconds * 1000:.2f}ms/{peak / 1024:.0f}KiB" for name, (seconds, peak) in results.items())
+      print(f"chars={length} rows={rows} text={text_fraction:.0%}: {summary}")
+
+
+if __name__ == "__main__":
+  main()
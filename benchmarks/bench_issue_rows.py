@@ -0,0 +1,124 @@
+import argparse
+import os
+import sys
+import time
+from collections import namedtuple
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import calculate_storage
+
+DiskUsage = namedtuple("DiskUsage", "total used free percent")
+
+DRIVES_PER_COMPUTER = 4
+
+
+def make_body(rows):
+  lines = [
+    "# Storage",
+    "",
+    "| Status | Computer | Drive | Used | Size |",
+    "| :-: | :-: | :-: | :-: | :-: |",
+  ]
+  for i in range(rows):
+    computer_name = f"host{i // DRIVES_PER_COMPUTER:05d}"
+    drive = f"/mnt/disk{i % DRIVES_PER_COMPUTER}"
+    lines.append(f"| ✅ | {computer_name} | {drive} | 1.00 GB (1.0%) | 100.00 GB (HDD) | <!-- calculate-storage#{computer_name}#{drive} -->")
+  lines.append("")
+  return "\n".join(lines)
+
+
+def legacy_rewrite(body, storage_rows):
+  # 変更前の実装 (行ごとに storage_rows を線形探索する)
+  new_rows = []
+  for row in body.split("\n"):
+    m = calculate_storage.GitHubIssue.row_regex.match(row)
+    if m is None:
+      new_rows.append(row)
+      continue
+    computer_name = m.group("computer_name")
+    drive = m.group("drive")
+    for storage_row in storage_rows:
+      if storage_row["computer_name"] == computer_name and storage_row["drive"] == drive:
+        new_rows.append(storage_row["markdown"]["raw"] + f" <!-- calculate-storage#{computer_name}#{drive} -->")
+        break
+  return "\n".join(new_rows)
+
+
+class IssueBodyStore:
+  # PATCH された本文を次の取得で返す (update_issue_body は書き込んだ後に取り直して確認するので)
+  def __init__(self, body):
+    self.body = body
+
+  def get_body(self, *args, **kwargs):
+    return self.body
+
+  def patch(self, path, json=None, headers=None, retry=True):
+    self.body = json["body"]
+    response = MagicMock()
+    response.status_code = 200
+    return response
+
+
+def timed(func):
+  start = time.perf_counter()
+  func()
+  return time.perf_counter() - start
+
+
+def run(rows, legacy):
+  body = make_body(rows)
+  usage = DiskUsage(total=100 * 1024 ** 3, used=50 * 1024 ** 3, free=50 * 1024 ** 3, percent=50.0)
+
+  store = IssueBodyStore(body)
+  with patch.object(calculate_storage.GitHubIssue, "_GitHubIssue__get_issue_body", side_effect=store.get_body), \
+      patch("calculate_storage.GitHubClient.patch", side_effect=store.patch):
+    issue = None
+
+    def parse():
+      nonlocal issue
+      issue = calculate_storage.GitHubIssue("bench/repo", 1, "token")
+
+    def update_rows():
+      for computer_name, drive in list(issue.storage_rows):
+        issue.update_storage_row(computer_name, drive, usage)
+
+    def lookup_drives():
+      for computer_name in list(issue.computer_index):
+        issue.get_computer_drives(computer_name)
+
+    results = {
+      "parse": timed(parse),
+      "update_storage_row": timed(update_rows),
+      "get_computer_drives": timed(lookup_drives),
+      "update_issue_body": timed(issue.update_issue_body),
+    }
+
+  if legacy:
+    legacy_rows = [
+      {"computer_name": row.computer_name, "drive": row.drive, "markdown": {"raw": row.raw}}
+      for row in issue.storage_rows.values()
+    ]
+    results["legacy_rewrite"] = timed(lambda: legacy_rewrite(body, legacy_rows))
+
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark GitHubIssue row handling on synthetic issue bodies")
+  parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 50000])
+  parser.add_argument("--legacy", action="store_true", help="also time the previous O(lines x rows) rewrite (slow for large row counts)")
+  args = parser.parse_args()
+
+  # 確認前の待ち時間は測らない
+  os.environ["CALCULATE_STORAGE_VERIFY_DELAY"] = "0"
+  calculate_storage.logging.disable(calculate_storage.logging.INFO)
+  for rows in args.rows:
+    results = run(rows, args.legacy)
+    summary = ", ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in results.items())
+    print(f"rows={rows}: {summary}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,82 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import calculate_storage
+
+DRIVES_PER_HOST = 4
+
+
+def make_results(results_dir, hosts, days, runs_per_day):
+  # save_results と同じ形式のファイルを hosts x days 個作る
+  rng = random.Random(0)
+  start = datetime.date(2024, 1, 1)
+  records = 0
+  for day in range(days):
+    date = start + datetime.timedelta(days=day)
+    timestamp = datetime.datetime.combine(date, datetime.time()).timestamp()
+    for host in range(hosts):
+      with open(os.path.join(results_dir, f"host{host:04d}_{date:%Y%m%d}.txt"), "w", encoding="utf-8") as f:
+        for run in range(runs_per_day):
+          for drive in range(DRIVES_PER_HOST):
+            used = rng.randint(1, 1000) * 1024 ** 3
+            f.write(json.dumps({
+              "drive": f"/mnt/disk{drive}",
+              "status": "ok",
+              "timestamp": timestamp + run * 86400 / runs_per_day,
+              "used": used,
+              "total": 1000 * 1024 ** 3,
+              "percent": used / (1000 * 1024 ** 3) * 100,
+              "used_size": "",
+              "total_size": ""
+            }) + "\n")
+            records += 1
+  return records
+
+
+def read_all(results_dir, workers):
+  for _ in calculate_storage.iter_results(results_dir, workers=workers):
+    pass
+
+
+def summarize(results_dir, workers):
+  return calculate_storage.summarize_result_files(results_dir, workers=workers)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark streaming reads of the results directory")
+  parser.add_argument("--hosts", type=int, default=50)
+  parser.add_argument("--days", type=int, nargs="+", default=[30, 90])
+  parser.add_argument("--runs-per-day", type=int, default=24)
+  parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+  args = parser.parse_args()
+
+  for days in args.days:
+    with tempfile.TemporaryDirectory() as results_dir:
+      records = make_results(results_dir, args.hosts, days, args.runs_per_day)
+      for name, func in (("iter_results", read_all), ("summarize_result_files", summarize)):
+        for workers in args.workers:
+          start = time.perf_counter()
+          func(results_dir, workers)
+          elapsed = time.perf_counter() - start
+          print(f"days={days} records={records} {name} workers={workers}: {elapsed:.2f}s ({records / elapsed:,.0f} records/s)")
+
+      # 履歴が増えてもピークメモリがレコード数に比例しないことを確認する
+      # (残るのはファイル名の一覧だけ。workers=1 のみ、tracemalloc は子プロセスを測れない)
+      tracemalloc.start()
+      summarize(results_dir, 1)
+      _, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      print(f"days={days} records={records}: peak memory {peak / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,63 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import calculate_storage
+
+
+def bench_ring(capacity, samples):
+  # リングへの追加の時間と、容量を超えて追加してもメモリが増えないこと
+  ring = calculate_storage.SampleRing(capacity)
+  for n in range(capacity):
+    ring.append(float(n), n, n)
+  tracemalloc.start()
+  before, _ = tracemalloc.get_traced_memory()
+  start = time.perf_counter()
+  for n in range(samples):
+    ring.append(float(n), n, n)
+  elapsed = time.perf_counter() - start
+  after, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  start = time.perf_counter()
+  ring.summarize(0)
+  summarize_elapsed = time.perf_counter() - start
+  return elapsed / samples, after - before, summarize_elapsed
+
+
+def bench_poll(drives, polls):
+  # 実際の psutil で 1 回の取得にかかる CPU 時間
+  sampler = calculate_storage.UsageSampler(3600, capacity=polls + 1, cpu_budget=0)
+  devices = calculate_storage.get_io_devices(drives)
+  sampler.targets = tuple((drive, calculate_storage.SampleRing(polls + 1), devices[drive]) for drive in drives)
+  costs = []
+  for _ in range(polls):
+    start = time.thread_time()
+    sampler.poll()
+    costs.append(time.thread_time() - start)
+  costs.sort()
+  return costs[len(costs) // 2], costs[-1], devices
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Measure the overhead of the disk usage / I/O sampler")
+  parser.add_argument("--drives", nargs="+", default=["C:\\" if os.name == "nt" else "/"])
+  parser.add_argument("--polls", type=int, default=200)
+  parser.add_argument("--interval", type=float, nargs="+", default=[1.0, 10.0], help="sample intervals to report the CPU share for")
+  parser.add_argument("--capacity", type=int, default=4096)
+  args = parser.parse_args()
+
+  per_sample, growth, summarize_elapsed = bench_ring(args.capacity, args.capacity * 10)
+  print(f"ring: {per_sample * 1e6:.2f}us per sample, {growth} bytes allocated after {args.capacity * 10} samples, summarize {args.capacity} samples in {summarize_elapsed * 1000:.2f}ms")
+
+  median, worst, devices = bench_poll(args.drives, args.polls)
+  print(f"poll {len(args.drives)} drives ({', '.join(f'{drive}={device}' for drive, device in devices.items())}): median {median * 1000:.3f}ms CPU, max {worst * 1000:.3f}ms")
+  for interval in args.interval:
+    print(f"interval={interval}s: {median / interval:.3%} of a core")
+
+
+if __name__ == "__main__":
+  main()
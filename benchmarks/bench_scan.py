@@ -0,0 +1,58 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import calculate_storage
+
+
+def make_tree(root, files, files_per_dir, fanout):
+  # files 個の小さなファイルを、1 ディレクトリ files_per_dir 個ずつ fanout 分岐の木に置く
+  directories = [root]
+  created = 0
+  index = 0
+  while created < files:
+    directory = directories[index]
+    index += 1
+    for i in range(fanout):
+      child = os.path.join(directory, f"d{i}")
+      os.mkdir(child)
+      directories.append(child)
+    for i in range(min(files_per_dir, files - created)):
+      with open(os.path.join(directory, f"f{i}"), "wb") as f:
+        f.write(b"x" * (i % 7 * 100))
+      created += 1
+  return len(directories)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark scan_directory_usage on a synthetic directory tree")
+  parser.add_argument("--files", type=int, default=1000000)
+  parser.add_argument("--files-per-dir", type=int, default=100)
+  parser.add_argument("--fanout", type=int, default=4)
+  parser.add_argument("--workers", type=int, nargs="+", default=[1, 8])
+  parser.add_argument("--dir", help="create the tree under this directory (default: a temporary directory)")
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory(dir=args.dir) as root:
+    start = time.perf_counter()
+    directories = make_tree(root, args.files, args.files_per_dir, args.fanout)
+    print(f"created {args.files} files in {directories} directories in {time.perf_counter() - start:.1f}s")
+
+    for workers in args.workers:
+      usage = calculate_storage.scan_directory_usage(root, top_n=10, depth=2, time_budget=3600, max_entries=args.files * 2, max_workers=workers)
+      rate = usage.files / usage.elapsed if usage.elapsed > 0 else 0
+      print(f"workers={workers}: {usage.files} files, {usage.directories} directories in {usage.elapsed:.2f}s ({rate:,.0f} files/s, truncated={usage.truncated})")
+
+    # 2 回目以降は DirectoryUsageCache で、変わっていないディレクトリの読み直しを省く
+    cache = calculate_storage.DirectoryUsageCache(None, root, max_age=3600)
+    for label in ("cold", "warm"):
+      usage = calculate_storage.scan_directory_usage(root, top_n=10, depth=2, time_budget=3600, max_entries=args.files * 2, max_workers=max(args.workers), cache=cache)
+      print(f"cache {label}: {usage.files} files in {usage.elapsed:.2f}s ({usage.cached_directories}/{usage.directories + 1} directories from cache)")
+
+
+if __name__ == "__main__":
+  main()
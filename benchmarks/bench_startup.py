@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+THRESHOLD_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_threshold.json")
+
+
+def measure_import_us():
+  # -X importtime の出力から calculate_storage の cumulative (us) を取り出す
+  result = subprocess.run(
+    [sys.executable, "-X", "importtime", "-c", "import calculate_storage"],
+    cwd=ROOT_DIR,
+    capture_output=True,
+    text=True,
+    check=True
+  )
+  for line in result.stderr.splitlines():
+    parts = [part.strip() for part in line.split("|")]
+    if len(parts) == 3 and parts[2] == "calculate_storage":
+      return int(parts[1])
+  raise Exception("calculate_storage not found in -X importtime output")
+
+
+def measure_help_ms():
+  start = time.perf_counter()
+  subprocess.run(
+    [sys.executable, "calculate_storage.py", "--help"],
+    cwd=ROOT_DIR,
+    capture_output=True,
+    check=True
+  )
+  return (time.perf_counter() - start) * 1000
+
+
+def loaded_modules(modules):
+  code = "import sys, calculate_storage; print(' '.join(m for m in sys.argv[1:] if m in sys.modules))"
+  result = subprocess.run(
+    [sys.executable, "-c", code, *modules],
+    cwd=ROOT_DIR,
+    capture_output=True,
+    text=True,
+    check=True
+  )
+  return result.stdout.split()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Measure calculate_storage cold-start cost against the tracked threshold")
+  parser.add_argument("--runs", type=int, default=10)
+  parser.add_argument("--update", action="store_true", help="write the measured values (with 50%% headroom) as the new threshold")
+  args = parser.parse_args()
+
+  with open(THRESHOLD_PATH, "r", encoding="utf-8") as f:
+    threshold = json.load(f)
+
+  import_us = statistics.median(measure_import_us() for _ in range(args.runs))
+  help_ms = statistics.median(measure_help_ms() for _ in range(args.runs))
+  loaded = loaded_modules(threshold["deferred_modules"])
+
+  print(f"import calculate_storage: {import_us:.0f}us (threshold {threshold['import_cumulative_us']}us)")
+  print(f"calculate_storage.py --help: {help_ms:.1f}ms (threshold {threshold['help_wall_ms']}ms)")
+  print(f"deferred modules loaded at import: {', '.join(loaded) or 'none'}")
+
+  if args.update:
+    threshold["import_cumulative_us"] = int(import_us * 1.5)
+    threshold["help_wall_ms"] = int(help_ms * 1.5)
+    with open(THRESHOLD_PATH, "w", encoding="utf-8") as f:
+      json.dump(threshold, f, indent=2)
+      f.write("\n")
+    print(f"Updated {THRESHOLD_PATH}")
+    return 0
+
+  failed = False
+  if import_us > threshold["import_cumulative_us"]:
+    print("FAIL: import time regressed")
+    failed = True
+  if help_ms > threshold["help_wall_ms"]:
+    print("FAIL: --help wall time regressed")
+    failed = True
+  if loaded:
+    print("FAIL: heavy modules are imported eagerly")
+    failed = True
+  return 1 if failed else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,202 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ISSUE_PATH_REGEX = re.compile(r"^/repos/(?P<repo>[^/]+/[^/]+)/issues/(?P<number>[0-9]+)$")
+
+
+class FakeGitHubServer:
+  # GitHub Issues API の GET / PATCH (/repos/{owner}/{repo}/issues/{number}) を真似するローカルサーバー
+  # 遅延、ETag (304)、レート制限のヘッダー、エラーの注入を設定できる
+  # PATCH は本物と同じく本文を丸ごと置き換える (If-Match のような競合検出はしない)
+  # テスト用に、actions に "503" / "502" / "429" / "ratelimit" / "reset" / "slow" (None は通常の応答) を積むと、
+  # 届いた順にリクエストをその動作にする。headers に入れたヘッダーはすべての応答に足す (同じ名前は上書き)
+  def __init__(self, issues=None, latency=0.0, jitter=0.0, error_rate=0.0, reset_rate=0.0, rate_limit=5000, rate_limit_window=3600.0, host="127.0.0.1", port=0, seed=None):
+    # (repo, number) -> 本文
+    self.issues = dict(issues or {})
+    self.latency = latency
+    self.jitter = jitter
+    self.error_rate = error_rate
+    self.reset_rate = reset_rate
+    self.rate_limit = rate_limit
+    self.rate_limit_window = rate_limit_window
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.stats = Counter()
+    self.window_start = time.time()
+    self.window_used = 0
+    self.actions = []
+    self.headers = {}
+    # (method, path) と、クライアントの送信元ポート (接続を使い回しているかの確認用)
+    self.requests = []
+    self.client_ports = set()
+
+    fake = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = "HTTP/1.1"
+      # ヘッダーと本文を別々に送るので、Nagle と遅延 ACK で応答ごとに 40ms 待たされないようにする
+      disable_nagle_algorithm = True
+
+      def do_GET(self):
+        fake._handle(self, "GET")
+
+      def do_PATCH(self):
+        fake._handle(self, "PATCH")
+
+      def log_message(self, format, *args):
+        pass
+
+    self.server = ThreadingHTTPServer((host, port), Handler)
+    self.server.daemon_threads = True
+    self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+
+  @property
+  def url(self):
+    host, port = self.server.server_address[:2]
+    return f"http://{host}:{port}"
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def get_body(self, repo, number):
+    with self.lock:
+      return self.issues.get((repo, int(number)))
+
+  def set_body(self, repo, number, body):
+    with self.lock:
+      self.issues[(repo, int(number))] = body
+
+  def _take_rate_limit(self):
+    # 固定ウィンドウで数える。使い切ったら None (403 を返す)
+    now = time.time()
+    if now - self.window_start >= self.rate_limit_window:
+      self.window_start = now
+      self.window_used = 0
+    reset = int(self.window_start + self.rate_limit_window) + 1
+    if self.window_used >= self.rate_limit:
+      return None, reset
+    self.window_used += 1
+    return self.rate_limit - self.window_used, reset
+
+  def _handle(self, handler, method):
+    start = time.perf_counter()
+    length = int(handler.headers.get("Content-Length") or 0)
+    payload = handler.rfile.read(length) if length else b""
+    with self.lock:
+      self.requests.append((method, handler.path))
+      self.client_ports.add(handler.client_address[1])
+      action = self.actions.pop(0) if self.actions else None
+    delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter > 0 else 0.0)
+    if action == "slow":
+      delay += 0.5
+    if delay > 0:
+      time.sleep(delay)
+
+    m = ISSUE_PATH_REGEX.match(handler.path)
+    with self.lock:
+      self.stats[f"{method} requests"] += 1
+      remaining, reset = self._take_rate_limit()
+      roll = self.random.random()
+      if action == "reset" or roll < self.reset_rate:
+        self.stats["injected resets"] += 1
+        handler.close_connection = True
+        return
+      headers = {
+        "X-RateLimit-Limit": str(self.rate_limit),
+        "X-RateLimit-Remaining": str(remaining if remaining is not None else 0),
+        "X-RateLimit-Reset": str(reset)
+      }
+      headers.update(self.headers)
+      if action == "429":
+        # secondary rate limit
+        self.stats["rate limited"] += 1
+        status, body = 429, {"message": "You have exceeded a secondary rate limit"}
+        headers["Retry-After"] = "1"
+      elif action == "ratelimit" or remaining is None:
+        self.stats["rate limited"] += 1
+        status, body = 403, {"message": "API rate limit exceeded"}
+        if action == "ratelimit":
+          headers["X-RateLimit-Remaining"] = "0"
+          headers["X-RateLimit-Reset"] = str(int(time.time()) + 3600)
+      elif action in ("502", "503") or roll < self.reset_rate + self.error_rate:
+        self.stats["injected errors"] += 1
+        status = int(action) if action in ("502", "503") else self.random.choice((502, 503))
+        body = {"message": "Server Error"}
+      elif m is None or (m.group("repo"), int(m.group("number"))) not in self.issues:
+        status, body = 404, {"message": "Not Found"}
+      else:
+        key = (m.group("repo"), int(m.group("number")))
+        if method == "PATCH":
+          self.issues[key] = json.loads(payload)["body"]
+        status, body = 200, {"number": key[1], "body": self.issues[key]}
+        headers["ETag"] = '"' + hashlib.sha1(body["body"].encode("utf-8")).hexdigest() + '"'
+        if method == "GET" and handler.headers.get("If-None-Match") == headers["ETag"]:
+          self.stats["not modified"] += 1
+          status, body = 304, None
+      self.stats[f"status {status}"] += 1
+      self.stats["server seconds"] += time.perf_counter() - start
+
+    data = json.dumps(body).encode("utf-8") if body is not None else b""
+    handler.send_response(status)
+    if body is not None:
+      handler.send_header("Content-Type", "application/json")
+    for name, value in headers.items():
+      handler.send_header(name, value)
+    handler.send_header("Content-Length", str(len(data)))
+    handler.end_headers()
+    handler.wfile.write(data)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Serve a fake GitHub Issues API for manual runs (set CALCULATE_STORAGE_GITHUB_API_URL to the printed URL)")
+  parser.add_argument("--port", type=int, default=8080)
+  parser.add_argument("--repo", default="owner/repo")
+  parser.add_argument("--issue", type=int, default=1)
+  parser.add_argument("--body-file", help="initial issue body (default: empty)")
+  parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+  parser.add_argument("--jitter", type=float, default=0.0, help="random extra seconds (0 to this) added to every response")
+  parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 502/503")
+  parser.add_argument("--reset-rate", type=float, default=0.0, help="fraction of requests whose connection is dropped")
+  parser.add_argument("--rate-limit", type=int, default=5000, help="requests per --rate-limit-window before 403")
+  parser.add_argument("--rate-limit-window", type=float, default=3600.0)
+  args = parser.parse_args()
+
+  body = ""
+  if args.body_file:
+    with open(args.body_file, "r", encoding="utf-8") as f:
+      body = f.read()
+
+  server = FakeGitHubServer(
+    {(args.repo, args.issue): body},
+    latency=args.latency,
+    jitter=args.jitter,
+    error_rate=args.error_rate,
+    reset_rate=args.reset_rate,
+    rate_limit=args.rate_limit,
+    rate_limit_window=args.rate_limit_window,
+    port=args.port
+  )
+  print(f"Serving {args.repo}#{args.issue} at {server.url}")
+  try:
+    server.server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server.server_close()
+    print(dict(server.stats))
+
+
+if __name__ == "__main__":
+  main()
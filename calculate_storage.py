@@ -1,12 +1,36 @@
+import argparse
+import array
+import contextlib
 import datetime
+import hashlib
 import json
+import mmap
+import queue
+import random
 import re
+import signal
+import struct
 import sys
 import os
-import psutil
-import requests
+import tempfile
+import threading
+import time
+from collections import deque, namedtuple
+import importlib
+import itertools
 import logging
 
+# requests / psutil は読み込みが重いので、--help や引数チェックだけで終わる場合に読み込まないよう、
+# 使う関数の中で import する。calculate_storage.psutil のようなモジュール属性としても参照できるようにしておく
+_LAZY_MODULES = ("psutil", "requests")
+
+def __getattr__(name):
+  if name in _LAZY_MODULES:
+    module = importlib.import_module(name)
+    globals()[name] = module
+    return module
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 def _get_default_log_dir():
   if os.name == "nt":
     user_profile = os.environ.get("USERPROFILE", os.path.expanduser("~"))
@@ -19,6 +43,173 @@ def _find_handler(root_logger, name):
       return handler
   return None
 
+def _get_env_float(name, default):
+  value = os.environ.get(name)
+  if value is None or value == "":
+    return default
+  try:
+    return float(value)
+  except ValueError:
+    raise ValueError(f"Invalid value for {name}: {value}") from None
+
+def _get_env_int(name, default):
+  value = os.environ.get(name)
+  if value is None or value == "":
+    return default
+  try:
+    return int(value)
+  except ValueError:
+    raise ValueError(f"Invalid value for {name}: {value}") from None
+
+def _atomic_write(path, data, fsync=True):
+  # 同じディレクトリの一時ファイルに書いてから os.replace で置き換える
+  # (読み込み途中や、途中で落ちたときに壊れたファイルを見せない)。data は str か bytes
+  if isinstance(data, str):
+    data = data.encode("utf-8")
+  directory, name = os.path.split(os.path.abspath(path))
+  fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+  try:
+    with os.fdopen(fd, "wb") as f:
+      f.write(data)
+      if fsync:
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+  except BaseException:
+    try:
+      os.unlink(tmp_path)
+    except OSError:
+      pass
+    raise
+
+def _safe_filename(name):
+  # ホスト名やドライブ名をファイル名に使えるようにする
+  return re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+
+# setup_logging が作るファイル (日付ごとのログと、そのローテーション・圧縮済みのもの)
+LOG_FILENAME_REGEX = re.compile(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}\.log(\.[0-9]+)?(\.gz)?$")
+
+class JsonLogFormatter(logging.Formatter):
+  # CALCULATE_STORAGE_LOG_FORMAT=json のときのファイルの形式 (1 行 1 レコード)
+  def format(self, record):
+    data = {
+      "time": datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+      "level": record.levelname,
+      "logger": record.name,
+      "thread": record.threadName,
+      "message": record.getMessage()
+    }
+    if record.exc_info and not record.exc_text:
+      record.exc_text = self.formatException(record.exc_info)
+    if record.exc_text:
+      data["exception"] = record.exc_text
+    return json.dumps(data, ensure_ascii=False)
+
+def _compress_log_file(source, dest):
+  # RotatingFileHandler.rotator としても使う。途中で止まっても壊れた .gz が残らないように置き換える
+  import gzip
+
+  stat = os.stat(source)
+  tmp_path = dest + ".tmp"
+  with open(source, "rb") as src, gzip.open(tmp_path, "wb") as dst:
+    for chunk in iter(lambda: src.read(1024 * 1024), b""):
+      dst.write(chunk)
+  os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+  os.replace(tmp_path, dest)
+  os.remove(source)
+
+def prune_log_files(log_dir, current_path, max_age_days, max_total_bytes, now=None):
+  # 前の日のログを圧縮し、max_age_days 日より古いものと、合計が max_total_bytes を超えた分を古い順に消す
+  # 書き込み中のファイルは消さない。戻り値は (圧縮した数, 消した数)
+  if now is None:
+    now = time.time()
+  current_name = os.path.basename(current_path)
+  compressed = 0
+  entries = []
+  total = 0
+  for name in os.listdir(log_dir):
+    if LOG_FILENAME_REGEX.match(name) is None:
+      continue
+    path = os.path.join(log_dir, name)
+    try:
+      if name != current_name and not name.endswith(".gz"):
+        _compress_log_file(path, path + ".gz")
+        path += ".gz"
+        compressed += 1
+      stat = os.stat(path)
+    except OSError as e:
+      logging.warning(f"Failed to compress log file {path}: {e}")
+      continue
+    total += stat.st_size
+    if name != current_name:
+      entries.append((stat.st_mtime, stat.st_size, path))
+
+  removed = 0
+  entries.sort()
+  for mtime, size, path in entries:
+    if mtime >= now - max_age_days * 86400 and total <= max_total_bytes:
+      break
+    try:
+      os.remove(path)
+    except OSError as e:
+      logging.warning(f"Failed to remove log file {path}: {e}")
+      continue
+    total -= size
+    removed += 1
+  return compressed, removed
+
+_queued_file_handler_class = None
+
+def _get_queued_file_handler_class():
+  # logging.handlers は読み込みが重い (socket / pickle) ので、ログを設定するときだけ読み込む
+  global _queued_file_handler_class
+  if _queued_file_handler_class is not None:
+    return _queued_file_handler_class
+
+  import logging.handlers
+
+  class QueuedFileHandler(logging.handlers.QueueHandler):
+    # ログを出すスレッドはキューに積むだけで、ファイルへの書き込みとローテーション (gzip) は QueueListener のスレッドで行う
+    def __init__(self, path, max_bytes, backup_count, formatter):
+      super().__init__(queue.Queue())
+      file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+      file_handler.namer = lambda name: name + ".gz"
+      file_handler.rotator = _compress_log_file
+      file_handler.setFormatter(formatter)
+      self.file_handler = file_handler
+      self.baseFilename = file_handler.baseFilename
+      self.closed = False
+      self.listener = logging.handlers.QueueListener(self.queue, file_handler)
+      self.listener.start()
+
+    def prepare(self, record):
+      # 引数は埋め込んでおく (後から書き換えられても影響しないように)。書式はファイル側の Formatter で付ける
+      # makeLogRecord は LogRecord.__init__ をもう一度通るので、属性だけを写す
+      prepared = logging.LogRecord.__new__(logging.LogRecord)
+      prepared.__dict__.update(record.__dict__)
+      record = prepared
+      record.msg = record.getMessage()
+      record.args = None
+      if record.exc_info:
+        record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+      return record
+
+    def flush(self):
+      # キューに積まれた分を書き終えるまで待つ
+      if not self.closed:
+        self.queue.join()
+      self.file_handler.flush()
+
+    def close(self):
+      if not self.closed:
+        self.closed = True
+        self.listener.stop()
+        self.file_handler.close()
+      super().close()
+
+  _queued_file_handler_class = QueuedFileHandler
+  return _queued_file_handler_class
 
 def setup_logging():
   log_dir = os.environ.get("CALCULATE_STORAGE_LOG_DIR", _get_default_log_dir())
@@ -67,14 +258,31 @@ def setup_logging():
 
   root_logger.setLevel(logging.DEBUG)
   formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+  file_formatter = JsonLogFormatter() if os.environ.get("CALCULATE_STORAGE_LOG_FORMAT", "text") == "json" else formatter
 
+  # 日付が変わったとき (と起動時) に、古いログを圧縮・削除する
   try:
-    file_handler = logging.FileHandler(log_path, encoding="utf-8")
+    compressed, removed = prune_log_files(
+      log_dir,
+      log_path,
+      _get_env_float("CALCULATE_STORAGE_LOG_MAX_AGE_DAYS", 30.0),
+      _get_env_float("CALCULATE_STORAGE_LOG_MAX_TOTAL_MB", 200.0) * 1024 * 1024
+    )
+  except OSError as e:
+    compressed, removed = 0, 0
+    logging.warning(f"Failed to prune log directory {log_dir}: {e}")
+
+  try:
+    file_handler = _get_queued_file_handler_class()(
+      log_path,
+      int(_get_env_float("CALCULATE_STORAGE_LOG_MAX_MB", 10.0) * 1024 * 1024),
+      _get_env_int("CALCULATE_STORAGE_LOG_BACKUPS", 5),
+      file_formatter
+    )
   except OSError as e:
     raise OSError(f"Failed to create log file: {log_path}: {e}") from e
   file_handler.name = "calculate-storage-file"
   file_handler.setLevel(logging.DEBUG)
-  file_handler.setFormatter(formatter)
 
   stream_handler = logging.StreamHandler()
   stream_handler.name = "calculate-storage-stream"
@@ -83,24 +291,338 @@ def setup_logging():
 
   root_logger.addHandler(file_handler)
   root_logger.addHandler(stream_handler)
+  if compressed > 0 or removed > 0:
+    logging.info(f"Log files: compressed {compressed}, removed {removed}")
 
   return log_path
 
+class PhaseTimer:
+  # フェーズ名 -> 所要時間 (秒)。同じフェーズを何度か通った場合は足し合わせる
+  def __init__(self):
+    self.timings = {}
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+  def merge(self, timings):
+    for name, seconds in timings.items():
+      self.timings[name] = self.timings.get(name, 0.0) + seconds
+    return self.timings
+
+  def pop(self):
+    # 1 回の実行分を取り出して、次の実行のために空にする
+    timings = self.timings
+    self.timings = {}
+    return timings
+
+class StorageRow:
+  __slots__ = (
+    "computer_name",
+    "drive",
+    "checkmark",
+    "view_computer_name",
+    "view_drive",
+    "used",
+    "size",
+    "drive_type",
+    "raw",
+  )
+
+  def __init__(self, computer_name, drive, checkmark, view_computer_name, view_drive, used, size, drive_type, raw):
+    self.computer_name = computer_name
+    self.drive = drive
+    self.checkmark = checkmark
+    self.view_computer_name = view_computer_name
+    self.view_drive = view_drive
+    self.used = used
+    self.size = size
+    self.drive_type = drive_type
+    self.raw = raw
+
+  @property
+  def key(self):
+    return (self.computer_name, self.drive)
+
+  def render(self):
+    return f"| {self.checkmark} | {self.view_computer_name} | {self.view_drive} | {self.used} | {self.size} ({self.drive_type}) |"
+
+  def render_line(self):
+    return f"{self.raw} <!-- calculate-storage#{self.computer_name}#{self.drive} -->"
+
+class GitHubRateLimitError(Exception):
+  pass
+
+class GitHubTransientError(Exception):
+  # retry=False のリクエストが一時的に失敗した。呼び出し側で wait 秒 (None ならバックオフ) 待ってからやり直す
+  def __init__(self, message, wait=None):
+    super().__init__(message)
+    self.wait = wait
+
+class GitHubClient:
+  default_api_url = "https://api.github.com"
+  # 一時的なエラーとみなしてリトライするステータスコード
+  retry_status_codes = (500, 502, 503, 504)
+  # レート制限 (primary / secondary) のときに返ってくるステータスコード
+  rate_limit_status_codes = (403, 429)
+
+  def __init__(self, github_token, api_url=None, connect_timeout=None, read_timeout=None, max_retries=None, backoff_base=None, backoff_max=None, pool_size=None):
+    if api_url is None:
+      api_url = os.environ.get("CALCULATE_STORAGE_GITHUB_API_URL") or self.default_api_url
+    if connect_timeout is None:
+      connect_timeout = _get_env_float("CALCULATE_STORAGE_HTTP_CONNECT_TIMEOUT", 5.0)
+    if read_timeout is None:
+      read_timeout = _get_env_float("CALCULATE_STORAGE_HTTP_READ_TIMEOUT", 30.0)
+    if max_retries is None:
+      max_retries = _get_env_int("CALCULATE_STORAGE_HTTP_RETRIES", 3)
+    if backoff_base is None:
+      backoff_base = _get_env_float("CALCULATE_STORAGE_HTTP_BACKOFF", 1.0)
+    if backoff_max is None:
+      backoff_max = 30.0
+    if pool_size is None:
+      pool_size = _get_env_int("CALCULATE_STORAGE_HTTP_POOL_SIZE", 4)
+
+    self.api_url = api_url.rstrip("/")
+    self.timeout = (connect_timeout, read_timeout)
+    self.max_retries = max_retries
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    # 残りリクエスト数がこの数以下になったら、リセットまで待つ (待ち時間が rate_limit_max_wait を超えるなら諦める)
+    self.rate_limit_reserve = _get_env_int("CALCULATE_STORAGE_RATE_LIMIT_RESERVE", 10)
+    self.rate_limit_max_wait = _get_env_float("CALCULATE_STORAGE_RATE_LIMIT_MAX_WAIT", 60.0)
+    self.rate_limit_remaining = None
+    self.rate_limit_reset = None
+
+    import requests
+
+    # Session を使い回して、GET / GET / PATCH で TCP + TLS の接続を再利用する
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    self.session.mount("https://", adapter)
+    self.session.mount("http://", adapter)
+    self.session.headers.update({
+      "Authorization": f"token {github_token}",
+      "Accept": "application/vnd.github+json",
+      "User-Agent": "calculate-storage"
+    })
+
+  def get(self, path, headers=None):
+    return self.request("GET", path, headers=headers)
+
+  def patch(self, path, json=None, headers=None, retry=True):
+    return self.request("PATCH", path, headers=headers, json=json, retry=retry)
+
+  def request(self, method, path, headers=None, json=None, retry=True):
+    # retry=False のときは送る前にも失敗した後にも待たず、一時的な失敗は GitHubTransientError にする
+    # (取得した本文をもとにした PATCH を、待っている間に古くなった内容で送らないように)
+    import requests
+
+    url = f"{self.api_url}{path}"
+    attempt = 0
+    while True:
+      self.__wait_for_rate_limit(retry)
+      try:
+        response = self.session.request(method, url, headers=headers, json=json, timeout=self.timeout)
+      except (requests.ConnectionError, requests.Timeout) as e:
+        if not retry:
+          raise GitHubTransientError(f"{method} {url} failed: {e}") from e
+        if attempt >= self.max_retries:
+          raise
+        logging.warning(f"{method} {url} failed: {e} (retry {attempt + 1}/{self.max_retries})")
+      else:
+        self.__update_rate_limit(response)
+        if response.status_code in self.rate_limit_status_codes:
+          wait = self.__get_rate_limit_wait(response)
+          if wait is None:
+            # レート制限以外の 403 (権限不足など)
+            return response
+          if wait > self.rate_limit_max_wait or (retry and attempt >= self.max_retries):
+            raise GitHubRateLimitError(f"GitHub API rate limit exceeded ({method} {url}, retry after {wait:.0f}s)")
+          if not retry:
+            raise GitHubTransientError(f"{method} {url} is rate limited, retry after {wait:.1f}s", wait)
+          logging.warning(f"{method} {url} is rate limited, waiting {wait:.1f}s (retry {attempt + 1}/{self.max_retries})")
+          time.sleep(wait)
+          attempt += 1
+          continue
+        if response.status_code in self.retry_status_codes and not retry:
+          raise GitHubTransientError(f"{method} {url} returned {response.status_code}")
+        if response.status_code not in self.retry_status_codes or attempt >= self.max_retries:
+          return response
+        logging.warning(f"{method} {url} returned {response.status_code} (retry {attempt + 1}/{self.max_retries})")
+
+      self.__sleep_backoff(attempt)
+      attempt += 1
+
+  def close(self):
+    self.session.close()
+
+  def __update_rate_limit(self, response):
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    reset = response.headers.get("X-RateLimit-Reset")
+    if remaining is None or reset is None:
+      return
+    try:
+      self.rate_limit_remaining = int(remaining)
+      self.rate_limit_reset = int(reset)
+    except ValueError:
+      return
+
+  def __get_rate_limit_wait(self, response):
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+      try:
+        return max(0.0, float(retry_after))
+      except ValueError:
+        pass
+    if response.headers.get("X-RateLimit-Remaining") == "0" and self.rate_limit_reset is not None:
+      return max(0.0, self.rate_limit_reset - time.time())
+    return None
+
+  def __wait_for_rate_limit(self, retry=True):
+    # 残りが少ないときは、使い切ってエラーになる前にリセットまで待つ
+    if self.rate_limit_remaining is None or self.rate_limit_remaining > self.rate_limit_reserve:
+      return
+    wait = self.rate_limit_reset - time.time()
+    if wait <= 0:
+      return
+    if wait > self.rate_limit_max_wait:
+      raise GitHubRateLimitError(f"GitHub API rate limit is low ({self.rate_limit_remaining} remaining), deferring until reset in {wait:.0f}s")
+    if not retry:
+      # 待つのは呼び出し側 (待った後に取り直す)
+      raise GitHubTransientError(f"GitHub API rate limit is low ({self.rate_limit_remaining} remaining), reset in {wait:.1f}s", wait)
+    logging.warning(f"GitHub API rate limit is low ({self.rate_limit_remaining} remaining), waiting {wait:.1f}s for reset")
+    time.sleep(wait)
+    self.rate_limit_remaining = None
+
+  def __sleep_backoff(self, attempt):
+    # exponential backoff + full jitter
+    delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+    time.sleep(random.uniform(0, delay))
+
+class IssueBodyCache:
+  # issue 本文を ETag と一緒に保存し、If-None-Match で条件付きリクエストを送るためのキャッシュ
+  # cache_dir が None の場合はメモリ上にだけ保持する
+  def __init__(self, cache_dir=None):
+    self.cache_dir = cache_dir
+    self.entries = {}
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, repo_name, issue_number):
+    key = (repo_name, str(issue_number))
+    if key in self.entries:
+      return self.entries[key]
+    if self.cache_dir is None:
+      return None
+
+    try:
+      with open(self.__get_path(repo_name, issue_number), "r", encoding="utf-8") as f:
+        data = json.load(f)
+    except FileNotFoundError:
+      return None
+    except (OSError, ValueError) as e:
+      logging.warning(f"Failed to read issue body cache: {e}")
+      return None
+
+    if not isinstance(data.get("etag"), str) or not isinstance(data.get("body"), str):
+      return None
+    self.entries[key] = (data["etag"], data["body"])
+    return self.entries[key]
+
+  def put(self, repo_name, issue_number, etag, body):
+    if not isinstance(etag, str) or not isinstance(body, str):
+      return
+    self.entries[(repo_name, str(issue_number))] = (etag, body)
+    if self.cache_dir is None:
+      return
+
+    # 同じホストで複数のプロセスが同時に書き込んでも壊れないように置き換える
+    try:
+      os.makedirs(self.cache_dir, exist_ok=True)
+      _atomic_write(self.__get_path(repo_name, issue_number), json.dumps({"etag": etag, "body": body}, ensure_ascii=False))
+    except OSError as e:
+      logging.warning(f"Failed to write issue body cache: {e}")
+
+  def __get_path(self, repo_name, issue_number):
+    name = _safe_filename(f"{repo_name}_{issue_number}")
+    return os.path.join(self.cache_dir, f"issue_{name}.json")
+
 class GitHubIssue:
   body = None
   storage_rows = None
+  computer_index = None
 
   row_regex = re.compile(r"(?P<markdown>.*) <!-- calculate-storage#(?P<computer_name>.+)#(?P<drive>.+) -->")
+  # 表の行以外の、キーで差し替える行 (scan: 容量の内訳、shard / host: シャードの目次)
+  marked_line_regex = re.compile(r"(?P<markdown>.*) <!-- calculate-storage-(?P<kind>scan|shard|host)#(?P<name>.+) -->")
+  marked_line_order = {"shard": 0, "host": 1, "scan": 2}
+  table_header = [
+    "| Status | Computer | Drive | Used | Size |",
+    "| :-: | :-: | :-: | :-: | :-: |",
+  ]
   # 1.9TB (HDD) というサイズ + ドライブの種類を取得するための正規表現
   size_regex = re.compile(r"^(?P<size>[0-9.]+ [TGMK]B) \((?P<drive_type>.+)\)$")
-
-  def __init__(self, repo_name, issue_number, github_token):
+  # 50.00 GB (50.0%) という使用量から使用率を取得するための正規表現
+  used_percent_regex = re.compile(r"\((?P<percent>[0-9.]+)%[,)]")
+  def __init__(self, repo_name, issue_number, github_token, client=None, cache=None, publish_threshold=None, body=None):
     self.repo_name = repo_name
     self.issue_number = issue_number
     self.github_token = github_token
+    self.client = client if client is not None else GitHubClient(github_token)
+    self.cache = cache if cache is not None else IssueBodyCache()
+    # 使用率がこのポイント数以上動くか、チェックマークが変わったときだけ行を書き換える (0 なら常に書き換える)
+    if publish_threshold is None:
+      publish_threshold = _get_env_float("CALCULATE_STORAGE_PUBLISH_THRESHOLD", 0.0)
+    self.publish_threshold = publish_threshold
+    self.update_attempts = _get_env_int("CALCULATE_STORAGE_UPDATE_ATTEMPTS", 5)
+    self.verify_delay = _get_env_float("CALCULATE_STORAGE_VERIFY_DELAY", 1.0)
+    self.conflict_backoff = 1.0
+    self.full_within_days = get_full_within_days()
+    self.fill_forecasts = {}
+    self.fill_rate_threshold = get_fill_rate_threshold()
+    self.fill_rates = {}
+    self.dirty_rows = set()
+    # insert_storage_row で追加した、まだ本文にない行と、remove_storage_row で消す行
+    self.new_rows = set()
+    self.removed_rows = set()
+    # (kind, name) -> 行。None は「あれば消す」
+    self.marked_lines = {}
+    self.dirty_marked_lines = set()
+    self.metrics = {
+      "attempts": 0,
+      "conflicts": 0,
+      "retries": 0
+    }
+    # fetch / parse / render / write / verify の所要時間。run_once が実行ごとに取り出す
+    self.timer = PhaseTimer()
+
+    # body を渡した場合は取得しない (API に接続できないときに、キャッシュ済みの本文からドライブを読むため)
+    with self.timer.phase("fetch"):
+      self.body = body if body is not None else self.__get_issue_body()
+    with self.timer.phase("parse"):
+      self.set_storage_rows(self.__get_storage_rows())
 
-    self.body = self.__get_issue_body()
-    self.storage_rows = self.__get_storage_rows()
+  @property
+  def issue_path(self):
+    return f"/repos/{self.repo_name}/issues/{self.issue_number}"
+
+  def set_storage_rows(self, storage_rows):
+    # (computer_name, drive) をキーにした dict と、computer_name ごとのドライブ一覧を作る
+    # 同じキーの行が複数ある場合は、最初の行を採用する
+    self.storage_rows = {}
+    self.computer_index = {}
+    for storage_row in storage_rows:
+      if storage_row.key in self.storage_rows:
+        continue
+      self.storage_rows[storage_row.key] = storage_row
+      self.computer_index.setdefault(storage_row.computer_name, []).append(storage_row.drive)
+    # 読み込み直した行にない、書き込み待ちのキーは捨てる (消す行は、残っていれば次の書き込みで消す)
+    self.new_rows &= self.storage_rows.keys()
+    self.dirty_rows &= self.storage_rows.keys()
 
   def update_storage_row(self, computer_name, drive, usage):
     # self.storage_rows から computer_name と drive が一致する行を取得する
@@ -109,78 +631,336 @@ class GitHubIssue:
     used_percent = usage.percent
     total_size = self.get_human_readable_size(usage.total)
 
-    checkmark = "🔴" if used_percent > 90 else "✅"
+    days_to_full = self.fill_forecasts.get((computer_name, drive))
+    checkmark = "🔴" if is_storage_red(used_percent, days_to_full, self.full_within_days) else "✅"
+    forecast_label = format_days_to_full(days_to_full)
+    used_suffix = f", full in {forecast_label}" if forecast_label is not None else ""
+    fill_rate_label = format_fill_rate(*self.fill_rates.get((computer_name, drive), (None, None)), self.fill_rate_threshold)
+    if fill_rate_label is not None:
+      used_suffix += f", {fill_rate_label}"
 
-    logging.info(f"{checkmark} {drive}: {used_size} / {total_size} ({used_percent}%)")
+    logging.info(f"{checkmark} {drive}: {used_size} / {total_size} ({used_percent}%{used_suffix})")
 
-    for storage_row in self.storage_rows:
-      if storage_row["computer_name"] == computer_name and storage_row["drive"] == drive:
-        storage_row["markdown"]["checkmark"] = checkmark
-        storage_row["markdown"]["used"] = f"{used_size} ({used_percent}%)"
-        storage_row["markdown"]["size"] = total_size
-        storage_row["markdown"]["raw"] = f"| {storage_row['markdown']['checkmark']} | {storage_row['markdown']['computer_name']} | {storage_row['markdown']['drive']} | {storage_row['markdown']['used']} | {storage_row['markdown']['size']} ({storage_row['markdown']['drive_type']}) |"
+    storage_row = self.storage_rows.get((computer_name, drive))
+    if storage_row is None:
+      return False
 
+    if self.publish_threshold > 0 and storage_row.checkmark == checkmark and storage_row.size == total_size:
+      m = self.used_percent_regex.search(storage_row.used)
+      if m is not None and abs(float(m.group("percent")) - used_percent) < self.publish_threshold:
+        logging.debug(f"{drive}: usage moved less than {self.publish_threshold} points, keep current row")
         return True
 
-    return False
+    storage_row.checkmark = checkmark
+    storage_row.used = f"{used_size} ({used_percent}%{used_suffix})"
+    storage_row.size = total_size
+    storage_row.raw = storage_row.render()
+    self.dirty_rows.add(storage_row.key)
+
+    return True
+
+  def add_storage_row(self, computer_name, drive, drive_type):
+    # 自動検出したドライブの行を追加する
+    # 値は直後の update_storage_row で埋まる。到達できなかった場合でも読み込み直せる形にしておく
+    storage_row = StorageRow(computer_name, drive, "⏳", computer_name, drive, "-", "0.00 KB", drive_type, "")
+    storage_row.raw = storage_row.render()
+    return self.insert_storage_row(storage_row)
+
+  def insert_storage_row(self, storage_row):
+    # 次の update_issue_body で、同じホストの最後の行の後ろ (なければ表の最後) に挿入する
+    key = storage_row.key
+    if key in self.storage_rows:
+      return False
+    self.storage_rows[key] = storage_row
+    self.computer_index.setdefault(storage_row.computer_name, []).append(storage_row.drive)
+    self.removed_rows.discard(key)
+    self.new_rows.add(key)
+    self.dirty_rows.add(key)
+    return True
+
+  def remove_storage_row(self, computer_name, drive):
+    # 次の update_issue_body で本文から消す (シャードの移動用)
+    key = (computer_name, drive)
+    if self.storage_rows.pop(key, None) is None:
+      return False
+    self.computer_index[computer_name].remove(drive)
+    if len(self.computer_index[computer_name]) == 0:
+      del self.computer_index[computer_name]
+    self.new_rows.discard(key)
+    self.dirty_rows.discard(key)
+    self.removed_rows.add(key)
+    return True
+
+  def set_marked_line(self, kind, name, markdown):
+    # <!-- calculate-storage-{kind}#{name} --> の付いた行を差し替える (None なら消す)
+    line = None
+    if markdown is not None:
+      line = f"{markdown} <!-- calculate-storage-{kind}#{name} -->"
+    self.marked_lines[(kind, name)] = line
+    self.dirty_marked_lines.add((kind, name))
+
+  def get_marked_lines(self, kind):
+    # 本文にある kind の行を {name: markdown} で返す
+    marked_lines = {}
+    for line in self.body.split("\n"):
+      m = self.marked_line_regex.match(line)
+      if m is not None and m.group("kind") == kind and m.group("name") not in marked_lines:
+        marked_lines[m.group("name")] = m.group("markdown")
+    return marked_lines
+
+  def set_fill_forecast(self, computer_name, drive, days_to_full):
+    # 次の update_storage_row で、満杯までの予測日数を表示・判定に使う
+    if days_to_full is None:
+      self.fill_forecasts.pop((computer_name, drive), None)
+    else:
+      self.fill_forecasts[(computer_name, drive)] = days_to_full
+
+  def set_fill_rate(self, computer_name, drive, peak_fill_rate, write_throughput=None):
+    # 次の update_storage_row で、前回からの最大の増加速度と書き込み速度を表示する (しきい値未満なら表示しない)
+    if peak_fill_rate is None:
+      self.fill_rates.pop((computer_name, drive), None)
+    else:
+      self.fill_rates[(computer_name, drive)] = (peak_fill_rate, write_throughput)
+
+  def set_directory_usage(self, computer_name, drive, directory_usage):
+    # 表の後ろに、ドライブの容量の内訳を折りたたみで表示する (None なら消す)
+    markdown = None
+    if directory_usage is not None:
+      markdown = render_directory_usage(computer_name, drive, directory_usage)
+    self.set_marked_line("scan", f"{computer_name}#{drive}", markdown)
+
+  def mark_storage_row_unreachable(self, computer_name, drive):
+    logging.warning(f"⚠️ {drive}: unreachable")
+
+    storage_row = self.storage_rows.get((computer_name, drive))
+    if storage_row is None:
+      return False
+
+    storage_row.checkmark = "⚠️"
+    storage_row.used = "unreachable"
+    storage_row.raw = storage_row.render()
+    self.dirty_rows.add(storage_row.key)
+
+    return True
 
   def get_computer_drives(self, computer_name):
-    computer_drives = []
-    for storage_row in self.storage_rows:
-      if storage_row["computer_name"] == computer_name:
-        computer_drives.append(storage_row["drive"])
-    return computer_drives
+    return list(self.computer_index.get(computer_name, []))
 
   def update_issue_body(self):
-    # 最新のissue bodyを取得して、同時実行時の競合を防ぐ
-    # storage_rowsは既にupdate_storage_rowで更新済みなので再取得しない
-    self.body = self.__get_issue_body()
-    
-    # self.storage_rows の内容を元に、issue の本文を更新する
-    # <!-- calculate-storage#computer_name#drive --> というコメントを探して、その行を更新する
-    rows = self.body.split("\n")
+    # 取得 → このインスタンスが更新した行だけを差し込む → PATCH → 再取得して確認、を繰り返す
+    # 他ホストの行は常に最新の本文のものを使うので、古い内容で上書きしない
+    # PATCH の直前に他ホストが書き込んだ場合は、確認時に自分の行が消えているので再試行する
+    fetched_body = None
+    for attempt in range(1, self.update_attempts + 1):
+      self.metrics["attempts"] += 1
+      if fetched_body is None:
+        with self.timer.phase("fetch"):
+          fetched_body = self.__get_issue_body()
+      with self.timer.phase("render"):
+        self.body, expected_lines = self.__splice_storage_rows(fetched_body)
+
+      # 表示上の変化がなければ書き込まない
+      if self.body == fetched_body:
+        logging.info("Issue body is unchanged, skip update")
+        self.dirty_rows.clear()
+        self.new_rows.clear()
+        self.removed_rows.clear()
+        self.dirty_marked_lines.clear()
+        return True
+
+      with self.timer.phase("write"):
+        try:
+          # クライアントには再送させない。待っている間に他ホストが書き込んで確認まで済ませると、
+          # 再送した古い本文でその行を戻してしまうので、取り直して差し込み直す
+          response = self.client.patch(
+            self.issue_path,
+            json={
+              "body": self.body
+            },
+            retry=False
+          )
+        except GitHubTransientError as e:
+          response = None
+          retry_wait = e.wait
+          logging.warning(f"Failed to update issue body: {e}, retrying ({attempt}/{self.update_attempts})")
+
+      if response is not None:
+        if response.status_code != 200:
+          raise Exception(f"Failed to update issue body: {response.text}")
+
+        self.cache.put(self.repo_name, self.issue_number, response.headers.get("ETag"), self.body)
+
+        with self.timer.phase("verify"):
+          verified, fetched_body = self.__verify_storage_rows(expected_lines)
+        if verified:
+          self.dirty_rows.clear()
+          self.new_rows.clear()
+          self.removed_rows.clear()
+          self.dirty_marked_lines.clear()
+          return True
+
+        self.metrics["conflicts"] += 1
+        retry_wait = None
+        logging.warning(f"Issue body was overwritten by a concurrent update, retrying ({attempt}/{self.update_attempts})")
+
+      if attempt < self.update_attempts:
+        self.metrics["retries"] += 1
+        if retry_wait is None:
+          retry_wait = random.uniform(0, min(30.0, self.conflict_backoff * (2 ** (attempt - 1))))
+        time.sleep(retry_wait)
+        # 待っている間に他ホストが書き込んでいるかもしれないので、確認時の本文は使わずに取り直す
+        # (変わっていなければ 304 で済む)
+        fetched_body = None
+
+    raise Exception(f"Failed to update issue body: rows were not written after {self.update_attempts} attempts (concurrent updates or transient errors)")
+
+  def log_update_metrics(self):
+    attempts = self.metrics["attempts"]
+    conflict_rate = self.metrics["conflicts"] / attempts if attempts > 0 else 0.0
+    logging.info(f"Issue update: {attempts} attempts, {self.metrics['conflicts']} conflicts ({conflict_rate:.0%}), {self.metrics['retries']} retries")
+
+  def __splice_storage_rows(self, body):
+    # <!-- calculate-storage#computer_name#drive --> というコメントを探して、更新した行だけを書き換える
+    # それ以外の行 (他ホストの行、取得後に追加された行など) はそのまま残す
+    # キーの付いた行 (<!-- calculate-storage-scan#... --> など) も同じように差し替え、なければ末尾に追加する
     new_rows = []
-    for row in rows:
+    expected_lines = {}
+    # 追加する行の挿入位置 (同じホストの最後の行、なければ表の最後の行)
+    last_row_index = None
+    last_row_index_by_computer = {}
+    last_table_index = None
+    last_marked_index_by_kind = {}
+    for row in body.split("\n"):
+      m = self.marked_line_regex.match(row)
+      if m is not None:
+        key = (m.group("kind"), m.group("name"))
+        # 表の行のキー (2 要素) と重ならないように、expected_lines では 3 要素にする
+        if key not in self.dirty_marked_lines or ("marked",) + key in expected_lines:
+          line = row
+        else:
+          line = self.marked_lines[key]
+          expected_lines[("marked",) + key] = line
+        if line is not None:
+          last_marked_index_by_kind[key[0]] = len(new_rows)
+          new_rows.append(line)
+        continue
+
       m = self.row_regex.match(row)
       if m is None:
+        if row.startswith("|"):
+          last_table_index = len(new_rows)
         new_rows.append(row)
         continue
 
-      computer_name = m.group("computer_name")
-      drive = m.group("drive")
-      for storage_row in self.storage_rows:
-        if storage_row["computer_name"] == computer_name and storage_row["drive"] == drive:
-          new_rows.append(storage_row["markdown"]["raw"] + f" <!-- calculate-storage#{computer_name}#{drive} -->")
-          break
+      key = (m.group("computer_name"), m.group("drive"))
+      if key in self.removed_rows:
+        expected_lines[key] = None
+        continue
+      last_row_index = len(new_rows)
+      last_row_index_by_computer[key[0]] = len(new_rows)
+      storage_row = self.storage_rows.get(key)
+      if key not in self.dirty_rows or storage_row is None:
+        new_rows.append(row)
+        continue
+      line = storage_row.render_line()
+      expected_lines[key] = line
+      new_rows.append(line)
 
-    self.body = "\n".join(new_rows)
+    for key in self.removed_rows:
+      expected_lines.setdefault(key, None)
 
-    response = requests.patch(
-      f"https://api.github.com/repos/{self.repo_name}/issues/{self.issue_number}",
-      headers={
-        "Authorization" : f"token {self.github_token}"
-      },
-      json={
-        "body": self.body
-      }
-    )
+    inserts = {}
+    for key in sorted(self.new_rows):
+      storage_row = self.storage_rows.get(key)
+      if key in expected_lines or storage_row is None:
+        continue
+      index = last_row_index_by_computer.get(key[0], last_row_index)
+      if index is None:
+        index = last_table_index
+      if index is None:
+        # 表がなければ、見出しごと末尾に追加する
+        if new_rows == [""]:
+          new_rows.clear()
+        elif len(new_rows) > 0 and new_rows[-1] != "":
+          new_rows.append("")
+        new_rows.extend(self.table_header)
+        index = last_table_index = len(new_rows) - 1
+      line = storage_row.render_line()
+      expected_lines[key] = line
+      inserts.setdefault(index, []).append(line)
+    # キーの付いた行は、同じ種類の最後の行の後ろ (なければ末尾) に追加する
+    missing = []
+    for key in sorted(self.dirty_marked_lines, key=lambda key: (self.marked_line_order[key[0]], key[1])):
+      if ("marked",) + key in expected_lines:
+        continue
+      line = self.marked_lines[key]
+      expected_lines[("marked",) + key] = line
+      if line is None:
+        continue
+      if key[0] in last_marked_index_by_kind:
+        inserts.setdefault(last_marked_index_by_kind[key[0]], []).append(line)
+      else:
+        missing.append(line)
 
-    if response.status_code != 200:
-      raise Exception(f"Failed to update issue body: {response.text}")
+    for index in sorted(inserts, reverse=True):
+      new_rows[index + 1:index + 1] = inserts[index]
 
-    return True
+    if len(missing) > 0:
+      trailing = []
+      while len(new_rows) > 0 and new_rows[-1] == "":
+        trailing.append(new_rows.pop())
+      # 表の続きとして解釈されないように空行を挟む
+      if len(new_rows) > 0 and self.marked_line_regex.match(new_rows[-1]) is None:
+        new_rows.append("")
+      new_rows.extend(missing)
+      new_rows.extend(trailing)
+
+    return "\n".join(new_rows), expected_lines
+
+  def __verify_storage_rows(self, expected_lines):
+    # 書き込んだ行が残っているかを再取得して確認する
+    # 少し待つことで、直前に GET した他ホストの PATCH が先に反映されるのを待つ
+    if self.verify_delay > 0:
+      time.sleep(random.uniform(self.verify_delay / 2, self.verify_delay))
+    body = self.__get_issue_body()
+
+    found_lines = {}
+    for row in body.split("\n"):
+      m = self.marked_line_regex.match(row)
+      if m is not None:
+        key = ("marked", m.group("kind"), m.group("name"))
+      else:
+        m = self.row_regex.match(row)
+        if m is None:
+          continue
+        key = (m.group("computer_name"), m.group("drive"))
+      if key in expected_lines and key not in found_lines:
+        found_lines[key] = row
+
+    # None は「その行が消えていること」を期待している
+    return all(found_lines.get(key) == line for key, line in expected_lines.items()), body
 
   def __get_issue_body(self):
-    url = f"https://api.github.com/repos/{self.repo_name}/issues/{self.issue_number}"
-    headers = {
-      "Authorization": f"token {self.github_token}"
-    }
+    # 前回取得時の ETag があれば If-None-Match を付けて、変更がなければ 304 (本文なし) を受け取る
+    cached = self.cache.get(self.repo_name, self.issue_number)
+    headers = None
+    if cached is not None:
+      headers = {
+        "If-None-Match": cached[0]
+      }
 
-    response = requests.get(url, headers=headers)
+    response = self.client.get(self.issue_path, headers=headers)
+    if response.status_code == 304 and cached is not None:
+      self.cache.hits += 1
+      logging.debug(f"Issue body not modified (ETag: {cached[0]})")
+      return cached[1]
     if response.status_code != 200:
       raise Exception(f"Failed to get issue body: {response.text}")
 
-    return response.json()["body"]
+    self.cache.misses += 1
+    body = response.json()["body"]
+    self.cache.put(self.repo_name, self.issue_number, response.headers.get("ETag"), body)
+    return body
 
   def __get_storage_rows(self):
     storage_rows = []
@@ -207,29 +987,470 @@ class GitHubIssue:
       size = match_size.group("size")
       drive_type = match_size.group("drive_type")
 
-      storage_rows.append({
-        "markdown": {
-          "checkmark": checkmark,
-          "computer_name": view_computer_name,
-          "drive": drive,
-          "used": used,
-          "size": size,
-          "drive_type": drive_type,
-          "raw": markdown
-        },
-        "computer_name": m.group("computer_name"),
-        "drive": m.group("drive")
-      })
+      storage_rows.append(StorageRow(
+        m.group("computer_name"),
+        m.group("drive"),
+        checkmark,
+        view_computer_name,
+        drive,
+        used,
+        size,
+        drive_type,
+        markdown
+      ))
 
     return storage_rows
 
   def get_human_readable_size(self, size):
-    units = ['B', 'KB', 'MB', 'GB', 'TB']
-    unit = 0
-    while size >= 1024:
-      size /= 1024
-      unit += 1
-    return f'{size:.2f} {units[unit]}'
+    return get_human_readable_size(size)
+
+  def refresh(self):
+    # 本文を取り直して行を読み込み直す (長時間動かす場合に、手で追加された行を拾うため)
+    with self.timer.phase("fetch"):
+      self.body = self.__get_issue_body()
+    with self.timer.phase("parse"):
+      self.set_storage_rows(self.__get_storage_rows())
+
+def get_human_readable_size(size):
+  units = ['B', 'KB', 'MB', 'GB', 'TB']
+  unit = 0
+  while size >= 1024:
+    size /= 1024
+    unit += 1
+  return f'{size:.2f} {units[unit]}'
+
+# 容量を持たない疑似ファイルシステム (コンテナの overlay や snap の squashfs も含む)
+PSEUDO_FILESYSTEM_TYPES = frozenset((
+  "autofs", "binfmt_misc", "bpf", "cgroup", "cgroup2", "configfs", "debugfs", "devpts", "devtmpfs",
+  "efivarfs", "fuse.gvfsd-fuse", "fuse.lxcfs", "fuse.portal", "fusectl", "hugetlbfs", "mqueue", "nfsd",
+  "nsfs", "overlay", "proc", "pstore", "ramfs", "rpc_pipefs", "securityfs", "selinuxfs", "squashfs",
+  "sysfs", "tmpfs", "tracefs",
+))
+
+# 応答しないと stat で止まるので、デバイス名だけでまとめるファイルシステム
+NETWORK_FILESYSTEM_TYPES = frozenset((
+  "9p", "ceph", "cifs", "fuse.glusterfs", "fuse.sshfs", "glusterfs", "nfs", "nfs4", "smb3", "smbfs",
+))
+
+# 自動検出したマウント。aliases は同じファイルシステムの別のマウントポイント
+DiscoveredMount = namedtuple("DiscoveredMount", "mountpoint device fstype aliases")
+
+# daemon モードでは、マウントの一覧が変わらない限り前回の結果を使う
+_discovered_mounts = {}
+
+def group_mounts(partitions):
+  # (device, mountpoint, fstype) の一覧を、同じデバイス (bind mount や二重マウント) か
+  # 同じファイルシステム (st_dev) ごとにまとめ、一番短いマウントポイントを代表にする
+  parents = list(range(len(partitions)))
+
+  def find(index):
+    while parents[index] != index:
+      parents[index] = parents[parents[index]]
+      index = parents[index]
+    return index
+
+  owners = {}
+  for index, (device, mountpoint, fstype) in enumerate(partitions):
+    keys = [("device", device)]
+    if fstype not in NETWORK_FILESYSTEM_TYPES:
+      try:
+        keys.append(("st_dev", os.stat(mountpoint).st_dev))
+      except OSError:
+        pass
+    for key in keys:
+      if key in owners:
+        parents[find(index)] = find(owners[key])
+      else:
+        owners[key] = index
+
+  groups = {}
+  for index in range(len(partitions)):
+    groups.setdefault(find(index), []).append(partitions[index])
+
+  mounts = []
+  for members in groups.values():
+    members.sort(key=lambda partition: (len(partition[1]), partition[1]))
+    device, mountpoint, fstype = members[0]
+    mounts.append(DiscoveredMount(mountpoint, device, fstype, [member[1] for member in members[1:]]))
+  mounts.sort(key=lambda mount: mount.mountpoint)
+  return mounts
+
+def discover_mounts(cache_dir=None):
+  # psutil.disk_partitions(all=True) から疑似ファイルシステムを除いたマウントを返す
+  # (all=False では NFS などのネットワークファイルシステムも除かれてしまう)
+  # まとめた結果はマウントの一覧のハッシュをキーにキャッシュし、変わっていなければ stat し直さない
+  import psutil
+
+  ignored = set(PSEUDO_FILESYSTEM_TYPES)
+  ignored.update(fstype for fstype in os.environ.get("CALCULATE_STORAGE_DISCOVER_IGNORE_FSTYPES", "").split(",") if fstype != "")
+  partitions = []
+  for partition in psutil.disk_partitions(all=True):
+    if partition.fstype == "" or partition.fstype in ignored or "cdrom" in partition.opts.split(","):
+      continue
+    mountpoint = partition.mountpoint
+    if os.name == "nt":
+      mountpoint = mountpoint.rstrip("\\")
+    partitions.append((partition.device, mountpoint, partition.fstype))
+
+  fingerprint = hashlib.sha256(json.dumps(partitions).encode("utf-8")).hexdigest()
+  if fingerprint in _discovered_mounts:
+    return _discovered_mounts[fingerprint]
+
+  cache_path = os.path.join(cache_dir, "mounts.json") if cache_dir is not None else None
+  mounts = None
+  if cache_path is not None:
+    try:
+      with open(cache_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+      if data.get("fingerprint") == fingerprint:
+        mounts = [DiscoveredMount(*mount) for mount in data["mounts"]]
+    except FileNotFoundError:
+      pass
+    except (OSError, ValueError, KeyError, TypeError) as e:
+      logging.warning(f"Failed to read mount cache: {e}")
+
+  if mounts is None:
+    mounts = group_mounts(partitions)
+    if cache_path is not None:
+      try:
+        os.makedirs(cache_dir, exist_ok=True)
+        _atomic_write(cache_path, json.dumps({"fingerprint": fingerprint, "mounts": mounts}, ensure_ascii=False))
+      except OSError as e:
+        logging.warning(f"Failed to write mount cache: {e}")
+
+  _discovered_mounts.clear()
+  _discovered_mounts[fingerprint] = mounts
+  return mounts
+
+def plan_discovered_drives(github_issue, hostname, mounts):
+  # 同じファイルシステムは 1 回だけ測るように、(測るドライブ, 代表のドライブ -> 同じ値を書く別の行) を返す
+  # issue にないファイルシステムは行を追加する。issue にあって検出されなかったドライブもそのまま測る
+  listed = github_issue.get_computer_drives(hostname)
+  listed_set = set(listed)
+  representatives = {}
+  aliases = {}
+  added = []
+  for mount in mounts:
+    members = [mount.mountpoint] + list(mount.aliases)
+    in_issue = [member for member in listed if member in members]
+    for member in members:
+      representatives[member] = None
+    if len(in_issue) == 0:
+      if github_issue.add_storage_row(hostname, mount.mountpoint, mount.fstype):
+        logging.info(f"Discovered new mount {mount.mountpoint} ({mount.device}, {mount.fstype})")
+        added.append(mount.mountpoint)
+      continue
+    representatives[in_issue[0]] = in_issue[0]
+    if len(in_issue) > 1:
+      aliases[in_issue[0]] = in_issue[1:]
+      logging.info(f"{', '.join(in_issue[1:])} share a filesystem with {in_issue[0]}, probing once")
+
+  drives = [drive for drive in listed if representatives.get(drive, drive) == drive]
+  return drives + added, aliases
+
+def copy_probe(probe, drive):
+  alias = DriveProbe(drive)
+  alias.status = probe.status
+  alias.usage = probe.usage
+  alias.error = probe.error
+  alias.elapsed = probe.elapsed
+  return alias
+
+class DriveProbe:
+  __slots__ = ("drive", "status", "usage", "error", "elapsed")
+
+  def __init__(self, drive):
+    self.drive = drive
+    self.status = None
+    self.usage = None
+    self.error = None
+    self.elapsed = None
+
+def probe_drives(drives, drive_timeout=None, total_timeout=None, max_workers=None):
+  # ハングしたマウント (NFS/CIFS など) で全体が止まらないように、
+  # daemon スレッドで並列に disk_usage を取得し、ドライブ単位と全体の期限を設ける
+  # 期限切れのスレッドは止められないので放置し、代わりのワーカーを起動する
+  if drive_timeout is None:
+    drive_timeout = _get_env_float("CALCULATE_STORAGE_PROBE_TIMEOUT", 10.0)
+  if total_timeout is None:
+    total_timeout = _get_env_float("CALCULATE_STORAGE_PROBE_TOTAL_TIMEOUT", 30.0)
+  if max_workers is None:
+    max_workers = _get_env_int("CALCULATE_STORAGE_PROBE_WORKERS", 8)
+
+  probes = [DriveProbe(drive) for drive in drives]
+  if len(probes) == 0:
+    return probes
+
+  pending = queue.Queue()
+  for probe in probes:
+    pending.put(probe)
+  started = {}
+  condition = threading.Condition()
+
+  import psutil
+
+  def worker():
+    while True:
+      try:
+        probe = pending.get_nowait()
+      except queue.Empty:
+        return
+      start = time.monotonic()
+      with condition:
+        started[id(probe)] = start
+        condition.notify_all()
+      try:
+        usage = psutil.disk_usage(probe.drive)
+        error = None
+      except OSError as e:
+        usage = None
+        error = e
+      with condition:
+        if probe.status is None:
+          probe.usage = usage
+          probe.error = error
+          probe.status = "ok" if error is None else "error"
+          probe.elapsed = time.monotonic() - start
+        condition.notify_all()
+      if probe.status == "unreachable":
+        # 期限切れ後に戻ってきたスレッドは、代わりのワーカーがいるので終了する
+        return
+
+  def start_worker():
+    thread = threading.Thread(target=worker, name="calculate-storage-probe", daemon=True)
+    thread.start()
+
+  for _ in range(min(max_workers, len(probes))):
+    start_worker()
+
+  deadline = time.monotonic() + total_timeout
+  with condition:
+    while True:
+      now = time.monotonic()
+      unfinished = [probe for probe in probes if probe.status is None]
+      if len(unfinished) == 0:
+        break
+
+      if now >= deadline:
+        for probe in unfinished:
+          probe.status = "unreachable"
+          probe.elapsed = now - started.get(id(probe), now)
+        break
+
+      wait_until = deadline
+      timed_out = False
+      for probe in unfinished:
+        probe_start = started.get(id(probe))
+        if probe_start is None:
+          continue
+        if now - probe_start >= drive_timeout:
+          probe.status = "unreachable"
+          probe.elapsed = now - probe_start
+          timed_out = True
+          if not pending.empty():
+            start_worker()
+          continue
+        wait_until = min(wait_until, probe_start + drive_timeout)
+
+      if not timed_out:
+        condition.wait(max(wait_until - now, 0))
+
+  return probes
+
+def make_result(probe):
+  if probe.status == "unreachable":
+    return {
+      "drive": probe.drive,
+      "status": "unreachable",
+      "timestamp": time.time(),
+      "elapsed": probe.elapsed
+    }
+
+  usage = probe.usage
+  return {
+    "drive": probe.drive,
+    "status": "ok",
+    "timestamp": time.time(),
+    "used": usage.used,
+    "total": usage.total,
+    "percent": usage.percent,
+    "used_size": get_human_readable_size(usage.used),
+    "total_size": get_human_readable_size(usage.total),
+    "elapsed": probe.elapsed
+  }
+
+def log_probe(probe):
+  if probe.status == "error":
+    logging.error(f"Failed to get disk usage for {probe.drive}: {probe.error}")
+  elif probe.status == "unreachable":
+    logging.error(f"Timed out getting disk usage for {probe.drive} after {probe.elapsed:.1f}s")
+
+# UsageSampler.collect が返す、前回の collect 以降のドライブごとのまとめ
+# peak_fill_rate は隣り合うサンプル間の使用量の増加速度の最大値、write_throughput は書き込みの平均速度 (どちらもバイト/秒)
+# write_throughput はデバイスの I/O カウンタがわからなければ None
+SampleSummary = namedtuple("SampleSummary", "samples elapsed peak_fill_rate write_throughput")
+
+class SampleRing:
+  # (時刻, 使用量, 書き込みバイト数) を固定長の配列に上書きしながら保存するリングバッファ
+  # 配列は最初に確保するだけで、サンプルごとにオブジェクトを残さない
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.timestamps = array.array("d", bytes(8 * capacity))
+    self.used = array.array("q", bytes(8 * capacity))
+    # 書き込みバイト数の累計 (わからなければ -1)
+    self.written = array.array("q", bytes(8 * capacity))
+    # これまでに追加したサンプルの数 (n 番目のサンプルは n % capacity の位置にある)
+    self.count = 0
+
+  def append(self, timestamp, used, written):
+    index = self.count % self.capacity
+    self.timestamps[index] = timestamp
+    self.used[index] = used
+    self.written[index] = written
+    self.count += 1
+
+  def summarize(self, since):
+    # since 番目 (上書きされていれば、残っている一番古いもの) から最後までのサンプルをまとめる
+    first = max(since, self.count - self.capacity, 0)
+    last = self.count - 1
+    if last <= first:
+      return None
+    peak_fill_rate = 0.0
+    previous = first % self.capacity
+    for n in range(first + 1, last + 1):
+      index = n % self.capacity
+      elapsed = self.timestamps[index] - self.timestamps[previous]
+      if elapsed > 0:
+        peak_fill_rate = max(peak_fill_rate, (self.used[index] - self.used[previous]) / elapsed)
+      previous = index
+    first_index = first % self.capacity
+    last_index = last % self.capacity
+    elapsed = self.timestamps[last_index] - self.timestamps[first_index]
+    written = self.written[last_index] - self.written[first_index]
+    write_throughput = None
+    # カウンタがない・巻き戻った (再起動やデバイスの付け替え) 場合は出さない
+    if self.written[first_index] >= 0 and written >= 0 and elapsed > 0:
+      write_throughput = written / elapsed
+    return SampleSummary(last - first + 1, elapsed, peak_fill_rate, write_throughput)
+
+def get_io_devices(drives):
+  # ドライブ (マウントポイント) -> psutil.disk_io_counters(perdisk=True) のキー (sda1、dm-0 など)
+  # /dev/mapper/... のようなリンクは辿る。わからないドライブ (ネットワークファイルシステムや Windows) は None
+  import psutil
+
+  try:
+    partitions = psutil.disk_partitions(all=True)
+  except OSError as e:
+    logging.warning(f"Failed to list partitions for I/O counters: {e}")
+    partitions = []
+  devices_by_mountpoint = {}
+  for partition in partitions:
+    devices_by_mountpoint.setdefault(partition.mountpoint, partition.device)
+  devices = {}
+  for drive in drives:
+    device = devices_by_mountpoint.get(drive)
+    devices[drive] = os.path.basename(os.path.realpath(device)) if device is not None and device.startswith("/dev/") else None
+  return devices
+
+class UsageSampler:
+  # daemon モードで、実行の間隔より細かく disk_usage と disk_io_counters を取るスレッド
+  # 実行と実行の間に大量に書き込まれて埋まるドライブを、次の実行で増加速度として報告するために使う
+  # 1 回の取得にかかった CPU 時間が cpu_budget (1 コアに対する割合) を超えないように、間隔を広げる
+  def __init__(self, interval, capacity=None, cpu_budget=None):
+    self.interval = interval
+    if capacity is None:
+      capacity = _get_env_int("CALCULATE_STORAGE_SAMPLE_CAPACITY", 4096)
+    self.capacity = max(2, capacity)
+    if cpu_budget is None:
+      cpu_budget = _get_env_float("CALCULATE_STORAGE_SAMPLE_CPU_BUDGET", 0.01)
+    self.cpu_budget = cpu_budget
+    self.lock = threading.Lock()
+    self.rings = {}
+    # ドライブ -> 前回の collect で使った最後のサンプルの番号 (次の collect の起点)
+    self.marks = {}
+    # (ドライブ, リング, I/O カウンタのキー) の一覧。watch で丸ごと差し替える
+    self.targets = ()
+    self.stop_event = threading.Event()
+    self.thread = None
+    self.polls = 0
+    self.cpu_seconds = 0.0
+    self.last_collect = (time.monotonic(), 0, 0.0)
+
+  def watch(self, drives):
+    # 取得するドライブを入れ替える。新しいドライブは次のサンプルから取る
+    devices = get_io_devices(drives)
+    with self.lock:
+      for drive in drives:
+        if drive not in self.rings:
+          self.rings[drive] = SampleRing(self.capacity)
+          self.marks[drive] = 0
+      for drive in list(self.rings):
+        if drive not in devices:
+          del self.rings[drive]
+          del self.marks[drive]
+      self.targets = tuple((drive, self.rings[drive], devices[drive]) for drive in drives)
+    if self.thread is None:
+      self.thread = threading.Thread(target=self.__run, name="calculate-storage-sampler", daemon=True)
+      self.thread.start()
+
+  def poll(self):
+    # disk_usage がハングするとサンプルが止まるだけで、実行側の probe_drives には影響しない
+    import psutil
+
+    timestamp = time.monotonic()
+    try:
+      counters = psutil.disk_io_counters(perdisk=True) or {}
+    except (OSError, RuntimeError):
+      counters = {}
+    for drive, ring, device in self.targets:
+      try:
+        used = psutil.disk_usage(drive).used
+      except OSError:
+        continue
+      counter = counters.get(device) if device is not None else None
+      written = counter.write_bytes if counter is not None else -1
+      with self.lock:
+        ring.append(timestamp, used, written)
+
+  def collect(self):
+    # 前回の collect 以降のサンプルを {ドライブ: SampleSummary} にまとめる (サンプルが 2 つ未満のドライブは含めない)
+    summaries = {}
+    with self.lock:
+      for drive, ring in self.rings.items():
+        summary = ring.summarize(self.marks[drive])
+        self.marks[drive] = max(ring.count - 1, 0)
+        if summary is not None:
+          summaries[drive] = summary
+      now = time.monotonic()
+      last_time, last_polls, last_cpu_seconds = self.last_collect
+      polls = self.polls - last_polls
+      cpu_seconds = self.cpu_seconds - last_cpu_seconds
+      self.last_collect = (now, self.polls, self.cpu_seconds)
+    if polls > 0:
+      logging.info(f"Sampler: {polls} polls of {len(self.targets)} drives, {cpu_seconds * 1000:.1f}ms CPU ({cpu_seconds / max(now - last_time, 1e-9):.2%} of a core)")
+    return summaries
+
+  def close(self):
+    self.stop_event.set()
+    if self.thread is not None:
+      self.thread.join(timeout=5)
+
+  def __run(self):
+    while not self.stop_event.is_set():
+      start = time.monotonic()
+      cpu_start = time.thread_time()
+      try:
+        self.poll()
+      except Exception as e:
+        logging.warning(f"Sampler poll failed: {e}")
+      cost = time.thread_time() - cpu_start
+      with self.lock:
+        self.polls += 1
+        self.cpu_seconds += cost
+      delay = self.interval
+      if self.cpu_budget > 0:
+        delay = max(delay, cost / self.cpu_budget)
+      self.stop_event.wait(max(0.0, start + delay - time.monotonic()))
 
 def is_valid_issue_number(issue_number):
   if issue_number is None:
@@ -246,6 +1467,14 @@ def get_real_hostname():
   else:
     return os.uname()[1]
 
+def get_start_offset(hostname, window):
+  # ホスト名のハッシュから 0 〜 window 秒の決まったオフセットを作り、
+  # 同じ cron の時刻に全ホストが一斉に API を叩かないようにする
+  if window <= 0:
+    return 0.0
+  digest = hashlib.sha256(hostname.encode("utf-8")).digest()
+  return int.from_bytes(digest[:8], "big") / 2 ** 64 * window
+
 def get_github_token():
   if not os.path.exists("data/github_token.txt"):
     raise Exception("Please create data/github_token.txt")
@@ -263,64 +1492,1976 @@ def save_results(hostname, results):
     logging.error(f"Failed to create results directory: {e}")
     raise
 
-  with open(path, "w", encoding="utf-8") as f:
+  # 同じ日の以前の実行結果を消さないように追記する
+  with open(path, "a", encoding="utf-8") as f:
     for result in results:
       f.write(json.dumps(result, ensure_ascii=False) + "\n")
 
-def main():
-  log_path = setup_logging()
-  logging.info(f"Logging to {log_path}")
+def _escape_prometheus_label(value):
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def render_prometheus_textfile(hostname, results, timings, now=None):
+  # node_exporter の textfile collector が読む形式 (ゲージのみ)
+  if now is None:
+    now = time.time()
+  host = _escape_prometheus_label(hostname)
+  metrics = {
+    "disk_used_bytes": ("Used bytes of the drive", []),
+    "disk_total_bytes": ("Total bytes of the drive", []),
+    "disk_used_percent": ("Used percent of the drive", []),
+    "disk_days_to_full": ("Forecast days until the drive is full (absent when not filling)", []),
+    "disk_peak_fill_rate_bytes_per_second": ("Peak growth of used bytes between samples since the last run", []),
+    "disk_write_bytes_per_second": ("Average bytes written to the device since the last run", []),
+    "disk_reachable": ("1 if the drive answered within the timeout", []),
+    "probe_duration_seconds": ("Time spent getting disk usage of the drive", []),
+    "phase_duration_seconds": ("Time spent in each phase of the last run", []),
+    "last_run_timestamp_seconds": ("Unix time of the last run", []),
+  }
+  for result in results:
+    labels = f'host="{host}",drive="{_escape_prometheus_label(result["drive"])}"'
+    reachable = result.get("status") == "ok"
+    metrics["disk_reachable"][1].append((labels, 1 if reachable else 0))
+    if result.get("elapsed") is not None:
+      metrics["probe_duration_seconds"][1].append((labels, result["elapsed"]))
+    if not reachable:
+      continue
+    metrics["disk_used_bytes"][1].append((labels, result["used"]))
+    metrics["disk_total_bytes"][1].append((labels, result["total"]))
+    metrics["disk_used_percent"][1].append((labels, result["percent"]))
+    if result.get("days_to_full") is not None:
+      metrics["disk_days_to_full"][1].append((labels, result["days_to_full"]))
+    if result.get("peak_fill_rate") is not None:
+      metrics["disk_peak_fill_rate_bytes_per_second"][1].append((labels, result["peak_fill_rate"]))
+    if result.get("write_throughput") is not None:
+      metrics["disk_write_bytes_per_second"][1].append((labels, result["write_throughput"]))
+  for name, seconds in sorted(timings.items()):
+    metrics["phase_duration_seconds"][1].append((f'host="{host}",phase="{_escape_prometheus_label(name)}"', seconds))
+  metrics["last_run_timestamp_seconds"][1].append((f'host="{host}"', now))
+
+  lines = []
+  for name, (help_text, samples) in metrics.items():
+    if len(samples) == 0:
+      continue
+    lines.append(f"# HELP calculate_storage_{name} {help_text}")
+    lines.append(f"# TYPE calculate_storage_{name} gauge")
+    for labels, value in samples:
+      lines.append(f"calculate_storage_{name}{{{labels}}} {float(value)!r}")
+  return "\n".join(lines) + "\n"
+
+def write_prometheus_textfile(path, hostname, results, timings):
+  # 読み込み途中のファイルを node_exporter に見せないよう、同じディレクトリに書いてから置き換える
+  directory = os.path.dirname(os.path.abspath(path))
+  os.makedirs(directory, exist_ok=True)
+  _atomic_write(path, render_prometheus_textfile(hostname, results, timings))
+
+def finish_run(hostname, results, timings):
+  # 所要時間をログと結果ファイルに残し、設定されていれば textfile を書く
+  # GitHub への反映に失敗しても呼ぶので、ここでは GitHub に依存しない
+  summary = ", ".join(f"{name}={seconds:.3f}s" for name, seconds in timings.items())
+  logging.info(f"Timings: {summary}")
+  try:
+    save_results(hostname, [{"status": "run", "timestamp": time.time(), "timings": timings}])
+  except OSError as e:
+    logging.error(f"Failed to save timings: {e}")
+
+  textfile_path = os.environ.get("CALCULATE_STORAGE_PROMETHEUS_TEXTFILE")
+  if textfile_path:
+    try:
+      write_prometheus_textfile(textfile_path, hostname, results, timings)
+    except OSError as e:
+      logging.error(f"Failed to write Prometheus textfile {textfile_path}: {e}")
+
+def format_days_to_full(days):
+  # 毎回 issue が書き換わらないように、粗い単位で表示する (1 年以上先は表示しない)
+  if days is None or days > 365:
+    return None
+  if days < 1:
+    return "<1d"
+  if days < 14:
+    return f"~{int(days)}d"
+  if days < 60:
+    return f"~{int(days // 7)}w"
+  return f"~{int(days // 30)}mo"
+
+def format_fill_rate(peak_fill_rate, write_throughput, threshold):
+  # 増加速度が threshold (バイト/秒) 以上のときだけ表示する (普段は行が書き換わらないように)
+  if peak_fill_rate is None or threshold is None or peak_fill_rate < threshold:
+    return None
+  label = f"peak +{get_human_readable_size(peak_fill_rate * 60)}/min"
+  if write_throughput is not None:
+    label += f", writes {get_human_readable_size(write_throughput)}/s"
+  return label
+
+# results/ のレコードを型付きで扱うための 1 行分のデータ
+ResultRecord = namedtuple("ResultRecord", "hostname date drive status timestamp used total percent days_to_full")
+
+# results/ をドライブごとに集計した結果
+ResultSummary = namedtuple("ResultSummary", "count min_used max_used last_used last_total last_timestamp")
+
+RESULT_FILENAME_REGEX = re.compile(r"^(?P<hostname>.+)_(?P<date>[0-9]{8})\.txt$")
+
+def list_result_files(results_dir="results", hosts=None, since=None, until=None):
+  # {hostname}_{YYYYMMDD}.txt を日付 (同じ日ならホスト名) の順に返す
+  try:
+    filenames = os.listdir(results_dir)
+  except FileNotFoundError:
+    return []
+
+  files = []
+  for filename in filenames:
+    m = RESULT_FILENAME_REGEX.match(filename)
+    if m is None:
+      continue
+    try:
+      date = datetime.datetime.strptime(m.group("date"), "%Y%m%d").date()
+    except ValueError:
+      continue
+    hostname = m.group("hostname")
+    if hosts is not None and hostname not in hosts:
+      continue
+    if (since is not None and date < since) or (until is not None and date > until):
+      continue
+    files.append((date, hostname, os.path.join(results_dir, filename)))
+  files.sort()
+  return files
+
+def _iter_result_file(path, hostname, date):
+  # 壊れた行や、必要なキーがない行 (実行ごとの timings のレコードなど) は読み飛ばす
+  # timestamp がない古いレコードは、ファイルの日付の 0 時として扱う
+  file_timestamp = datetime.datetime.combine(date, datetime.time()).timestamp()
+  with open(path, "r", encoding="utf-8") as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+        drive = record["drive"]
+      except (ValueError, TypeError, KeyError):
+        continue
+      yield ResultRecord(
+        hostname,
+        date,
+        drive,
+        record.get("status", "ok"),
+        record.get("timestamp", file_timestamp),
+        record.get("used"),
+        record.get("total"),
+        record.get("percent"),
+        record.get("days_to_full")
+      )
+
+def _read_result_file(path, hostname, date):
+  # 別プロセスから返すときは、pickle が軽いただの tuple にする
+  return [tuple(record) for record in _iter_result_file(path, hostname, date)]
+
+def _summarize_result_file(path, hostname, date):
+  return summarize_results(_iter_result_file(path, hostname, date))
+
+def _map_result_files(func, files, workers):
+  # ファイルごとに func を別プロセスで実行し、結果をファイルの順に返す
+  # 先読みは workers * 2 ファイルまでなので、メモリは履歴の量によらない
+  import concurrent.futures
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+    files = iter(files)
+    pending = deque()
+    for date, hostname, path in itertools.islice(files, workers * 2):
+      pending.append(executor.submit(func, path, hostname, date))
+    while len(pending) > 0:
+      future = pending.popleft()
+      for date, hostname, path in itertools.islice(files, 1):
+        pending.append(executor.submit(func, path, hostname, date))
+      yield future.result()
+
+def iter_results(results_dir="results", hosts=None, since=None, until=None, workers=1):
+  # results/ のレコードをファイルの日付順に 1 件ずつ返す
+  # workers > 1 ならファイル単位で別プロセスにデコードさせる
+  files = list_result_files(results_dir, hosts, since, until)
+  if workers <= 1 or len(files) <= 1:
+    for date, hostname, path in files:
+      yield from _iter_result_file(path, hostname, date)
+    return
+
+  for records in _map_result_files(_read_result_file, files, workers):
+    for record in records:
+      yield ResultRecord._make(record)
+
+def summarize_results(records):
+  # ドライブごとの最小 / 最大 / 最後の使用量を、レコードを溜めずに集計する
+  summaries = {}
+  for record in records:
+    if record.status != "ok" or record.used is None:
+      continue
+    key = (record.hostname, record.drive)
+    summary = summaries.get(key)
+    if summary is None:
+      summaries[key] = ResultSummary(1, record.used, record.used, record.used, record.total, record.timestamp)
+    else:
+      summaries[key] = ResultSummary(
+        summary.count + 1,
+        min(summary.min_used, record.used),
+        max(summary.max_used, record.used),
+        record.used,
+        record.total,
+        record.timestamp
+      )
+  return summaries
+
+def merge_result_summaries(summaries, later):
+  # later は summaries より後のファイルを集計したもの
+  for key, summary in later.items():
+    earlier = summaries.get(key)
+    if earlier is None:
+      summaries[key] = summary
+      continue
+    summaries[key] = ResultSummary(
+      earlier.count + summary.count,
+      min(earlier.min_used, summary.min_used),
+      max(earlier.max_used, summary.max_used),
+      summary.last_used,
+      summary.last_total,
+      summary.last_timestamp
+    )
+  return summaries
+
+def summarize_result_files(results_dir="results", hosts=None, since=None, until=None, workers=1):
+  # workers > 1 なら、ファイルごとの集計を別プロセスで行ってから日付順にまとめる
+  # (レコードをプロセス間で受け渡すより速い)
+  files = list_result_files(results_dir, hosts, since, until)
+  if workers <= 1 or len(files) <= 1:
+    return summarize_results(iter_results(results_dir, hosts, since, until))
+
+  summaries = {}
+  for file_summaries in _map_result_files(_summarize_result_file, files, workers):
+    merge_result_summaries(summaries, file_summaries)
+  return summaries
+
+def load_usage_series(hostname, results_dir="results", days=30, now=None):
+  # 直近 days 日分の (timestamp, used, total) をドライブごとに読む
+  if now is None:
+    now = time.time()
+  since = now - days * 86400
+  since_date = datetime.datetime.fromtimestamp(since).date()
+  series = {}
+  for record in iter_results(results_dir, hosts=[hostname], since=since_date):
+    if record.status != "ok" or record.used is None or record.total is None or record.timestamp < since:
+      continue
+    series.setdefault(record.drive, []).append((record.timestamp, record.used, record.total))
+
+  for points in series.values():
+    points.sort()
+  return series
+
+def forecast_days_to_full(series):
+  # ドライブごとに使用量の増加率を最小二乗法で求め、最後の観測点から満杯までの日数を返す
+  # 増えていない、または点が足りないドライブは None
+  drives = [drive for drive, points in series.items() if len(points) >= 2]
+  forecasts = {drive: None for drive in series}
+  if len(drives) == 0:
+    return forecasts
+
+  for drive in drives:
+    points = series[drive]
+    count = len(points)
+    mean_t = sum(point[0] for point in points) / count
+    mean_used = sum(point[1] for point in points) / count
+    variance = sum((point[0] - mean_t) ** 2 for point in points)
+    if variance <= 0:
+      continue
+    slope = sum((point[0] - mean_t) * (point[1] - mean_used) for point in points) / variance
+    _, last_used, last_total = points[-1]
+    if slope > 0:
+      forecasts[drive] = max(0.0, last_total - last_used) / (slope * 86400)
+  return forecasts
+
+def forecast_probes(hostname, probes, now=None):
+  # 過去の結果に今回の測定値を加えて予測する
+  days = _get_env_float("CALCULATE_STORAGE_FORECAST_DAYS", 30.0)
+  if days <= 0:
+    return {}
+  if now is None:
+    now = time.time()
+  try:
+    series = load_usage_series(hostname, days=days, now=now)
+  except OSError as e:
+    logging.error(f"Failed to load results for forecasting: {e}")
+    return {}
+  for probe in probes:
+    if probe.status == "ok":
+      series.setdefault(probe.drive, []).append((now, probe.usage.used, probe.usage.total))
+  return forecast_days_to_full(series)
+
+def get_full_within_days():
+  # 「N 日以内に満杯になる」と予測されたドライブも 🔴 にする (None なら使用率だけで判定する)
+  full_within_days = _get_env_float("CALCULATE_STORAGE_FULL_WITHIN_DAYS", 0.0)
+  return full_within_days if full_within_days > 0 else None
+
+def get_fill_rate_threshold():
+  # issue の行に増加速度を表示するしきい値 (GB/分 で指定、バイト/秒 で返す。0 なら表示しない)
+  gb_per_minute = _get_env_float("CALCULATE_STORAGE_FILL_RATE_GB_PER_MIN", 1.0)
+  return gb_per_minute * 1024 ** 3 / 60 if gb_per_minute > 0 else None
+
+def is_storage_red(used_percent, days_to_full, full_within_days):
+  filling_soon = full_within_days is not None and days_to_full is not None and days_to_full <= full_within_days
+  return used_percent > 90 or filling_soon
+
+# scan_directory_usage の結果 (top_directories は (path, size) の大きい順のリスト)
+# cached_directories は DirectoryUsageCache から読み直さずに済んだディレクトリの数
+DirectoryUsage = namedtuple("DirectoryUsage", "root top_directories total_size files directories errors truncated elapsed cached_directories", defaults=(0,))
+
+# stat.FILE_ATTRIBUTE_REPARSE_POINT (ジャンクション、ボリュームのマウントポイント、シンボリックリンク)
+_FILE_ATTRIBUTE_REPARSE_POINT = 0x400
+
+def _get_allocated_size(stat_result):
+  # du と同じく実際に確保されているブロックで数える (st_blocks がない Windows ではファイルサイズ)
+  blocks = getattr(stat_result, "st_blocks", None)
+  if blocks is None:
+    return stat_result.st_size
+  return blocks * 512
+
+class DirectoryWatcher:
+  # Linux の inotify で、スキャンしたディレクトリの変更 (ファイルの書き換えを含む) を次のスキャンまで記録する
+  # daemon モードのようにプロセスが生き続ける場合だけ意味がある
+  IN_MODIFY = 0x2
+  IN_ATTRIB = 0x4
+  IN_CLOSE_WRITE = 0x8
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_DELETE_SELF = 0x400
+  IN_MOVE_SELF = 0x800
+  IN_Q_OVERFLOW = 0x4000
+  IN_IGNORED = 0x8000
+  IN_ONLYDIR = 0x01000000
+  WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+  event_struct = struct.Struct("iIII")
+
+  def __init__(self, max_watches=None):
+    if max_watches is None:
+      max_watches = _get_env_int("CALCULATE_STORAGE_SCAN_INOTIFY_MAX_WATCHES", 100000)
+    import ctypes
+    import ctypes.util
+    self.ctypes = ctypes
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, f"Failed to initialize inotify: {os.strerror(errno)}")
+    self.fd = fd
+    self.max_watches = max_watches
+    self.paths = {}
+    self.watches = {}
+
+  def is_watched(self, path):
+    return path in self.watches
+
+  def add(self, path):
+    if path in self.watches or len(self.watches) >= self.max_watches:
+      return False
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+    if wd < 0:
+      # ENOSPC (fs.inotify.max_user_watches) などは、監視しないディレクトリとして mtime だけで判定する
+      return False
+    self.paths[wd] = path
+    self.watches[path] = wd
+    return True
+
+  def read_changes(self):
+    # 変更があったディレクトリの集合を返す。イベントがあふれた場合は None (すべて変わったものとして扱う)
+    changed = set()
+    overflowed = False
+    while True:
+      try:
+        data = os.read(self.fd, 65536)
+      except BlockingIOError:
+        break
+      offset = 0
+      while offset + self.event_struct.size <= len(data):
+        wd, mask, _, length = self.event_struct.unpack_from(data, offset)
+        offset += self.event_struct.size + length
+        if mask & self.IN_Q_OVERFLOW:
+          overflowed = True
+          continue
+        path = self.paths.get(wd)
+        if path is None:
+          continue
+        changed.add(path)
+        if mask & (self.IN_IGNORED | self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+          # 消えた・移動したディレクトリの監視はやめる (移動先は次のスキャンで監視し直す)
+          if not mask & self.IN_IGNORED:
+            self.libc.inotify_rm_watch(self.fd, wd)
+          self.paths.pop(wd, None)
+          self.watches.pop(path, None)
+    return None if overflowed else changed
+
+  def close(self):
+    os.close(self.fd)
+
+class DirectoryUsageCache:
+  # scan_directory_usage の途中結果をディレクトリ単位で保存し、次のスキャンで変わっていないディレクトリを読み直さないためのキャッシュ
+  # (st_dev, st_ino, st_mtime_ns) が同じなら、直下のファイルの合計と子ディレクトリの一覧を再利用する
+  # ディレクトリの mtime はファイルの書き換えでは変わらないので、max_age 秒より古いエントリは読み直す
+  # watcher (DirectoryWatcher) で監視しているディレクトリは、変更がなければ max_age を過ぎても再利用する
+  # cache_dir が None の場合はメモリ上にだけ保持する
+  def __init__(self, cache_dir, drive, max_age=None, watcher=None):
+    if max_age is None:
+      max_age = _get_env_float("CALCULATE_STORAGE_SCAN_CACHE_MAX_AGE", 7 * 86400.0)
+    self.cache_dir = cache_dir
+    self.drive = drive
+    self.max_age = max_age
+    self.watcher = watcher
+    # path -> [st_dev, st_ino, st_mtime_ns, size, files, scanned_at, children]
+    self.entries = self.__load()
+    self.visited = {}
+    self.now = time.time()
+
+  def begin(self):
+    # スキャンの前に、前回のスキャン以降に変わったディレクトリを捨てる
+    self.visited = {}
+    self.now = time.time()
+    if self.watcher is None:
+      return
+    changed = self.watcher.read_changes()
+    if changed is None:
+      logging.warning(f"inotify queue overflowed for {self.drive}, rescanning everything")
+      self.entries = {}
+      return
+    for path in changed:
+      self.entries.pop(path, None)
+
+  def get(self, path, stat_key):
+    entry = self.entries.get(path)
+    if entry is None or tuple(entry[:3]) != stat_key:
+      return None
+    if self.now - entry[5] >= self.max_age and not (self.watcher is not None and self.watcher.is_watched(path)):
+      return None
+    self.visited[path] = entry
+    return entry
+
+  def put(self, path, stat_key, size, files, children):
+    self.visited[path] = [*stat_key, size, files, self.now, children]
+
+  def finish(self, truncated):
+    # 今回たどったディレクトリだけを残すことで、消えたディレクトリを捨てる
+    # 途中で打ち切った場合は、たどれなかったディレクトリの前回の結果も残す
+    if truncated:
+      self.entries.update(self.visited)
+    else:
+      self.entries = self.visited
+    self.visited = {}
+    if self.watcher is not None:
+      for path in self.entries:
+        if not self.watcher.add(path):
+          break
+    self.__save()
+
+  def __get_path(self):
+    name = _safe_filename(self.drive)
+    return os.path.join(self.cache_dir, f"scan_{name}.json")
+
+  def __load(self):
+    if self.cache_dir is None:
+      return {}
+    try:
+      with open(self.__get_path(), "r", encoding="utf-8") as f:
+        data = json.load(f)
+    except FileNotFoundError:
+      return {}
+    except (OSError, ValueError) as e:
+      logging.warning(f"Failed to read directory usage cache: {e}")
+      return {}
+    if data.get("drive") != self.drive or not isinstance(data.get("entries"), dict):
+      return {}
+    return data["entries"]
+
+  def __save(self):
+    if self.cache_dir is None:
+      return
+    try:
+      os.makedirs(self.cache_dir, exist_ok=True)
+      _atomic_write(self.__get_path(), json.dumps({"drive": self.drive, "entries": self.entries}, ensure_ascii=False, separators=(",", ":")))
+    except OSError as e:
+      logging.warning(f"Failed to write directory usage cache: {e}")
+
+def scan_directory_usage(root, top_n=None, depth=None, time_budget=None, max_entries=None, max_workers=None, cache=None):
+  # du のように、root から depth 階層までの各ディレクトリの合計サイズを並列に求める
+  # 別のファイルシステム (マウントポイントの先) には入らず、ハードリンクは (st_dev, st_ino) で 1 回だけ数える
+  # time_budget 秒か、max_entries 個のエントリを見たところで打ち切り、それまでの結果を truncated として返す
+  # cache (DirectoryUsageCache) があれば、変わっていないディレクトリは stat 1 回だけで済ませる
+  # (キャッシュから読んだディレクトリと読み直したディレクトリの間のハードリンクは重複して数えることがある)
+  if top_n is None:
+    top_n = _get_env_int("CALCULATE_STORAGE_SCAN_TOP", 10)
+  if depth is None:
+    depth = _get_env_int("CALCULATE_STORAGE_SCAN_DEPTH", 2)
+  if time_budget is None:
+    time_budget = _get_env_float("CALCULATE_STORAGE_SCAN_TIMEOUT", 60.0)
+  if max_entries is None:
+    max_entries = _get_env_int("CALCULATE_STORAGE_SCAN_MAX_ENTRIES", 1000000)
+  if max_workers is None:
+    max_workers = _get_env_int("CALCULATE_STORAGE_SCAN_WORKERS", 8)
+
+  start = time.monotonic()
+  deadline = start + time_budget
+  # Windows の DirEntry.stat() は st_dev / st_ino / st_nlink が常に 0 なので、os.stat で取り直す
+  # (ファイルごとにハンドルを開くので遅くなるが、WinSxS のようにハードリンクの多いドライブでも二重に数えない)
+  windows = os.name == "nt"
+
+  def stat_entry(entry):
+    if windows:
+      return os.stat(entry.path, follow_symlinks=False)
+    return entry.stat(follow_symlinks=False)
+
+  def get_stat_key(st):
+    # キャッシュのキーは、一覧で見つけた子ディレクトリ (stat_entry) もキャッシュから作った子ディレクトリ (scan の os.stat) も
+    # 同じ値から作る (Windows では DirEntry.stat() と os.stat() の st_dev / st_ino が違い、キャッシュが当たらなくなる)
+    return (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+  root = os.path.abspath(root)
+  root_stat = os.stat(root)
+  root_dev = root_stat.st_dev
+  if cache is not None:
+    cache.begin()
+
+  pending = queue.Queue()
+  pending.put((root, (), get_stat_key(root_stat)))
+  condition = threading.Condition()
+  stopped = threading.Event()
+  seen_inodes = set()
+  # totals は depth 階層までのディレクトリだけを持つので、ファイル数が多くてもメモリは増えない
+  totals = {}
+  state = {"outstanding": 1, "entries": 0, "total_size": 0, "files": 0, "directories": 0, "errors": 0, "cached": 0, "truncated": False}
+
+  def stop():
+    with condition:
+      state["truncated"] = True
+      stopped.set()
+      condition.notify_all()
+
+  def get_child_ancestors(ancestors, path):
+    return ancestors + (path,) if len(ancestors) < depth else ancestors
+
+  def list_directory(path, ancestors):
+    # (size, files, errors, entries, children, complete) を返す
+    size = 0
+    files = 0
+    errors = 0
+    entries = 0
+    children = []
+    try:
+      with os.scandir(path) as it:
+        for entry in it:
+          entries += 1
+          if entries % 1000 == 0 and (stopped.is_set() or time.monotonic() >= deadline):
+            stop()
+            return size, files, errors, entries, children, False
+          try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            st = stat_entry(entry)
+          except OSError:
+            errors += 1
+            continue
+          if is_dir:
+            if st.st_dev != root_dev:
+              continue
+            # Windows のボリュームのマウントポイントとジャンクションは、リンク自体の st_dev が親と同じなので属性で見分ける
+            if windows and getattr(st, "st_file_attributes", 0) & _FILE_ATTRIBUTE_REPARSE_POINT:
+              continue
+            size += _get_allocated_size(st)
+            children.append((entry.path, get_child_ancestors(ancestors, entry.path), get_stat_key(st)))
+            continue
+          if st.st_nlink > 1:
+            inode = (st.st_dev, st.st_ino)
+            with condition:
+              if inode in seen_inodes:
+                continue
+              seen_inodes.add(inode)
+          size += _get_allocated_size(st)
+          files += 1
+    except OSError:
+      return size, files, errors + 1, entries, children, False
+    return size, files, errors, entries, children, True
+
+  def scan(path, ancestors, stat_key):
+    cached = None
+    if cache is not None:
+      if stat_key is None:
+        # キャッシュから作った子ディレクトリは、自分で stat して変わっていないかを確かめる
+        try:
+          st = os.stat(path, follow_symlinks=False)
+          stat_key = get_stat_key(st)
+        except OSError:
+          stat_key = None
+      if stat_key is not None and stat_key[0] != root_dev:
+        # 前回のスキャン後にマウントされた
+        cached = (0, 0, [])
+      elif stat_key is not None:
+        entry = cache.get(path, stat_key)
+        if entry is not None:
+          cached = (entry[3], entry[4], [(os.path.join(path, name), get_child_ancestors(ancestors, os.path.join(path, name)), None) for name in entry[6]])
+
+    if cached is not None:
+      size, files, children = cached
+      errors = 0
+      entries = 1
+    else:
+      size, files, errors, entries, children, complete = list_directory(path, ancestors)
+      if cache is not None and complete and stat_key is not None:
+        cache.put(path, stat_key, size, files, [os.path.basename(child[0]) for child in children])
+
+    with condition:
+      for ancestor in ancestors:
+        totals[ancestor] = totals.get(ancestor, 0) + size
+      state["total_size"] += size
+      state["files"] += files
+      state["directories"] += len(children)
+      state["errors"] += errors
+      state["entries"] += entries
+      if cached is not None:
+        state["cached"] += 1
+      if state["entries"] >= max_entries:
+        state["truncated"] = True
+        stopped.set()
+      if not stopped.is_set():
+        state["outstanding"] += len(children)
+        for child in children:
+          pending.put(child)
+      state["outstanding"] -= 1
+      condition.notify_all()
+
+  def worker():
+    while not stopped.is_set():
+      try:
+        path, ancestors, stat_key = pending.get(timeout=0.1)
+      except queue.Empty:
+        continue
+      if stopped.is_set() or time.monotonic() >= deadline:
+        stop()
+        return
+      scan(path, ancestors, stat_key)
+
+  for _ in range(max(1, max_workers)):
+    threading.Thread(target=worker, name="calculate-storage-scan", daemon=True).start()
+
+  # 応答しないディレクトリで止まったスレッドは待たずに放置する (probe_drives と同じ)
+  with condition:
+    while state["outstanding"] > 0 and not stopped.is_set():
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        state["truncated"] = True
+        break
+      condition.wait(remaining)
+    stopped.set()
+    top_directories = sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:top_n]
+    directory_usage = DirectoryUsage(
+      root,
+      top_directories,
+      state["total_size"],
+      state["files"],
+      state["directories"],
+      state["errors"],
+      state["truncated"],
+      time.monotonic() - start,
+      state["cached"]
+    )
+  if cache is not None:
+    cache.finish(directory_usage.truncated)
+  return directory_usage
+
+def render_directory_usage(computer_name, drive, directory_usage):
+  # issue には 1 行の <details> として書く (行単位で差し替えられるようにするため)
+  import html
+  note = ", truncated" if directory_usage.truncated else ""
+  summary = f"🔴 {computer_name} {drive}: largest directories (scanned {directory_usage.files} files in {directory_usage.elapsed:.1f}s{note})"
+  items = "".join(
+    f"<li>{get_human_readable_size(size)} <code>{html.escape(path)}</code></li>"
+    for path, size in directory_usage.top_directories
+  )
+  return f"<details><summary>{html.escape(summary)}</summary><ul>{items}</ul></details>"
+
+def get_scan_mode():
+  # 🔴 のドライブの容量の内訳を調べるか: off / results (結果ファイルだけ) / issue (issue にも書く)
+  mode = os.environ.get("CALCULATE_STORAGE_SCAN_RED", "off")
+  if mode not in ("off", "results", "issue"):
+    raise ValueError(f"Invalid value for CALCULATE_STORAGE_SCAN_RED: {mode}")
+  return mode
+
+# daemon モードでは、ドライブごとのキャッシュ (と inotify の監視) をサイクルをまたいで使い回す
+_directory_usage_caches = {}
+
+def get_directory_usage_cache(drive):
+  # CALCULATE_STORAGE_SCAN_CACHE_MAX_AGE が 0 以下ならキャッシュしない
+  if drive in _directory_usage_caches:
+    return _directory_usage_caches[drive]
+  max_age = _get_env_float("CALCULATE_STORAGE_SCAN_CACHE_MAX_AGE", 7 * 86400.0)
+  if max_age <= 0:
+    return None
+
+  watcher = None
+  if os.environ.get("CALCULATE_STORAGE_SCAN_INOTIFY", "0") == "1":
+    try:
+      watcher = DirectoryWatcher()
+    except (OSError, AttributeError) as e:
+      logging.warning(f"Failed to start inotify, falling back to mtime checks: {e}")
+  cache_dir = os.environ.get("CALCULATE_STORAGE_CACHE_DIR", "cache")
+  _directory_usage_caches[drive] = DirectoryUsageCache(cache_dir, drive, max_age, watcher)
+  return _directory_usage_caches[drive]
+
+def scan_red_drive(drive, time_budget=None):
+  try:
+    directory_usage = scan_directory_usage(drive, time_budget=time_budget, cache=get_directory_usage_cache(drive))
+  except OSError as e:
+    logging.error(f"Failed to scan directory usage for {drive}: {e}")
+    return None
+  truncated = ", truncated" if directory_usage.truncated else ""
+  logging.info(f"Scanned {drive}: {directory_usage.files} files, {directory_usage.directories} directories ({directory_usage.cached_directories} cached) in {directory_usage.elapsed:.1f}s{truncated}")
+  return directory_usage
+
+def scan_red_drives(drives, time_budget=None):
+  # 🔴 のドライブを同時に調べる。全体で time_budget 秒 (ドライブの数によらない) で打ち切る
+  # 各スキャンは同じ期限で途中までの結果を返す。それでも戻らない (root の stat で止まったなど) スレッドは待たずに放置する
+  # 戻り値は drive -> DirectoryUsage (調べられなかったドライブは含まない)
+  if time_budget is None:
+    time_budget = _get_env_float("CALCULATE_STORAGE_SCAN_TIMEOUT", 60.0)
+  deadline = time.monotonic() + time_budget
+  directory_usages = {}
+  state = {"done": 0}
+  condition = threading.Condition()
+
+  def worker(drive):
+    directory_usage = scan_red_drive(drive, time_budget)
+    with condition:
+      if directory_usage is not None:
+        directory_usages[drive] = directory_usage
+      state["done"] += 1
+      condition.notify_all()
+
+  for drive in drives:
+    threading.Thread(target=worker, args=(drive,), name="calculate-storage-scan-drive", daemon=True).start()
+
+  with condition:
+    # スキャン自体が期限で打ち切って結果をまとめるまでの分だけ、少し余分に待つ
+    while state["done"] < len(drives):
+      remaining = deadline + 1.0 - time.monotonic()
+      if remaining <= 0:
+        logging.warning(f"Timed out scanning {len(drives) - state['done']} drives after {time_budget:.1f}s")
+        break
+      condition.wait(remaining)
+    return dict(directory_usages)
+
+def directory_usage_to_result(directory_usage):
+  return {
+    "top_directories": [{"path": path, "size": size} for path, size in directory_usage.top_directories],
+    "total_size": directory_usage.total_size,
+    "files": directory_usage.files,
+    "errors": directory_usage.errors,
+    "truncated": directory_usage.truncated,
+    "elapsed": directory_usage.elapsed,
+    "cached_directories": directory_usage.cached_directories
+  }
+
+def directory_usage_from_result(drive, record):
+  return DirectoryUsage(
+    drive,
+    [(item["path"], item["size"]) for item in record["top_directories"]],
+    record["total_size"],
+    record["files"],
+    0,
+    record["errors"],
+    record["truncated"],
+    record["elapsed"]
+  )
+
+def publish_directory_usage(github_issue, hostname, drive, directory_usage):
+  # issue に内訳を載せるのは 🔴 の行だけ。🔴 でなくなったら消す (スキャンに失敗したときは前回のものを残す)
+  storage_row = github_issue.storage_rows.get((hostname, drive))
+  if storage_row is None:
+    return
+  if storage_row.checkmark != "🔴":
+    github_issue.set_directory_usage(hostname, drive, None)
+  elif directory_usage is not None:
+    github_issue.set_directory_usage(hostname, drive, directory_usage)
+
+# HistoryStore.query が返す 1 点分のデータ (生データは used_min == used_max == used_last、count == 1)
+HistoryPoint = namedtuple("HistoryPoint", "timestamp used_min used_max used_last total count")
+
+class HistoryStore:
+  # ドライブごと・粒度ごとのファイルに固定長レコードを時刻順に追記する時系列ストア
+  # 時刻順に並んでいるので、範囲検索は mmap 上の二分探索で必要な部分だけを読む
+  # 古い生データは 1 時間ごと、さらに古いものは 1 日ごとの集計に畳む
+  raw_record = struct.Struct("<dIQQ")  # timestamp, drive_id, used, total
+  aggregate_record = struct.Struct("<dIQQQQI")  # timestamp, drive_id, used_min, used_max, used_last, total, count
+  # (粒度, 集計単位の秒数) の古い順
+  tiers = (("daily", 86400), ("hourly", 3600), ("raw", None))
+
+  def __init__(self, history_dir, hostname, raw_retention=7 * 86400, hourly_retention=90 * 86400, daily_retention=None):
+    self.path = os.path.join(history_dir, _safe_filename(hostname))
+    self.retention = {
+      "raw": raw_retention,
+      "hourly": hourly_retention,
+      "daily": daily_retention
+    }
+    self.drive_ids = None
+
+  def append(self, results):
+    points = {}
+    for result in results:
+      if result.get("status", "ok") != "ok" or "used" not in result:
+        continue
+      drive_id = self.get_drive_id(result["drive"], create=True)
+      timestamp = result.get("timestamp", time.time())
+      points.setdefault(drive_id, []).append(self.raw_record.pack(timestamp, drive_id, result["used"], result["total"]))
+
+    for drive_id, records in points.items():
+      path = self.__get_file_path("raw", drive_id)
+      last = self.__get_last_timestamp("raw", drive_id)
+      # 時刻が巻き戻った点は、二分探索の前提が崩れるので書き込まない
+      records = [record for record in records if last is None or self.raw_record.unpack(record)[0] >= last]
+      with open(path, "ab") as f:
+        # 前回の書き込みが途中で止まっていたら、レコード境界まで切り詰めてから追記する
+        size = f.seek(0, os.SEEK_END)
+        if size % self.raw_record.size != 0:
+          f.truncate(size - size % self.raw_record.size)
+        f.write(b"".join(records))
+    return sum(len(records) for records in points.values())
+
+  def query(self, drive, start=None, end=None):
+    drive_id = self.get_drive_id(drive)
+    if drive_id is None:
+      return []
+    points = []
+    for tier, _ in self.tiers:
+      points.extend(self.__read_range(tier, drive_id, start, end))
+    return points
+
+  def maintain(self, now=None):
+    # 保持期間を過ぎた生データを 1 時間単位、1 時間単位を 1 日単位に畳み、1 日単位の古いものを捨てる
+    if now is None:
+      now = time.time()
+    for drive_id in self.__load_drive_ids().values():
+      self.__rollup(drive_id, "raw", "hourly", 3600, now - self.retention["raw"])
+      self.__rollup(drive_id, "hourly", "daily", 86400, now - self.retention["hourly"])
+      if self.retention["daily"] is not None:
+        points = self.__read_range("daily", drive_id, now - self.retention["daily"], None)
+        if len(points) < self.__count("daily", drive_id):
+          self.__write_points("daily", drive_id, points)
+
+  def get_drive_id(self, drive, create=False):
+    drive_ids = self.__load_drive_ids()
+    if drive in drive_ids or not create:
+      return drive_ids.get(drive)
+
+    drive_ids[drive] = max(drive_ids.values(), default=-1) + 1
+    os.makedirs(self.path, exist_ok=True)
+    _atomic_write(os.path.join(self.path, "drives.json"), json.dumps(drive_ids, ensure_ascii=False))
+    return drive_ids[drive]
 
+  def __load_drive_ids(self):
+    if self.drive_ids is None:
+      try:
+        with open(os.path.join(self.path, "drives.json"), "r", encoding="utf-8") as f:
+          self.drive_ids = json.load(f)
+      except FileNotFoundError:
+        self.drive_ids = {}
+    return self.drive_ids
+
+  def __get_file_path(self, tier, drive_id):
+    return os.path.join(self.path, f"{tier}_{drive_id}.dat")
+
+  def __get_record(self, tier):
+    return self.raw_record if tier == "raw" else self.aggregate_record
+
+  def __count(self, tier, drive_id):
+    try:
+      return os.path.getsize(self.__get_file_path(tier, drive_id)) // self.__get_record(tier).size
+    except FileNotFoundError:
+      return 0
+
+  def __get_last_timestamp(self, tier, drive_id):
+    count = self.__count(tier, drive_id)
+    if count == 0:
+      return None
+    record = self.__get_record(tier)
+    with open(self.__get_file_path(tier, drive_id), "rb") as f:
+      f.seek((count - 1) * record.size)
+      return record.unpack(f.read(record.size))[0]
+
+  def __read_range(self, tier, drive_id, start, end, inclusive=True):
+    count = self.__count(tier, drive_id)
+    if count == 0:
+      return []
+    record = self.__get_record(tier)
+    with open(self.__get_file_path(tier, drive_id), "rb") as f:
+      with mmap.mmap(f.fileno(), count * record.size, access=mmap.ACCESS_READ) as data:
+        def timestamp_at(index):
+          return struct.unpack_from("<d", data, index * record.size)[0]
+
+        low = 0 if start is None else self.__bisect(timestamp_at, count, start)
+        high = count if end is None else self.__bisect(timestamp_at, count, end, right=inclusive)
+        if low >= high:
+          return []
+        view = memoryview(data)[low * record.size:high * record.size]
+        try:
+          if tier == "raw":
+            return [HistoryPoint(ts, used, used, used, total, 1) for ts, _, used, total in record.iter_unpack(view)]
+          return [HistoryPoint(ts, used_min, used_max, used_last, total, n) for ts, _, used_min, used_max, used_last, total, n in record.iter_unpack(view)]
+        finally:
+          view.release()
+
+  def __bisect(self, timestamp_at, count, value, right=False):
+    low, high = 0, count
+    while low < high:
+      middle = (low + high) // 2
+      timestamp = timestamp_at(middle)
+      if timestamp < value or (right and timestamp == value):
+        low = middle + 1
+      else:
+        high = middle
+    return low
+
+  def __rollup(self, drive_id, source, target, bucket, cutoff):
+    # 集計単位の境界で切るので、畳んだ区間は常に完全な 1 時間 (1 日) になる
+    cutoff = cutoff // bucket * bucket
+    old_points = self.__read_range(source, drive_id, None, cutoff, inclusive=False)
+    if len(old_points) == 0:
+      return
+
+    buckets = {}
+    for point in old_points:
+      key = point.timestamp // bucket * bucket
+      current = buckets.get(key)
+      if current is None:
+        buckets[key] = point._replace(timestamp=key)
+        continue
+      buckets[key] = HistoryPoint(key, min(current.used_min, point.used_min), max(current.used_max, point.used_max), point.used_last, point.total, current.count + point.count)
+
+    # 前回途中で止まっていた場合に、同じ区間を二重に書かない
+    last = self.__get_last_timestamp(target, drive_id)
+    aggregates = [point for key, point in sorted(buckets.items()) if last is None or key > last]
+    with open(self.__get_file_path(target, drive_id), "ab") as f:
+      f.write(b"".join(self.aggregate_record.pack(point.timestamp, drive_id, point.used_min, point.used_max, point.used_last, point.total, point.count) for point in aggregates))
+    self.__write_points(source, drive_id, self.__read_range(source, drive_id, cutoff, None))
+
+  def __write_points(self, tier, drive_id, points):
+    if tier == "raw":
+      data = b"".join(self.raw_record.pack(point.timestamp, drive_id, point.used_last, point.total) for point in points)
+    else:
+      data = b"".join(self.aggregate_record.pack(point.timestamp, drive_id, point.used_min, point.used_max, point.used_last, point.total, point.count) for point in points)
+    _atomic_write(self.__get_file_path(tier, drive_id), data)
+
+def record_history(hostname, results):
+  history_dir = os.environ.get("CALCULATE_STORAGE_HISTORY_DIR", "history")
+  try:
+    store = HistoryStore(history_dir, hostname)
+    store.append(results)
+    store.maintain()
+  except (OSError, ValueError) as e:
+    # 壊れた drives.json などで履歴が書けなくても、実行は止めない
+    logging.error(f"Failed to record history: {e}")
+
+def get_repo_name():
   repo_name = "book000/book000"
   if os.environ.get("GITHUB_REPOSITORY") is not None:
     repo_name = os.environ["GITHUB_REPOSITORY"]
+  return repo_name
 
-  issue_number = sys.argv[1] if len(sys.argv) > 1 else None
-  if issue_number is None:
-    logging.error("Please input issue number")
+# 集約された結果から update_storage_row に渡すための使用量
+ReportedUsage = namedtuple("ReportedUsage", "total used free percent")
+
+def apply_result(github_issue, hostname, result):
+  # 結果レコード (make_result の形式) を issue の行に反映する
+  drive = result["drive"]
+  if result.get("status") == "unreachable":
+    update_result = github_issue.mark_storage_row_unreachable(hostname, drive)
+  else:
+    github_issue.set_fill_forecast(hostname, drive, result.get("days_to_full"))
+    github_issue.set_fill_rate(hostname, drive, result.get("peak_fill_rate"), result.get("write_throughput"))
+    usage = ReportedUsage(result["total"], result["used"], result["total"] - result["used"], result["percent"])
+    update_result = github_issue.update_storage_row(hostname, drive, usage)
+    if get_scan_mode() == "issue":
+      directory_usage = result.get("directory_usage")
+      if directory_usage is not None:
+        directory_usage = directory_usage_from_result(drive, directory_usage)
+      publish_directory_usage(github_issue, hostname, drive, directory_usage)
+  if not update_result:
+    logging.error(f"Failed to update {drive} ({hostname})")
+  return update_result
+
+# インデックスの issue の「- host: #12」という行からシャードを取り出すための正規表現
+SHARD_HOST_REGEX = re.compile(r"#(?P<shard>[0-9]+)$")
+
+def parse_shard_index(index_issue):
+  # インデックスの issue から、シャードの issue 番号の一覧と、ホストの割り当て (host -> issue 番号) を読む
+  # シャードの行がなければ、インデックスの issue 自体に表がある (シャードなし)
+  shards = sorted((name for name in index_issue.get_marked_lines("shard") if name.isdigit()), key=int)
+  hosts = {}
+  for hostname, markdown in index_issue.get_marked_lines("host").items():
+    m = SHARD_HOST_REGEX.search(markdown)
+    if m is not None:
+      hosts[hostname] = m.group("shard")
+  return shards, hosts
+
+def get_shard_for_host(hostname, shards, hosts):
+  # 割り当てがあればそれを使い、なければ rendezvous hashing で決める
+  # (シャードを増やしても、割り当てが変わるのは新しいシャードに移るホストだけ)
+  shard = hosts.get(hostname)
+  if shard in shards:
+    return shard
+  return max(shards, key=lambda shard: hashlib.sha256(f"{hostname}#{shard}".encode("utf-8")).digest())
+
+def open_github_issue(repo_name, issue_number, github_token, cache, client=None, allow_cached=True):
+  try:
+    return GitHubIssue(repo_name, issue_number, github_token, client=client, cache=cache)
+  except Exception as e:
+    # API に接続できなくても、キャッシュ済みの本文があればドライブを測って spool に残す
+    cached = cache.get(repo_name, issue_number)
+    if cached is None or not allow_cached:
+      raise
+    logging.error(f"Failed to get issue body, using cached body: {e}")
+    return GitHubIssue(repo_name, issue_number, github_token, client=client, cache=cache, body=cached[1])
+
+def open_shard_issue(index_issue, hostname, current=None):
+  # このホストの行があるシャードの issue を返す (シャードがなければインデックスの issue)
+  shards, hosts = parse_shard_index(index_issue)
+  if len(shards) == 0:
+    return index_issue
+  shard = get_shard_for_host(hostname, shards, hosts)
+  if current is not None and current is not index_issue and str(current.issue_number) == shard:
+    return current
+  logging.info(f"Using shard issue #{shard}")
+  return open_github_issue(index_issue.repo_name, shard, index_issue.github_token, index_issue.cache, client=index_issue.client)
+
+def copy_storage_row(storage_row):
+  return StorageRow(
+    storage_row.computer_name,
+    storage_row.drive,
+    storage_row.checkmark,
+    storage_row.view_computer_name,
+    storage_row.view_drive,
+    storage_row.used,
+    storage_row.size,
+    storage_row.drive_type,
+    storage_row.raw
+  )
+
+def rebalance_shards(index_issue, add_shards=(), remove_shards=(), reset_pins=False):
+  # 各ホストの行 (と容量の内訳) を割り当てたシャードに移し、インデックスを書き直す
+  # 行を失わないように、移動先への追加 → インデックス → 移動元からの削除の順に書く
+  # それぞれの書き込みは update_issue_body の確認付きの差し込みなので、同時に動いているホストの書き込みとは衝突しない
+  old_shards, old_hosts = parse_shard_index(index_issue)
+  shards = sorted((set(old_shards) | {str(shard) for shard in add_shards}) - {str(shard) for shard in remove_shards}, key=int)
+  if len(shards) == 0:
+    raise Exception("Failed to rebalance shards: no shard issues")
+  if str(index_issue.issue_number) in shards:
+    raise Exception("Failed to rebalance shards: the index issue cannot be a shard")
+
+  shard_issues = {}
+  for shard in sorted(set(old_shards) | set(shards), key=int):
+    shard_issues[shard] = GitHubIssue(index_issue.repo_name, shard, index_issue.github_token, client=index_issue.client, cache=index_issue.cache)
+  sources = [(str(index_issue.issue_number), index_issue)] + list(shard_issues.items())
+
+  # ホストごとの、今ある行と容量の内訳
+  rows = {}
+  scans = {}
+  for number, issue in sources:
+    for storage_row in issue.storage_rows.values():
+      rows.setdefault(storage_row.computer_name, []).append((number, storage_row))
+    for name, markdown in issue.get_marked_lines("scan").items():
+      scans.setdefault(name.split("#", 1)[0], []).append((number, name, markdown))
+
+  pins = {} if reset_pins else old_hosts
+  placement = {}
+  for hostname in sorted(set(rows) | set(pins)):
+    placement[hostname] = get_shard_for_host(hostname, shards, pins)
+
+  moves = []
+  for hostname, shard in placement.items():
+    current = sorted({number for number, _ in rows.get(hostname, [])}, key=int)
+    if current != [shard] and len(current) > 0:
+      moves.append((hostname, current, shard))
+      logging.info(f"Move {hostname}: #{', #'.join(current)} -> #{shard}")
+
+  # 1. 移動先に追加する
+  for hostname, shard in placement.items():
+    target = shard_issues[shard]
+    for _, storage_row in rows.get(hostname, []):
+      target.insert_storage_row(copy_storage_row(storage_row))
+    for _, name, markdown in scans.get(hostname, []):
+      if name not in target.get_marked_lines("scan"):
+        target.set_marked_line("scan", name, markdown)
+  for shard in shards:
+    shard_issues[shard].update_issue_body()
+
+  # 2. インデックスにシャードと割り当てを書き、シャードなしだった頃の行を消す
+  for shard in sorted(set(old_shards) | set(shards), key=int):
+    index_issue.set_marked_line("shard", shard, f"- Shard #{shard}" if shard in shards else None)
+  for hostname in sorted(set(old_hosts) | set(placement)):
+    index_issue.set_marked_line("host", hostname, f"- {hostname}: #{placement[hostname]}" if hostname in placement else None)
+  for key in list(index_issue.storage_rows):
+    index_issue.remove_storage_row(*key)
+  for name in index_issue.get_marked_lines("scan"):
+    index_issue.set_marked_line("scan", name, None)
+  index_issue.update_issue_body()
+
+  # 3. 移動元から消す
+  for number, issue in shard_issues.items():
+    for key in list(issue.storage_rows):
+      if placement.get(key[0]) != number:
+        issue.remove_storage_row(*key)
+    for name in issue.get_marked_lines("scan"):
+      if placement.get(name.split("#", 1)[0]) != number:
+        issue.set_marked_line("scan", name, None)
+    issue.update_issue_body()
+    # GitHub の issue 本文は 65,536 文字まで
+    if len(issue.body) > 60000:
+      logging.warning(f"Shard issue #{number} is {len(issue.body)} characters, add another shard")
+  return moves
+
+class ResultSpool:
+  # GitHub に反映できなかった結果を溜めておく追記専用のキュー
+  # 1 行 1 レコードの JSONL で、追記ごとに fsync する。途中で落ちて壊れた行は読み込み時に捨てる
+  def __init__(self, spool_dir, max_records=None):
+    if max_records is None:
+      max_records = _get_env_int("CALCULATE_STORAGE_SPOOL_MAX_RECORDS", 10000)
+    self.spool_dir = spool_dir
+    self.path = os.path.join(spool_dir, "pending.jsonl")
+    self.max_records = max_records
+
+  def append(self, hostname, results):
+    spooled_at = time.time()
+    lines = []
+    for result in results:
+      if result.get("status") not in ("ok", "unreachable"):
+        continue
+      record = {key: value for key, value in result.items() if key != "update_result"}
+      record["computer_name"] = hostname
+      record["spooled_at"] = spooled_at
+      lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+    if len(lines) == 0:
+      return 0
+
+    data = "".join(lines).encode("utf-8")
+    os.makedirs(self.spool_dir, exist_ok=True)
+    with open(self.path, "a+b") as f:
+      # 前回の書き込みが途中で止まっていたら、次の行とくっつかないように改行を入れる
+      if f.seek(0, os.SEEK_END) > 0:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+          data = b"\n" + data
+      f.write(data)
+      f.flush()
+      os.fsync(f.fileno())
+
+    if self.__count_records() > self.max_records:
+      self.compact()
+    return len(lines)
+
+  def load(self):
+    # (computer_name, drive) ごとに最新のレコードだけを返す
+    records = {}
+    for record in self.__read_records():
+      records[(record["computer_name"], record["drive"])] = record
+    return records
+
+  def discard(self, flushed):
+    # 反映済みのレコード (load の戻り値) と、それより古いレコードを捨てる。読み込んだ後に追記された分は残す
+    remaining = []
+    for record in self.__read_records():
+      flushed_record = flushed.get((record["computer_name"], record["drive"]))
+      if flushed_record is not None and record.get("spooled_at", 0) <= flushed_record.get("spooled_at", 0):
+        continue
+      remaining.append(record)
+    if len(remaining) == 0:
+      try:
+        os.remove(self.path)
+      except FileNotFoundError:
+        pass
+      return
+    self.__write_records(remaining)
+
+  def compact(self):
+    # 同じドライブは最新だけに畳み、それでも上限を超える場合は古いものから捨てる
+    records = self.load()
+    kept = sorted(records.values(), key=lambda record: record.get("spooled_at", 0))[-self.max_records:]
+    if len(kept) < len(records):
+      logging.warning(f"Spool is full, dropped {len(records) - len(kept)} oldest records")
+    self.__write_records(kept)
+
+  def __read_records(self):
+    try:
+      with open(self.path, "rb") as f:
+        data = f.read()
+    except FileNotFoundError:
+      return []
+
+    # 最後の改行より後ろは書き込み途中なので読まない
+    records = []
+    for line in data[:data.rfind(b"\n") + 1].split(b"\n"):
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue
+      if not isinstance(record, dict) or "computer_name" not in record or "drive" not in record:
+        continue
+      records.append(record)
+    return records
+
+  def __count_records(self):
+    try:
+      with open(self.path, "rb") as f:
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1024 * 1024), b""))
+    except FileNotFoundError:
+      return 0
+
+  def __write_records(self, records):
+    data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+    _atomic_write(self.path, data)
+
+def is_valid_reported_result(result):
+  # collector に送られてきた結果レコード (make_result の形式) が apply_result で使えるか
+  if not isinstance(result, dict) or not isinstance(result.get("drive"), str):
+    return False
+  status = result.get("status")
+  if status == "unreachable":
+    return True
+  if status != "ok":
+    return False
+  return all(isinstance(result.get(key), (int, float)) and not isinstance(result.get(key), bool) for key in ("used", "total", "percent"))
+
+class Collector:
+  # 各ホストから送られてきた結果を (host, drive) ごとに最新だけ保持し、
+  # flush でまとめて 1 回の issue 更新に反映する
+  def __init__(self, github_issue):
+    self.github_issue = github_issue
+    self.pending = {}
+    self.lock = threading.Lock()
+    self.flush_lock = threading.Lock()
+    # GET /drives は flush (GitHub の取得・更新・確認で数十秒かかることがある) を待たずに、この写しから返す
+    self.drives = {}
+    self.__update_drives()
+
+  def report(self, hostname, results):
+    # 形の合わない結果は受け取らない (flush の apply_result で毎回失敗して、他の行の反映を止めないように)
+    # 戻り値は受け取った件数
+    received_at = time.time()
+    accepted = 0
+    with self.lock:
+      for result in results:
+        if not is_valid_reported_result(result):
+          continue
+        self.pending[(hostname, result["drive"])] = dict(result, received_at=received_at)
+        accepted += 1
+    return accepted
+
+  def get_drives(self, hostname):
+    with self.lock:
+      return list(self.drives.get(hostname, []))
+
+  def flush(self):
+    with self.flush_lock:
+      with self.lock:
+        pending = self.pending
+        self.pending = {}
+      if len(pending) == 0:
+        return 0
+
+      try:
+        self.github_issue.refresh()
+        for (hostname, drive), result in list(pending.items()):
+          try:
+            apply_result(self.github_issue, hostname, result)
+          except (KeyError, TypeError, ValueError) as e:
+            # 1 件の壊れた結果で、他の行の反映を止めない (次の flush にも回さない)
+            logging.error(f"Failed to apply result for {drive} ({hostname}), dropping it: {e!r}")
+            del pending[(hostname, drive)]
+        self.__update_drives()
+
+        logging.info(f"Update issue body ({len(pending)} rows)")
+        self.github_issue.update_issue_body()
+      except Exception:
+        # 失敗した分は、より新しい結果が届いていなければ次回の flush に回す
+        with self.lock:
+          for key, result in pending.items():
+            self.pending.setdefault(key, result)
+        raise
+
+      self.github_issue.log_update_metrics()
+      return len(pending)
+
+  def __update_drives(self):
+    # flush_lock を持っている (または初期化中の) ときだけ呼ぶ
+    drives = {computer_name: list(computer_drives) for computer_name, computer_drives in self.github_issue.computer_index.items()}
+    with self.lock:
+      self.drives = drives
+
+_collector_request_handler = None
+
+def _get_collector_request_handler():
+  # http.server も読み込みが重いので、collector を起動するときだけ読み込む
+  global _collector_request_handler
+  if _collector_request_handler is not None:
+    return _collector_request_handler
+
+  from http.server import BaseHTTPRequestHandler
+  from urllib.parse import parse_qs, urlparse
+
+  class CollectorRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+      if not self.__authorize():
+        return
+      url = urlparse(self.path)
+      if url.path != "/drives":
+        self.__send_json(404, {"error": "not found"})
+        return
+      hostname = parse_qs(url.query).get("host", [None])[0]
+      if not hostname:
+        self.__send_json(400, {"error": "host is required"})
+        return
+      self.__send_json(200, {"drives": self.server.collector.get_drives(hostname)})
+
+    def do_POST(self):
+      if not self.__authorize():
+        return
+      if urlparse(self.path).path != "/report":
+        self.__send_json(404, {"error": "not found"})
+        return
+      try:
+        length = int(self.headers.get("Content-Length") or 0)
+        if length < 0:
+          raise ValueError(f"invalid Content-Length: {length}")
+        if length > self.server.max_body:
+          # 読まずに捨てるので、この接続は使い回さない
+          self.close_connection = True
+          self.__send_json(413, {"error": f"report is larger than {self.server.max_body} bytes"})
+          return
+        payload = json.loads(self.rfile.read(length))
+        hostname = payload["hostname"]
+        results = payload["results"]
+        if not isinstance(hostname, str) or not isinstance(results, list):
+          raise ValueError("hostname and results are required")
+        invalid = [result.get("drive") if isinstance(result, dict) else None for result in results if not is_valid_reported_result(result)]
+        if len(invalid) > 0:
+          raise ValueError(f"results need a drive and status ok (with numeric used/total/percent) or unreachable: {invalid}")
+      except (ValueError, KeyError, TypeError) as e:
+        self.__send_json(400, {"error": f"invalid report: {e}"})
+        return
+      accepted = self.server.collector.report(hostname, results)
+      self.__send_json(202, {"accepted": accepted})
+
+    def log_message(self, format, *args):
+      logging.debug(f"collector: {self.address_string()} {format % args}")
+
+    def __authorize(self):
+      token = self.server.token
+      if token and self.headers.get("Authorization") != f"Bearer {token}":
+        self.__send_json(401, {"error": "unauthorized"})
+        return False
+      return True
+
+    def __send_json(self, status, data):
+      body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+  _collector_request_handler = CollectorRequestHandler
+  return _collector_request_handler
+
+def is_loopback_host(host):
+  import ipaddress
+
+  if host == "localhost":
+    return True
+  try:
+    return ipaddress.ip_address(host.strip("[]")).is_loopback
+  except ValueError:
+    return False
+
+def create_collector_server(collector, host, port, token=None):
+  from http.server import ThreadingHTTPServer
+
+  # token なしで外から届くアドレスに公開すると、誰でも issue の行を書き換えられる
+  if not token and not is_loopback_host(host):
+    raise Exception(f"Failed to start collector: listening on {host} requires CALCULATE_STORAGE_COLLECTOR_TOKEN")
+  server = ThreadingHTTPServer((host, port), _get_collector_request_handler())
+  server.daemon_threads = True
+  server.collector = collector
+  server.token = token
+  server.max_body = _get_env_int("CALCULATE_STORAGE_COLLECTOR_MAX_BODY", 1024 * 1024)
+  return server
+
+def run_collector(collector, host, port, flush_interval, token=None):
+  server = create_collector_server(collector, host, port, token)
+  stop_event = threading.Event()
+
+  def flush_loop():
+    while not stop_event.wait(flush_interval):
+      try:
+        collector.flush()
+      except Exception as e:
+        logging.error(f"Failed to flush collected results: {e}")
+
+  flush_thread = threading.Thread(target=flush_loop, name="calculate-storage-collector-flush", daemon=True)
+  flush_thread.start()
+  # serve_forever を動かしているスレッドからは shutdown できないので、別スレッドで止める
+  restore_signal_handlers = install_stop_signal_handlers(lambda: threading.Thread(target=server.shutdown, daemon=True).start())
+  logging.info(f"Collector listening on {host}:{server.server_address[1]} (flush every {flush_interval}s)")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    restore_signal_handlers()
+    stop_event.set()
+    server.server_close()
+    flush_thread.join()
+    collector.flush()
+
+def install_stop_signal_handlers(callback):
+  # SIGTERM / SIGINT で callback を呼ぶ。戻り値を呼ぶと元のハンドラに戻す
+  # signal.signal はメインスレッドからしか呼べないので、それ以外では何もしない
+  if threading.current_thread() is not threading.main_thread():
+    return lambda: None
+
+  def handler(signum, frame):
+    logging.info(f"Received signal {signum}, shutting down")
+    callback()
+
+  previous_handlers = {}
+  for signum in (signal.SIGTERM, signal.SIGINT):
+    previous_handlers[signum] = signal.signal(signum, handler)
+
+  def restore():
+    for signum, previous_handler in previous_handlers.items():
+      signal.signal(signum, previous_handler)
+
+  return restore
+
+def run_daemon(run_cycle, interval, jitter=0.1, stop_event=None):
+  # プロセス、HTTP 接続、GitHubIssue の状態を保ったまま、interval 秒ごとに run_cycle を実行する
+  # 全ホストが同じタイミングで動かないように、interval に ±jitter の揺らぎを加える
+  if stop_event is None:
+    stop_event = threading.Event()
+  restore_signal_handlers = install_stop_signal_handlers(stop_event.set)
+  logging.info(f"Daemon started (interval: {interval}s, jitter: {jitter:.0%})")
+  try:
+    while not stop_event.is_set():
+      # 日付が変わっていれば新しいログファイルに切り替える
+      setup_logging()
+      try:
+        run_cycle()
+      except Exception as e:
+        logging.exception(f"Daemon cycle failed: {e}")
+      delay = max(0.0, interval * (1 + random.uniform(-jitter, jitter)))
+      stop_event.wait(delay)
+  finally:
+    restore_signal_handlers()
+  logging.info("Daemon stopped")
+
+def _collector_headers():
+  token = os.environ.get("CALCULATE_STORAGE_COLLECTOR_TOKEN")
+  if not token:
+    return {}
+  return {
+    "Authorization": f"Bearer {token}"
+  }
+
+def get_collector_drives(collector_url, hostname):
+  import requests
+
+  response = requests.get(
+    f"{collector_url.rstrip('/')}/drives",
+    params={"host": hostname},
+    headers=_collector_headers(),
+    timeout=(5, 30)
+  )
+  if response.status_code != 200:
+    raise Exception(f"Failed to get drives from collector: {response.text}")
+  return response.json()["drives"]
+
+def report_to_collector(collector_url, hostname, results):
+  import requests
+
+  response = requests.post(
+    f"{collector_url.rstrip('/')}/report",
+    json={"hostname": hostname, "results": results},
+    headers=_collector_headers(),
+    timeout=(5, 30)
+  )
+  if response.status_code != 202:
+    raise Exception(f"Failed to report to collector: {response.text}")
+  return True
+
+def parse_listen_address(value):
+  host, _, port = value.rpartition(":")
+  if not port.isdigit():
+    raise argparse.ArgumentTypeError(f"invalid listen address: {value}")
+  return (host or "127.0.0.1", int(port))
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(prog="calculate_storage.py", description="Report disk usage to a GitHub issue", epilog="Run 'calculate_storage.py results --help' to read saved results, or 'calculate_storage.py rebalance --help' to shard the table across issues.")
+  parser.add_argument("issue_number", nargs="?", help="issue number that holds the storage table")
+  parser.add_argument("--collector-url", default=os.environ.get("CALCULATE_STORAGE_COLLECTOR_URL"), help="report results to a collector instead of GitHub")
+  parser.add_argument("--serve-collector", metavar="HOST:PORT", type=parse_listen_address, help="run as a collector that batches reports into the issue (HOST defaults to 127.0.0.1; other addresses require CALCULATE_STORAGE_COLLECTOR_TOKEN)")
+  parser.add_argument("--flush-interval", type=float, default=60.0, help="seconds between collector flushes (default: 60)")
+  parser.add_argument("--daemon", action="store_true", help="keep running and re-probe drives every --interval seconds")
+  parser.add_argument("--interval", type=float, default=_get_env_float("CALCULATE_STORAGE_INTERVAL", 600.0), help="seconds between probes in daemon mode (default: 600)")
+  parser.add_argument("--jitter", type=float, default=0.1, help="random +/- fraction applied to --interval (default: 0.1)")
+  parser.add_argument("--sample-interval", type=float, default=_get_env_float("CALCULATE_STORAGE_SAMPLE_INTERVAL", 0.0), help="in daemon mode, also sample disk usage and I/O every this many seconds and report the peak fill rate (default: 0, off)")
+  parser.add_argument("--discover", action="store_true", default=os.environ.get("CALCULATE_STORAGE_DISCOVER", "0") == "1", help="probe every mounted filesystem once and add missing rows to the issue")
+  parser.add_argument("--spread", type=float, default=_get_env_float("CALCULATE_STORAGE_SPREAD", 0.0), help="delay the start by a per-host offset within this many seconds (default: 0)")
+  parser.add_argument("--target", action="append", metavar="[OWNER/REPO]#ISSUE", default=[value for value in os.environ.get("CALCULATE_STORAGE_TARGETS", "").split(",") if value.strip()], help="also write to this issue (repeatable); drives are probed once and all issues are updated concurrently")
+  parser.add_argument("--max-concurrency", type=int, default=_get_env_int("CALCULATE_STORAGE_TARGET_CONCURRENCY", 4), help="issues fetched and updated at the same time with --target (default: 4)")
+  return parser.parse_args(argv)
+
+def parse_date_arg(value):
+  try:
+    return datetime.datetime.strptime(value, "%Y%m%d").date()
+  except ValueError:
+    raise argparse.ArgumentTypeError(f"invalid date (expected YYYYMMDD): {value}")
+
+def parse_results_args(argv):
+  parser = argparse.ArgumentParser(prog="calculate_storage.py results", description="Stream records saved in the results directory as JSON lines")
+  parser.add_argument("--dir", default="results", help="results directory (default: results)")
+  parser.add_argument("--host", action="append", dest="hosts", help="only read this host (repeatable)")
+  parser.add_argument("--since", type=parse_date_arg, help="first date to read (YYYYMMDD)")
+  parser.add_argument("--until", type=parse_date_arg, help="last date to read (YYYYMMDD)")
+  parser.add_argument("--workers", type=int, default=1, help="processes used to decode files in parallel (default: 1)")
+  parser.add_argument("--summary", action="store_true", help="print per-drive count / min / max / last used instead of records")
+  return parser.parse_args(argv)
+
+def run_results_command(argv, out=None):
+  args = parse_results_args(argv)
+  if out is None:
+    out = sys.stdout
+  if args.summary:
+    summaries = summarize_result_files(args.dir, args.hosts, args.since, args.until, args.workers)
+    for (hostname, drive), summary in sorted(summaries.items()):
+      out.write(json.dumps({"hostname": hostname, "drive": drive, **summary._asdict()}, ensure_ascii=False) + "\n")
     return
-  if not is_valid_issue_number(issue_number):
+
+  for record in iter_results(args.dir, args.hosts, args.since, args.until, args.workers):
+    line = record._asdict()
+    line["date"] = record.date.strftime("%Y%m%d")
+    out.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+def parse_rebalance_args(argv):
+  parser = argparse.ArgumentParser(prog="calculate_storage.py rebalance", description="Move storage rows into shard issues listed in an index issue")
+  parser.add_argument("issue_number", help="index issue that lists the shard issues")
+  parser.add_argument("--add-shard", type=int, action="append", default=[], metavar="ISSUE", help="add a shard issue (repeatable)")
+  parser.add_argument("--remove-shard", type=int, action="append", default=[], metavar="ISSUE", help="move rows out of a shard issue and drop it (repeatable)")
+  parser.add_argument("--reset-pins", action="store_true", help="ignore the current host assignments and place every host by hash")
+  return parser.parse_args(argv)
+
+def run_rebalance_command(argv):
+  args = parse_rebalance_args(argv)
+  if not is_valid_issue_number(args.issue_number):
     logging.error("Invalid issue number")
     return
+  cache = IssueBodyCache(os.environ.get("CALCULATE_STORAGE_CACHE_DIR", "cache"))
+  index_issue = GitHubIssue(get_repo_name(), args.issue_number, get_github_token(), cache=cache)
+  moves = rebalance_shards(index_issue, args.add_shard, args.remove_shard, args.reset_pins)
+  logging.info(f"Rebalanced shards: {len(moves)} hosts moved")
 
-  logging.info(f"Issue number: {issue_number}")
+def run_report_to_collector(collector_url, sampler=None):
+  hostname = get_real_hostname()
+  drives = get_collector_drives(collector_url, hostname)
+  if len(drives) == 0:
+    logging.warning(f"No drives found ({hostname})")
+    return
+
+  timer = PhaseTimer()
+  results = measure_drives(hostname, drives, timer=timer, sampler=sampler)
+
+  with timer.phase("save"):
+    save_results(hostname, results)
+
+  logging.info(f"Report to collector: {collector_url}")
+  try:
+    with timer.phase("report"):
+      report_to_collector(collector_url, hostname, results)
+    # 内訳は使用量を送った後で調べて、調べた行だけをもう一度送る (collector が issue に書くかを決める)
+    scanned = scan_red_results(hostname, results, timer)
+    if len(scanned) > 0:
+      with timer.phase("report"):
+        report_to_collector(collector_url, hostname, scanned)
+  finally:
+    # 履歴は送った後で残す (履歴の失敗や遅れで送信を止めない)
+    with timer.phase("save"):
+      record_history(hostname, results)
+    finish_run(hostname, results, timer.pop())
+
+def main(argv=None):
+  if argv is None:
+    argv = sys.argv[1:]
+  # results サブコマンドは保存済みの結果を読むだけなので、ログや GitHub の設定は使わない
+  if len(argv) > 0 and argv[0] == "results":
+    run_results_command(argv[1:])
+    return
+  if len(argv) > 0 and argv[0] == "rebalance":
+    log_path = setup_logging()
+    logging.info(f"Logging to {log_path}")
+    run_rebalance_command(argv[1:])
+    return
+
+  args = parse_args(argv)
+
+  log_path = setup_logging()
+  logging.info(f"Logging to {log_path}")
+
+  # 実行と実行の間のサンプルは、プロセスが残る daemon モードでだけ取れる
+  sampler = None
+  if args.daemon and args.sample_interval > 0 and not args.serve_collector:
+    sampler = UsageSampler(args.sample_interval)
+
+  if args.collector_url and not args.serve_collector:
+    if args.daemon:
+      run_daemon(lambda: run_report_to_collector(args.collector_url, sampler), args.interval, args.jitter)
+    else:
+      run_report_to_collector(args.collector_url)
+    return
+
+  repo_name = get_repo_name()
+
+  targets = []
+  issue_number = args.issue_number
+  if issue_number is not None:
+    if not is_valid_issue_number(issue_number):
+      logging.error("Invalid issue number")
+      return
+    targets.append(IssueTarget(repo_name, issue_number))
+  try:
+    for value in args.target:
+      target = parse_issue_target(value, repo_name)
+      if target not in targets:
+        targets.append(target)
+  except ValueError as e:
+    logging.error(str(e))
+    return
+  if len(targets) == 0:
+    logging.error("Please input issue number")
+    return
+  if len(targets) > 1 and args.serve_collector:
+    logging.error("--serve-collector writes to a single issue, do not combine it with --target")
+    return
+  if args.serve_collector and not os.environ.get("CALCULATE_STORAGE_COLLECTOR_TOKEN") and not is_loopback_host(args.serve_collector[0]):
+    logging.error("--serve-collector on a non-loopback address requires CALCULATE_STORAGE_COLLECTOR_TOKEN")
+    return
+
+  repo_name, issue_number = targets[0]
+  logging.info(f"Issue number: {', '.join(f'{target.repo_name}#{target.issue_number}' for target in targets)}")
 
   github_token = get_github_token()
 
-  github_issue = GitHubIssue(repo_name, issue_number, github_token)
+  if args.spread > 0 and not args.serve_collector:
+    offset = get_start_offset(get_real_hostname(), args.spread)
+    logging.info(f"Waiting {offset:.1f}s before start (spread: {args.spread}s)")
+    time.sleep(offset)
+
+  cache = IssueBodyCache(os.environ.get("CALCULATE_STORAGE_CACHE_DIR", "cache"))
+  spool_dir = os.environ.get("CALCULATE_STORAGE_SPOOL_DIR", "spool")
+  if len(targets) > 1:
+    import asyncio
+
+    hostname = get_real_hostname()
+    clients = {}
+
+    def run_targets_cycle():
+      asyncio.run(run_targets(targets, hostname, github_token, cache, spool_dir, discover=args.discover, max_concurrency=args.max_concurrency, clients=clients, sampler=sampler))
+
+    if args.daemon:
+      run_daemon(run_targets_cycle, args.interval, args.jitter)
+    else:
+      run_targets_cycle()
+    return
+
+  spool = ResultSpool(spool_dir)
+  github_issue = open_github_issue(repo_name, issue_number, github_token, cache, allow_cached=not args.serve_collector)
 
+  if args.serve_collector:
+    host, port = args.serve_collector
+    run_collector(Collector(github_issue), host, port, args.flush_interval, os.environ.get("CALCULATE_STORAGE_COLLECTOR_TOKEN"))
+    return
+
+  # issue_number がシャードのインデックスなら、このホストのシャードだけを読み書きする
   hostname = get_real_hostname()
-  drives = github_issue.get_computer_drives(hostname)
+  index_issue = github_issue
+  github_issue = open_shard_issue(index_issue, hostname)
+  if args.daemon:
+    current = [github_issue]
+
+    def run_cycle():
+      # 304 なら本文は送られてこないので、毎回取り直しても安い
+      # 取り直せなくても (open_github_issue のキャッシュと同じく) 今の行でドライブを測って spool に残す
+      issue = current[0]
+      try:
+        index_issue.refresh()
+        issue = open_shard_issue(index_issue, hostname, current[0])
+        if issue is current[0] and issue is not index_issue:
+          issue.refresh()
+      except Exception as e:
+        logging.error(f"Failed to refresh issue body, using the current rows: {e}")
+      current[0] = issue
+      run_once(issue, hostname, spool, discover=args.discover, sampler=sampler)
+
+    run_daemon(run_cycle, args.interval, args.jitter)
+    return
+
+  run_once(github_issue, hostname, spool, discover=args.discover)
+
+def run_once(github_issue, hostname, spool=None, discover=False, sampler=None):
+  timer = PhaseTimer()
+  aliases = {}
+  if discover:
+    with timer.phase("discover"):
+      drives, aliases = plan_discovered_drives(github_issue, hostname, discover_mounts(os.environ.get("CALCULATE_STORAGE_CACHE_DIR", "cache")))
+  else:
+    drives = github_issue.get_computer_drives(hostname)
   if len(drives) == 0:
     logging.warning(f"No drives found ({hostname})")
-    return
+    return None
+
+  results = measure_drives(hostname, drives, aliases, timer, sampler)
+  for result in results:
+    result["update_result"] = apply_result(github_issue, hostname, result)
+
+  with timer.phase("save"):
+    save_results(hostname, results)
+
+  try:
+    published = publish_results(github_issue, hostname, results, spool)
+    # 🔴 のドライブの内訳は、使用量を反映した後で調べる (スキャンに時間がかかっても反映を遅らせない)
+    scanned = scan_red_results(hostname, results, timer)
+    if published:
+      publish_scanned_results(github_issue, hostname, scanned)
+  finally:
+    # 履歴は反映した後で残す (履歴の失敗や遅れで反映を止めない)
+    with timer.phase("save"):
+      record_history(hostname, results)
+    # issue の取得・解析 (run_once の前に行ったものを含む) と書き込みの時間も合わせて残す
+    finish_run(hostname, results, timer.merge(github_issue.timer.pop()))
+  return results
+
+def measure_drives(hostname, drives, aliases=None, timer=None, sampler=None):
+  # ドライブを測って結果レコード (make_result の形式) を返す。issue には書き込まない
+  # aliases (代表のドライブ -> 同じファイルシステムの別の行) には、測った値をそのまま使う
+  # sampler があれば、前回からのサンプルの増加速度と書き込み速度を足し、次の実行までのサンプルを続ける
+  if timer is None:
+    timer = PhaseTimer()
+  summaries = {}
+  if sampler is not None:
+    summaries = sampler.collect()
+    sampler.watch(drives)
+  representatives = {alias: drive for drive, members in (aliases or {}).items() for alias in members}
+  with timer.phase("probe"):
+    probes = probe_drives(drives)
+  if aliases:
+    probes.extend(copy_probe(probe, alias) for probe in list(probes) for alias in aliases.get(probe.drive, []))
+  with timer.phase("forecast"):
+    forecasts = forecast_probes(hostname, probes)
 
   results = []
-  for drive in drives:
+  for probe in probes:
+    log_probe(probe)
+    if probe.status == "error":
+      continue
+    result = make_result(probe)
+    if probe.status == "ok":
+      result["days_to_full"] = forecasts.get(probe.drive)
+      summary = summaries.get(representatives.get(probe.drive, probe.drive))
+      if summary is not None:
+        result["samples"] = summary.samples
+        result["peak_fill_rate"] = summary.peak_fill_rate
+        result["write_throughput"] = summary.write_throughput
+    results.append(result)
+  return results
+
+def scan_red_results(hostname, results, timer=None):
+  # 🔴 になったドライブは、何が容量を使っているかを調べて結果レコードに directory_usage を足し、結果ファイルにも残す
+  # issue への反映 (publish_results / report_to_collector) の後に呼ぶ。スキャンに時間がかかっても健全なドライブの反映を遅らせない
+  # 戻り値は directory_usage を足した結果レコードのリスト
+  if timer is None:
+    timer = PhaseTimer()
+  if get_scan_mode() == "off":
+    return []
+  full_within_days = get_full_within_days()
+  red_results = [
+    result for result in results
+    if result.get("status") == "ok" and is_storage_red(result["percent"], result.get("days_to_full"), full_within_days)
+  ]
+  if len(red_results) == 0:
+    return []
+
+  with timer.phase("scan"):
+    directory_usages = scan_red_drives([result["drive"] for result in red_results])
+  scanned = []
+  for result in red_results:
+    directory_usage = directory_usages.get(result["drive"])
+    if directory_usage is not None:
+      result["directory_usage"] = directory_usage_to_result(directory_usage)
+      scanned.append(result)
+  if len(scanned) > 0:
     try:
-      usage = psutil.disk_usage(drive)
+      save_results(hostname, [{"drive": result["drive"], "status": "scan", "timestamp": time.time(), "directory_usage": result["directory_usage"]} for result in scanned])
     except OSError as e:
-      logging.error(f"Failed to get disk usage for {drive}: {e}")
+      logging.error(f"Failed to save directory usage: {e}")
+  return scanned
+
+def publish_scanned_results(github_issue, hostname, scanned):
+  # scan_red_results で調べた内訳を issue に書く (使用量は publish_results で反映済み)
+  # 書き込めなくても次の実行でまた調べる (キャッシュがあれば安い) ので、spool には残さない
+  if len(scanned) == 0 or get_scan_mode() != "issue":
+    return False
+  for result in scanned:
+    publish_directory_usage(github_issue, hostname, result["drive"], directory_usage_from_result(result["drive"], result["directory_usage"]))
+  logging.info(f"Update directory usage ({github_issue.repo_name}#{github_issue.issue_number})")
+  try:
+    github_issue.update_issue_body()
+  except Exception as e:
+    logging.error(f"Failed to update directory usage: {e}")
+    return False
+  return True
+
+def publish_results(github_issue, hostname, results, spool=None):
+  # apply_result 済みの issue に、前回までに反映できなかった結果を足して書き込む
+  # 書き込めなかった場合は spool に残して False を返す (spool がなければ例外をそのまま投げる)
+  # 前回までに反映できなかった結果は、今回測っていないドライブについてだけまとめて反映する
+  spooled = spool.load() if spool is not None else {}
+  probed = {result["drive"] for result in results}
+  for (computer_name, drive), result in spooled.items():
+    if computer_name == hostname and drive in probed:
       continue
+    apply_result(github_issue, computer_name, result)
+  if len(spooled) > 0:
+    logging.info(f"Flushing {len(spooled)} spooled results")
 
-    update_result = github_issue.update_storage_row(hostname, drive, usage)
-    if not update_result:
-      logging.error(f"Failed to update {drive}")
-
-    results.append({
-      "drive": drive,
-      "used": usage.used,
-      "total": usage.total,
-      "percent": usage.percent,
-      "used_size": github_issue.get_human_readable_size(usage.used),
-      "total_size": github_issue.get_human_readable_size(usage.total),
-      "update_result": update_result
-    })
+  logging.info(f"Update issue body ({github_issue.repo_name}#{github_issue.issue_number})")
+  try:
+    github_issue.update_issue_body()
+  except Exception as e:
+    if spool is None:
+      raise
+    spool.append(hostname, results)
+    logging.error(f"Failed to update issue body, spooled {len(results)} results for the next run: {e}")
+    return False
+  if len(spooled) > 0:
+    spool.discard(spooled)
+  cache = github_issue.cache
+  logging.info(f"Issue body cache: {cache.hits} hits, {cache.misses} misses")
+  github_issue.log_update_metrics()
+  return True
+
+# 書き込み先の issue。main の --target / CALCULATE_STORAGE_TARGETS で複数指定できる
+IssueTarget = namedtuple("IssueTarget", "repo_name issue_number")
+
+def parse_issue_target(value, default_repo_name):
+  # "owner/repo#12"、"#12"、"12" のいずれか。リポジトリを省略したら default_repo_name
+  repo_name, _, issue_number = value.strip().rpartition("#")
+  if repo_name == "":
+    repo_name = default_repo_name
+  if not is_valid_issue_number(issue_number) or len(repo_name.split("/")) != 2:
+    raise ValueError(f"Invalid target: {value}")
+  return IssueTarget(repo_name, issue_number)
+
+def get_target_spool(spool_dir, target):
+  # 書き込み先ごとに別の spool にする (1 つだけ失敗した場合に、他の issue へ二重に反映しないため)
+  return ResultSpool(os.path.join(spool_dir, f"{target.repo_name.replace('/', '_')}_{target.issue_number}"))
+
+async def run_targets(targets, hostname, github_token, cache, spool_dir=None, discover=False, max_concurrency=None, clients=None, sampler=None):
+  # 同じホストを複数の issue (別リポジトリを含む) に書き込む
+  # ドライブは 1 回だけ測り、issue の取得と書き込みは max_concurrency 個ずつ同時に行う
+  # 全体の時間が、issue ごとの時間の合計ではなく一番遅い issue の時間くらいになるようにする
+  # 戻り値は target -> 書き込めたか
+  import asyncio
+
+  if max_concurrency is None:
+    max_concurrency = _get_env_int("CALCULATE_STORAGE_TARGET_CONCURRENCY", 4)
+  # clients を渡すと GitHubClient (接続) を次の実行でも使い回す
+  if clients is None:
+    clients = {}
+  semaphore = asyncio.Semaphore(max(1, max_concurrency))
+  timer = PhaseTimer()
+
+  async def call(func, *args):
+    # requests は同期なので、同時に動くスレッドを max_concurrency 個までにする
+    async with semaphore:
+      return await asyncio.to_thread(func, *args)
+
+  def open_target(target):
+    client = clients.get(target)
+    if client is None:
+      client = clients[target] = GitHubClient(github_token)
+    index_issue = open_github_issue(target.repo_name, target.issue_number, github_token, cache, client=client)
+    return open_shard_issue(index_issue, hostname)
+
+  outcomes = {target: False for target in targets}
+  with timer.phase("open"):
+    opened = await asyncio.gather(*(call(open_target, target) for target in targets), return_exceptions=True)
+  issues = {}
+  for target, issue in zip(targets, opened):
+    if isinstance(issue, Exception):
+      logging.error(f"Failed to open {target.repo_name}#{target.issue_number}: {issue}")
+      continue
+    issues[target] = issue
+
+  # issue ごとのドライブをまとめて、同じドライブは 1 回だけ測る
+  mounts = discover_mounts(os.environ.get("CALCULATE_STORAGE_CACHE_DIR", "cache")) if discover else None
+  drives = []
+  aliases = {}
+  target_drives = {}
+  for target, issue in issues.items():
+    if discover:
+      issue_drives, issue_aliases = plan_discovered_drives(issue, hostname, mounts)
+    else:
+      issue_drives, issue_aliases = issue.get_computer_drives(hostname), {}
+    target_drives[target] = set(issue_drives).union(*issue_aliases.values())
+    drives.extend(drive for drive in issue_drives if drive not in drives)
+    for drive, members in issue_aliases.items():
+      aliases.setdefault(drive, []).extend(member for member in members if member not in aliases[drive])
+  # 別の issue で測るドライブになっているものは、コピーせずにそのまま測る
+  aliases = {drive: [member for member in members if member not in drives] for drive, members in aliases.items()}
+  if len(drives) == 0:
+    logging.warning(f"No drives found ({hostname})")
+    return outcomes
+
+  results = await asyncio.to_thread(measure_drives, hostname, drives, aliases, timer, sampler)
+  with timer.phase("save"):
+    save_results(hostname, results)
+
+  def publish(target, issue):
+    target_results = [dict(result) for result in results if result["drive"] in target_drives[target]]
+    for result in target_results:
+      result["update_result"] = apply_result(issue, hostname, result)
+    spool = get_target_spool(spool_dir, target) if spool_dir is not None else None
+    return publish_results(issue, hostname, target_results, spool)
+
+  try:
+    with timer.phase("publish"):
+      published = await asyncio.gather(*(call(publish, target, issue) for target, issue in issues.items()), return_exceptions=True)
+    for (target, issue), outcome in zip(issues.items(), published):
+      if isinstance(outcome, Exception):
+        logging.error(f"Failed to update {target.repo_name}#{target.issue_number}: {outcome}")
+        continue
+      outcomes[target] = outcome
 
-  save_results(hostname, results)
+    # 🔴 のドライブの内訳は、すべての issue に使用量を反映した後で 1 回だけ調べる
+    scanned = await asyncio.to_thread(scan_red_results, hostname, results, timer)
+    if len(scanned) > 0:
+      def publish_scanned(target, issue):
+        return publish_scanned_results(issue, hostname, [result for result in scanned if result["drive"] in target_drives[target]])
 
-  logging.info("Update issue body")
-  github_issue.update_issue_body()
+      with timer.phase("publish"):
+        await asyncio.gather(*(call(publish_scanned, target, issue) for target, issue in issues.items() if outcomes[target]))
+  finally:
+    # 履歴はすべての issue に反映した後で残す
+    with timer.phase("save"):
+      record_history(hostname, results)
+    # issue ごとの fetch / write などは足し合わせる (同時に動くので、合計は publish より長くなる)
+    for issue in issues.values():
+      timer.merge(issue.timer.pop())
+    finish_run(hostname, results, timer.pop())
+  return outcomes
 
 if __name__ == "__main__":
   main()
@@ -1,28 +1,95 @@
+import asyncio
+import contextlib
 import unittest
 from unittest.mock import patch, MagicMock
 from collections import namedtuple
 import calculate_storage
 import os
 import psutil
-import platform
 import tempfile
+import threading
+import time
+import json
+import datetime
+import gzip
+import io
+import shutil
+import signal
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks"))
+
+from fake_github import FakeGitHubServer
 
 DiskUsage = namedtuple("DiskUsage", "total used free percent")
 
+ROW_BODY = "| ✅ | test_computer | C | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#test_computer#C -->"
+CHANGED_USAGE = DiskUsage(total=100 * 1024 ** 3, used=2 * 1024 ** 3, free=98 * 1024 ** 3, percent=2)
+# FakeGitHubServer に置く issue (GitHubIssue("owner/repo", 1, ...) が読み書きする)
+ISSUE = ("owner/repo", 1)
+
+class IssueBodyStore:
+  # GitHubClient.patch のモックで書き込まれた本文を、次の取得で返す
+  def __init__(self, body):
+    self.body = body
+
+  def get_body(self, *args, **kwargs):
+    return self.body
+
+  def patch(self, path, json=None, headers=None, retry=True):
+    self.body = json["body"]
+    response = MagicMock()
+    response.status_code = 200
+    return response
+
+class WindowsDirEntry:
+  # Windows の os.scandir と同じく、stat() の st_dev / st_ino / st_nlink が 0 になる DirEntry
+  def __init__(self, entry):
+    self.entry = entry
+    self.name = entry.name
+    self.path = entry.path
+
+  def is_dir(self, follow_symlinks=True):
+    return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+  def stat(self, follow_symlinks=True):
+    st = self.entry.stat(follow_symlinks=follow_symlinks)
+    extra = {name: getattr(st, name) for name in ("st_mtime_ns", "st_blocks") if hasattr(st, name)}
+    return os.stat_result((st.st_mode, 0, 0, 0, st.st_uid, st.st_gid, st.st_size, st.st_atime, st.st_mtime, st.st_ctime), extra)
+
+real_scandir = os.scandir
+
+@contextlib.contextmanager
+def windows_scandir(path):
+  with real_scandir(path) as it:
+    yield (WindowsDirEntry(entry) for entry in it)
+
 class TestCalculateStorage(unittest.TestCase):
+  def setUp(self):
+    env_patcher = patch.dict(os.environ, {"CALCULATE_STORAGE_VERIFY_DELAY": "0"})
+    env_patcher.start()
+    self.addCleanup(env_patcher.stop)
+    # main() などが既定の results/ history/ cache/ spool/ に書いても、リポジトリを汚さないように一時ディレクトリで動かす
+    workdir = tempfile.TemporaryDirectory()
+    self.addCleanup(workdir.cleanup)
+    self.addCleanup(os.chdir, os.getcwd())
+    os.chdir(workdir.name)
+
   def _cleanup_logging_handlers(self):
     root_logger = calculate_storage.logging.getLogger()
     for handler in list(root_logger.handlers):
       root_logger.removeHandler(handler)
       if hasattr(handler, "close"):
         handler.close()
-  @patch('calculate_storage.requests.get')
-  @patch('calculate_storage.requests.patch')
+  @patch('calculate_storage.GitHubClient.get')
+  @patch('calculate_storage.GitHubClient.patch')
   def test_github_issue_update(self, mock_patch, mock_get):
+    store = IssueBodyStore("| ✅ | TEST_COMPUTER | C: | 50% | 100 GB (SSD) | <!-- calculate-storage#TEST_COMPUTER#C -->")
     mock_get.return_value.status_code = 200
-    mock_get.return_value.json.return_value = {"body": "| ✅ | TEST_COMPUTER | C: | 50% | 100 GB (SSD) | <!-- calculate-storage#TEST_COMPUTER#C -->"}
+    mock_get.return_value.json.side_effect = lambda: {"body": store.body}
 
-    mock_patch.return_value.status_code = 200
+    mock_patch.side_effect = store.patch
 
     github_issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
     usage = MagicMock()
@@ -81,7 +148,7 @@ class TestCalculateStorage(unittest.TestCase):
       self._cleanup_logging_handlers()
       tmpdir.cleanup()
 
-  @patch('calculate_storage.requests.get')
+  @patch('calculate_storage.GitHubClient.get')
   def test_get_issue_body(self, mock_get):
     mock_response = MagicMock()
     mock_response.status_code = 200
@@ -91,7 +158,7 @@ class TestCalculateStorage(unittest.TestCase):
     issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
     self.assertEqual(issue.body, "Test issue body")
 
-  @patch('calculate_storage.requests.get')
+  @patch('calculate_storage.GitHubClient.get')
   def test_get_issue_body_failure(self, mock_get):
     mock_response = MagicMock()
     mock_response.status_code = 404
@@ -102,7 +169,7 @@ class TestCalculateStorage(unittest.TestCase):
       calculate_storage.GitHubIssue("test_repo", 1, "test_token")
     self.assertIn("Failed to get issue body", str(context.exception))
 
-  @patch('calculate_storage.requests.get')
+  @patch('calculate_storage.GitHubClient.get')
   def test_get_issue_body_api_error(self, mock_get):
     mock_get.return_value.status_code = 500
     mock_get.return_value.text = "Internal Server Error"
@@ -111,37 +178,162 @@ class TestCalculateStorage(unittest.TestCase):
       calculate_storage.GitHubIssue("test_repo", 1, "test_token")
     self.assertIn("Failed to get issue body", str(context.exception))
 
-  @patch('calculate_storage.requests.patch')
+  @patch('calculate_storage.GitHubClient.patch')
   def test_update_issue_body(self, mock_patch):
-    mock_patch.return_value.status_code = 200
-    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', return_value="Mocked body"):
+    store = IssueBodyStore(ROW_BODY)
+    mock_patch.side_effect = store.patch
+    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', side_effect=store.get_body):
       issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
-      issue.body = "Updated body"
+      issue.update_storage_row("test_computer", "C", CHANGED_USAGE)
       result = issue.update_issue_body()
       self.assertTrue(result)
+      mock_patch.assert_called_once()
 
-  @patch('calculate_storage.requests.patch')
+  @patch('calculate_storage.GitHubClient.patch')
   def test_update_issue_body_failure(self, mock_patch):
     mock_patch.return_value.status_code = 400
     mock_patch.return_value.text = "Bad Request"
-    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', return_value="Mocked body"):
+    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', return_value=ROW_BODY):
       issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
-      issue.body = "Updated body"
+      issue.update_storage_row("test_computer", "C", CHANGED_USAGE)
       with self.assertRaises(Exception) as context:
         issue.update_issue_body()
       self.assertIn("Failed to update issue body", str(context.exception))
 
-  @patch('calculate_storage.requests.patch')
+  @patch('calculate_storage.GitHubClient.patch')
   def test_update_issue_body_api_error(self, mock_patch):
     mock_patch.return_value.status_code = 500
     mock_patch.return_value.text = "Internal Server Error"
-    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', return_value="Mocked body"):
+    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', return_value=ROW_BODY):
       issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
-      issue.body = "Updated body"
+      issue.update_storage_row("test_computer", "C", CHANGED_USAGE)
       with self.assertRaises(Exception) as context:
         issue.update_issue_body()
       self.assertIn("Failed to update issue body", str(context.exception))
 
+  @patch('calculate_storage.GitHubClient.patch')
+  def test_update_issue_body_skips_unchanged(self, mock_patch):
+    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', return_value=ROW_BODY):
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+      same_usage = DiskUsage(total=100 * 1024 ** 3, used=1 * 1024 ** 3, free=99 * 1024 ** 3, percent=1)
+      self.assertTrue(issue.update_storage_row("test_computer", "C", same_usage))
+      self.assertTrue(issue.update_issue_body())
+    mock_patch.assert_not_called()
+
+  @patch('calculate_storage.GitHubClient.patch')
+  def test_update_issue_body_publish_threshold(self, mock_patch):
+    store = IssueBodyStore(ROW_BODY)
+    mock_patch.side_effect = store.patch
+    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', side_effect=store.get_body):
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token", publish_threshold=5)
+      # 1% -> 2% は閾値未満なので書き込まない
+      issue.update_storage_row("test_computer", "C", CHANGED_USAGE)
+      issue.update_issue_body()
+      mock_patch.assert_not_called()
+
+      # 1% -> 91% はチェックマークも変わるので書き込む
+      full_usage = DiskUsage(total=100 * 1024 ** 3, used=91 * 1024 ** 3, free=9 * 1024 ** 3, percent=91)
+      issue.update_storage_row("test_computer", "C", full_usage)
+      issue.update_issue_body()
+      mock_patch.assert_called_once()
+      self.assertIn("| 🔴 | test_computer | C | 91.00 GB (91%) |", mock_patch.call_args.kwargs["json"]["body"])
+
+  @patch('calculate_storage.time.sleep')
+  @patch('calculate_storage.GitHubClient.patch')
+  def test_update_issue_body_merges_only_own_rows(self, mock_patch, mock_sleep):
+    other_row = "| ✅ | other | D | 1.00 GB (1%) | 100.00 GB (HDD) | <!-- calculate-storage#other#D -->"
+    store = IssueBodyStore(ROW_BODY + "\n" + other_row)
+    mock_patch.side_effect = store.patch
+    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', side_effect=store.get_body):
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+      # 取得後に他ホストが自分の行を更新した
+      newer_other_row = other_row.replace("1.00 GB (1%)", "5.00 GB (5%)")
+      store.body = store.body.replace(other_row, newer_other_row)
+
+      issue.update_storage_row("test_computer", "C", CHANGED_USAGE)
+      self.assertTrue(issue.update_issue_body())
+
+    lines = store.body.split("\n")
+    self.assertIn("2.00 GB (2%)", lines[0])
+    self.assertEqual(lines[1], newer_other_row)
+    self.assertEqual(issue.metrics, {"attempts": 1, "conflicts": 0, "retries": 0})
+    self.assertEqual(issue.dirty_rows, set())
+
+  @patch('calculate_storage.time.sleep')
+  @patch('calculate_storage.GitHubClient.patch')
+  def test_update_issue_body_retries_lost_update(self, mock_patch, mock_sleep):
+    other_row = "| ✅ | other | D | 1.00 GB (1%) | 100.00 GB (HDD) | <!-- calculate-storage#other#D -->"
+    store = IssueBodyStore(ROW_BODY + "\n" + other_row)
+    overwrites = [ROW_BODY + "\n" + other_row.replace("1.00 GB (1%)", "5.00 GB (5%)")]
+
+    def patch_then_overwrite(path, json=None, headers=None, retry=True):
+      response = store.patch(path, json=json)
+      # 直前に GET した他ホストの PATCH が後から届き、こちらの行を古い内容で上書きする
+      if overwrites:
+        store.body = overwrites.pop(0)
+      return response
+
+    mock_patch.side_effect = patch_then_overwrite
+    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', side_effect=store.get_body):
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+      issue.update_storage_row("test_computer", "C", CHANGED_USAGE)
+      self.assertTrue(issue.update_issue_body())
+
+    self.assertEqual(mock_patch.call_count, 2)
+    self.assertIn("2.00 GB (2%)", store.body)
+    self.assertIn("5.00 GB (5%)", store.body)
+    self.assertEqual(issue.metrics, {"attempts": 2, "conflicts": 1, "retries": 1})
+
+  @patch('calculate_storage.time.sleep')
+  @patch('calculate_storage.GitHubClient.patch')
+  def test_update_issue_body_gives_up_after_attempts(self, mock_patch, mock_sleep):
+    store = IssueBodyStore(ROW_BODY)
+
+    def patch_lost(path, json=None, headers=None, retry=True):
+      store.patch(path, json=json)
+      store.body = ROW_BODY
+      response = MagicMock()
+      response.status_code = 200
+      return response
+
+    mock_patch.side_effect = patch_lost
+    with patch.dict(os.environ, {"CALCULATE_STORAGE_UPDATE_ATTEMPTS": "3"}):
+      with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', side_effect=store.get_body):
+        issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+        issue.update_storage_row("test_computer", "C", CHANGED_USAGE)
+        with self.assertRaises(Exception) as context:
+          issue.update_issue_body()
+    self.assertIn("Failed to update issue body", str(context.exception))
+    self.assertEqual(issue.metrics, {"attempts": 3, "conflicts": 3, "retries": 2})
+
+  def test_update_issue_body_does_not_replay_stale_patch(self):
+    # B の PATCH が 503 になり、待っている間に A が書き込んで確認まで済ませる
+    # B がクライアントで同じ本文を再送すると A の行が戻るので、B は取り直して差し込み直す
+    other_row = "| ✅ | other | D | 1.00 GB (1%) | 100.00 GB (HDD) | <!-- calculate-storage#other#D -->"
+    with FakeGitHubServer({ISSUE: ROW_BODY + "\n" + other_row}) as server:
+      client = calculate_storage.GitHubClient("test_token", api_url=server.url, max_retries=3, backoff_base=0)
+      issue_a = calculate_storage.GitHubIssue("owner/repo", 1, "test_token", client=client)
+      issue_b = calculate_storage.GitHubIssue("owner/repo", 1, "test_token", client=client)
+      issue_a.update_storage_row("other", "D", CHANGED_USAGE)
+      issue_b.update_storage_row("test_computer", "C", CHANGED_USAGE)
+      pending = [issue_a.update_issue_body]
+      server.actions = [None, "503"]
+      with patch('calculate_storage.time.sleep', side_effect=lambda seconds: pending and pending.pop()()):
+        self.assertTrue(issue_b.update_issue_body())
+
+      self.assertIn("| other | D | 2.00 GB (2%)", server.get_body(*ISSUE))
+      self.assertIn("| test_computer | C | 2.00 GB (2%)", server.get_body(*ISSUE))
+      self.assertEqual(issue_b.metrics, {"attempts": 2, "conflicts": 0, "retries": 1})
+
+      # レート制限もクライアントでは待たず、待ち時間を渡す
+      server.actions = ["429"]
+      with patch('calculate_storage.time.sleep') as mock_sleep:
+        with self.assertRaises(calculate_storage.GitHubTransientError) as context:
+          client.patch("/repos/owner/repo/issues/1", json={"body": server.get_body(*ISSUE)}, retry=False)
+      self.assertEqual(context.exception.wait, 1.0)
+      mock_sleep.assert_not_called()
+      client.close()
+
   def test_get_human_readable_size(self):
     with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', return_value="Mocked body"):
       issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
@@ -154,36 +346,52 @@ class TestCalculateStorage(unittest.TestCase):
     mock_disk_usage.return_value = DiskUsage(total=1000000000, used=900000000, free=100000000, percent=91)
     with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', return_value="Mocked body"):
       issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
-      issue.storage_rows = [
-        {
-          "computer_name": "test_computer",
-          "drive": "C",
-          "markdown": {
-            "computer_name": "test_computer",
-            "drive": "C",
-            "checkmark": "",
-            "used": "",
-            "size": "",
-            "raw": "",
-            "drive_type": "SSD"
-          }
-        }
-      ]
+      issue.set_storage_rows([
+        calculate_storage.StorageRow("test_computer", "C", "", "test_computer", "C", "", "", "SSD", "")
+      ])
       result = issue.update_storage_row("test_computer", "C", mock_disk_usage.return_value)
       self.assertTrue(result)
-      self.assertEqual(issue.storage_rows[0]["markdown"]["checkmark"], "🔴")
+      self.assertEqual(issue.storage_rows[("test_computer", "C")].checkmark, "🔴")
+      self.assertFalse(issue.update_storage_row("test_computer", "Z", mock_disk_usage.return_value))
 
   def test_get_computer_drives(self):
     with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', return_value="Mocked body"):
       issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
-      issue.storage_rows = [
-        {"computer_name": "test_computer", "drive": "C"},
-        {"computer_name": "test_computer", "drive": "D"},
-        {"computer_name": "other_computer", "drive": "E"}
-      ]
+      issue.set_storage_rows([
+        calculate_storage.StorageRow("test_computer", "C", "", "test_computer", "C", "", "", "SSD", ""),
+        calculate_storage.StorageRow("test_computer", "D", "", "test_computer", "D", "", "", "SSD", ""),
+        calculate_storage.StorageRow("other_computer", "E", "", "other_computer", "E", "", "", "SSD", "")
+      ])
       drives = issue.get_computer_drives("test_computer")
       self.assertEqual(drives, ["C", "D"])
 
+  @patch('calculate_storage.GitHubClient.patch')
+  def test_update_issue_body_rewrites_rows(self, mock_patch):
+    body = "\n".join([
+      "# Storage",
+      "| ✅ | A | C: | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#A#C: -->",
+      "| ✅ | B | D: | 2.00 GB (2%) | 100.00 GB (HDD) | <!-- calculate-storage#B#D: -->",
+      "footer"
+    ])
+    added = "| ✅ | C | E: | 3.00 GB (3%) | 100.00 GB (HDD) | <!-- calculate-storage#C#E: -->"
+    store = IssueBodyStore(body)
+    mock_patch.side_effect = store.patch
+    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', side_effect=store.get_body):
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+      # 取得後に他ホストが行を追加した
+      store.body = body + "\n" + added
+      usage = DiskUsage(total=100 * 1024 ** 3, used=95 * 1024 ** 3, free=5 * 1024 ** 3, percent=95)
+      self.assertTrue(issue.update_storage_row("A", "C:", usage))
+      issue.update_issue_body()
+
+    lines = mock_patch.call_args.kwargs["json"]["body"].split("\n")
+    self.assertEqual(lines[0], "# Storage")
+    self.assertEqual(lines[1], "| 🔴 | A | C: | 95.00 GB (95%) | 100.00 GB (SSD) | <!-- calculate-storage#A#C: -->")
+    self.assertEqual(lines[2], "| ✅ | B | D: | 2.00 GB (2%) | 100.00 GB (HDD) | <!-- calculate-storage#B#D: -->")
+    self.assertEqual(lines[3], "footer")
+    # 取得後に追加された行は消さない
+    self.assertEqual(lines[4], added)
+
   def test_is_valid_issue_number(self):
     self.assertTrue(calculate_storage.is_valid_issue_number("123"))
     self.assertFalse(calculate_storage.is_valid_issue_number(None))
@@ -219,6 +427,77 @@ class TestCalculateStorage(unittest.TestCase):
       calculate_storage.save_results("test_host", [{"key": "value"}])
     self.assertIn("Permission denied", str(context.exception))
 
+  def test_save_results_appends(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    cwd = os.getcwd()
+    try:
+      os.chdir(tmpdir.name)
+      calculate_storage.save_results("test_host", [{"drive": "C", "used": 1}])
+      calculate_storage.save_results("test_host", [{"drive": "C", "used": 2}])
+      paths = os.listdir("results")
+      self.assertEqual(len(paths), 1)
+      with open(os.path.join("results", paths[0]), "r", encoding="utf-8") as f:
+        self.assertEqual([json.loads(line)["used"] for line in f], [1, 2])
+    finally:
+      os.chdir(cwd)
+      tmpdir.cleanup()
+
+  def test_history_store_append_and_query(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      store = calculate_storage.HistoryStore(tmpdir.name, "host/1")
+      base = 1700000000.0
+      for i in range(100):
+        store.append([
+          {"drive": "C:", "status": "ok", "used": i, "total": 1000, "timestamp": base + i * 60},
+          {"drive": "D:", "status": "unreachable", "timestamp": base + i * 60}
+        ])
+      # 時刻が巻き戻った点は書き込まれない
+      store.append([{"drive": "C:", "status": "ok", "used": 999, "total": 1000, "timestamp": base}])
+
+      self.assertIsNone(store.get_drive_id("D:"))
+      points = store.query("C:", base + 600, base + 1200)
+      self.assertEqual([point.used_last for point in points], list(range(10, 21)))
+      self.assertEqual(len(store.query("C:")), 100)
+      self.assertEqual(store.query("missing"), [])
+
+      # 別インスタンスからも読める
+      self.assertEqual(len(calculate_storage.HistoryStore(tmpdir.name, "host/1").query("C:")), 100)
+    finally:
+      tmpdir.cleanup()
+
+  def test_history_store_rollup(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      store = calculate_storage.HistoryStore(tmpdir.name, "host", raw_retention=86400, hourly_retention=3 * 86400, daily_retention=10 * 86400)
+      day = 86400
+      base = 1700006400.0 - 1700006400.0 % day
+      # 20 日分を 30 分ごとに記録する
+      results = [{"drive": "/", "status": "ok", "used": i, "total": 10000, "timestamp": base + i * 1800} for i in range(20 * 48)]
+      store.append(results)
+      now = base + 20 * day
+      store.maintain(now)
+      store.maintain(now)
+
+      points = store.query("/")
+      timestamps = [point.timestamp for point in points]
+      self.assertEqual(timestamps, sorted(timestamps))
+      self.assertEqual(len(set(timestamps)), len(timestamps))
+      # 10 日より古い日次集計は捨てる
+      self.assertGreaterEqual(points[0].timestamp, now - 10 * day)
+      # 直近 1 日は生データ
+      raw = [point for point in points if point.timestamp >= now - day]
+      self.assertEqual(len(raw), 48)
+      self.assertTrue(all(point.count == 1 for point in raw))
+      # 1 日単位の集計
+      daily = points[0]
+      self.assertEqual(daily.count, 48)
+      self.assertEqual(daily.used_max - daily.used_min, 47)
+      self.assertEqual(daily.used_last, daily.used_max)
+      self.assertEqual(sum(point.count for point in points), 10 * 48)
+    finally:
+      tmpdir.cleanup()
+
   def test_setup_logging_writes_file(self):
     root_logger = calculate_storage.logging.getLogger()
     for handler in list(root_logger.handlers):
@@ -272,6 +551,1409 @@ class TestCalculateStorage(unittest.TestCase):
       self._cleanup_logging_handlers()
       tmpdir.cleanup()
 
+  def test_probe_drives_timeout(self):
+    release = threading.Event()
+    usage = DiskUsage(total=100, used=50, free=50, percent=50.0)
+
+    def disk_usage(drive):
+      if drive == "/stale":
+        release.wait(10)
+      if drive == "/broken":
+        raise OSError("I/O error")
+      return usage
+
+    try:
+      with patch('calculate_storage.psutil.disk_usage', side_effect=disk_usage):
+        start = time.monotonic()
+        probes = calculate_storage.probe_drives(["/", "/stale", "/broken", "/data"], drive_timeout=0.2, total_timeout=5, max_workers=2)
+        elapsed = time.monotonic() - start
+    finally:
+      release.set()
+
+    self.assertLess(elapsed, 2)
+    statuses = {probe.drive: probe.status for probe in probes}
+    self.assertEqual(statuses, {"/": "ok", "/stale": "unreachable", "/broken": "error", "/data": "ok"})
+    self.assertIs(probes[0].usage, usage)
+
+  def test_probe_drives_total_timeout(self):
+    release = threading.Event()
+    try:
+      with patch('calculate_storage.psutil.disk_usage', side_effect=lambda drive: release.wait(10)):
+        probes = calculate_storage.probe_drives(["/a", "/b", "/c"], drive_timeout=5, total_timeout=0.2, max_workers=1)
+    finally:
+      release.set()
+    self.assertEqual([probe.status for probe in probes], ["unreachable"] * 3)
+
+  @patch('calculate_storage.save_results')
+  @patch('calculate_storage.probe_drives')
+  @patch('calculate_storage.get_real_hostname', return_value="TEST_COMPUTER")
+  @patch('calculate_storage.get_github_token', return_value="test_token")
+  @patch('calculate_storage.GitHubIssue')
+  def test_main_unreachable_drive(self, MockGitHubIssue, mock_get_github_token, mock_get_real_hostname, mock_probe_drives, mock_save_results):
+    mock_issue_instance = MockGitHubIssue.return_value
+    mock_issue_instance.get_computer_drives.return_value = ["/", "/stale"]
+    ok_probe = calculate_storage.DriveProbe("/")
+    ok_probe.status = "ok"
+    ok_probe.usage = DiskUsage(total=100, used=50, free=50, percent=50.0)
+    stale_probe = calculate_storage.DriveProbe("/stale")
+    stale_probe.status = "unreachable"
+    stale_probe.elapsed = 10.0
+    mock_probe_drives.return_value = [ok_probe, stale_probe]
+
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      with patch.dict(os.environ, {"CALCULATE_STORAGE_LOG_DIR": tmpdir.name}):
+        with patch('sys.argv', ["calculate_storage.py", "1"]):
+          calculate_storage.main()
+    finally:
+      self._cleanup_logging_handlers()
+      tmpdir.cleanup()
+
+    mock_issue_instance.update_storage_row.assert_called_once_with("TEST_COMPUTER", "/", ok_probe.usage)
+    mock_issue_instance.mark_storage_row_unreachable.assert_called_once_with("TEST_COMPUTER", "/stale")
+    mock_issue_instance.update_issue_body.assert_called_once()
+    results = mock_save_results.call_args_list[0].args[1]
+    self.assertEqual([result["status"] for result in results], ["ok", "unreachable"])
+
+  def test_mark_storage_row_unreachable(self):
+    body = "| ✅ | A | /mnt | 1.00 GB (1%) | 100.00 GB (HDD) | <!-- calculate-storage#A#/mnt -->"
+    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', return_value=body):
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+    self.assertTrue(issue.mark_storage_row_unreachable("A", "/mnt"))
+    self.assertEqual(issue.storage_rows[("A", "/mnt")].raw, "| ⚠️ | A | /mnt | unreachable | 100.00 GB (HDD) |")
+
+  def test_github_client_stub_server(self):
+    body = "| ✅ | A | C: | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#A#C: -->"
+    with FakeGitHubServer({ISSUE: body}) as server:
+      client = calculate_storage.GitHubClient("test_token", api_url=server.url, backoff_base=0)
+      issue = calculate_storage.GitHubIssue("owner/repo", 1, "test_token", client=client)
+      usage = DiskUsage(total=100 * 1024 ** 3, used=2 * 1024 ** 3, free=98 * 1024 ** 3, percent=2)
+      issue.update_storage_row("A", "C:", usage)
+      issue.update_issue_body()
+      client.close()
+
+      self.assertEqual(server.requests, [
+        ("GET", "/repos/owner/repo/issues/1"),
+        ("GET", "/repos/owner/repo/issues/1"),
+        ("PATCH", "/repos/owner/repo/issues/1"),
+        ("GET", "/repos/owner/repo/issues/1")
+      ])
+      # keep-alive で同じ接続が使い回される
+      self.assertEqual(len(server.client_ports), 1)
+      self.assertIn("2.00 GB (2%)", server.get_body(*ISSUE))
+
+  def test_refresh_drops_pending_rows_that_are_gone(self):
+    body = "\n".join([
+      "| ✅ | A | C: | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#A#C: -->",
+      "| ✅ | A | D: | 1.00 GB (1%) | 100.00 GB (HDD) | <!-- calculate-storage#A#D: -->"
+    ])
+    with FakeGitHubServer({ISSUE: body}) as server:
+      client = calculate_storage.GitHubClient("test_token", api_url=server.url, backoff_base=0)
+      issue = calculate_storage.GitHubIssue("owner/repo", 1, "test_token", client=client)
+      issue.update_attempts = 1
+      issue.add_storage_row("A", "/mnt/new", "HDD")
+      issue.update_storage_row("A", "D:", DiskUsage(total=100 * 1024 ** 3, used=2 * 1024 ** 3, free=98 * 1024 ** 3, percent=2))
+      server.actions = [None, "503"]
+      with self.assertRaises(Exception):
+        issue.update_issue_body()
+
+      # 書き込めないうちに D: の行が手で消され、追加した行はまだ本文にない
+      server.set_body(*ISSUE, body.split("\n")[0])
+      issue.refresh()
+      self.assertTrue(issue.update_issue_body())
+      self.assertEqual(server.get_body(*ISSUE), body.split("\n")[0])
+      self.assertEqual((issue.new_rows, issue.dirty_rows), (set(), set()))
+
+  def test_github_client_retries_transient_errors(self):
+    with FakeGitHubServer({ISSUE: "Test issue body"}) as server:
+      server.actions = ["503", "reset", "503"]
+      client = calculate_storage.GitHubClient("test_token", api_url=server.url, max_retries=3, backoff_base=0)
+      response = client.get("/repos/owner/repo/issues/1")
+      self.assertEqual(response.status_code, 200)
+      self.assertEqual(len(server.requests), 4)
+
+      server.actions = ["503", "503"]
+      client = calculate_storage.GitHubClient("test_token", api_url=server.url, max_retries=1, backoff_base=0)
+      self.assertEqual(client.get("/repos/owner/repo/issues/1").status_code, 503)
+
+  def test_github_client_read_timeout(self):
+    with FakeGitHubServer({ISSUE: "Test issue body"}) as server:
+      server.actions = ["slow"]
+      client = calculate_storage.GitHubClient("test_token", api_url=server.url, read_timeout=0.1, max_retries=0)
+      with self.assertRaises(calculate_storage.requests.Timeout):
+        client.get("/repos/owner/repo/issues/1")
+
+  @patch('calculate_storage.random.uniform', side_effect=lambda low, high: high)
+  @patch('calculate_storage.time.sleep')
+  def test_github_client_backoff(self, mock_sleep, mock_uniform):
+    with FakeGitHubServer({ISSUE: "Test issue body"}) as server:
+      server.actions = ["503"] * 4
+      client = calculate_storage.GitHubClient("test_token", api_url=server.url, max_retries=4, backoff_base=1, backoff_max=3)
+      client.get("/repos/owner/repo/issues/1")
+    self.assertEqual([c.args[0] for c in mock_sleep.call_args_list], [1, 2, 3, 3])
+
+  def test_atomic_write(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      path = os.path.join(tmpdir.name, "data.json")
+      calculate_storage._atomic_write(path, "first")
+      calculate_storage._atomic_write(path, b"second", fsync=False)
+      with open(path, "rb") as f:
+        self.assertEqual(f.read(), b"second")
+      # 置き換えに失敗しても元のファイルが残り、一時ファイルは残らない
+      with patch('calculate_storage.os.replace', side_effect=OSError("disk full")):
+        with self.assertRaises(OSError):
+          calculate_storage._atomic_write(path, "third")
+      self.assertEqual(os.listdir(tmpdir.name), ["data.json"])
+      self.assertEqual(calculate_storage._safe_filename("owner/repo_1"), "owner_repo_1")
+    finally:
+      tmpdir.cleanup()
+
+  def test_issue_body_cache_conditional_requests(self):
+    body = "| ✅ | A | C: | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#A#C: -->"
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      with FakeGitHubServer({ISSUE: body}) as server:
+        client = calculate_storage.GitHubClient("test_token", api_url=server.url, backoff_base=0)
+        cache = calculate_storage.IssueBodyCache(tmpdir.name)
+        issue = calculate_storage.GitHubIssue("owner/repo", 1, "test_token", client=client, cache=cache)
+        issue.update_issue_body()
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # 別プロセス相当: ディスク上のキャッシュから ETag を読み込む
+        cache = calculate_storage.IssueBodyCache(tmpdir.name)
+        issue = calculate_storage.GitHubIssue("owner/repo", 1, "test_token", client=client, cache=cache)
+        self.assertEqual(issue.body, body)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+        server.set_body(*ISSUE, body.replace("1.00 GB (1%)", "2.00 GB (2%)"))
+        issue = calculate_storage.GitHubIssue("owner/repo", 1, "test_token", client=client, cache=cache)
+        self.assertEqual(issue.body, server.get_body(*ISSUE))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+      self.assertEqual(os.listdir(tmpdir.name), ["issue_owner_repo_1.json"])
+    finally:
+      tmpdir.cleanup()
+
+  def test_issue_body_cache_ignores_broken_file(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      cache = calculate_storage.IssueBodyCache(tmpdir.name)
+      cache.put("owner/repo", 1, '"etag"', "body")
+      self.assertEqual(calculate_storage.IssueBodyCache(tmpdir.name).get("owner/repo", 1), ('"etag"', "body"))
+      with open(os.path.join(tmpdir.name, "issue_owner_repo_1.json"), "w", encoding="utf-8") as f:
+        f.write("{broken")
+      self.assertIsNone(calculate_storage.IssueBodyCache(tmpdir.name).get("owner/repo", 1))
+    finally:
+      tmpdir.cleanup()
+
+  def test_collector_flush_batches_hosts(self):
+    body = "\n".join([
+      "| ✅ | A | C: | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#A#C: -->",
+      "| ✅ | B | /data | 1.00 GB (1%) | 100.00 GB (HDD) | <!-- calculate-storage#B#/data -->"
+    ])
+    with FakeGitHubServer({ISSUE: body}) as server:
+      client = calculate_storage.GitHubClient("test_token", api_url=server.url, backoff_base=0)
+      issue = calculate_storage.GitHubIssue("owner/repo", 1, "test_token", client=client)
+      collector = calculate_storage.Collector(issue)
+      collector.report("A", [{"drive": "C:", "status": "ok", "used": 10 * 1024 ** 3, "total": 100 * 1024 ** 3, "percent": 10}])
+      collector.report("B", [{"drive": "/data", "status": "unreachable"}])
+      # 同じドライブは最新の結果だけが反映される
+      collector.report("A", [{"drive": "C:", "status": "ok", "used": 20 * 1024 ** 3, "total": 100 * 1024 ** 3, "percent": 20}])
+      self.assertEqual(collector.flush(), 2)
+      self.assertEqual(collector.flush(), 0)
+      self.assertEqual(collector.get_drives("B"), ["/data"])
+
+      self.assertEqual([method for method, _ in server.requests].count("PATCH"), 1)
+      self.assertIn("| ✅ | A | C: | 20.00 GB (20%) | 100.00 GB (SSD) |", server.get_body(*ISSUE))
+      self.assertIn("| ⚠️ | B | /data | unreachable | 100.00 GB (HDD) |", server.get_body(*ISSUE))
+
+  def test_collector_flush_failure_keeps_pending(self):
+    issue = MagicMock()
+    issue.update_issue_body.side_effect = Exception("Failed to update issue body")
+    collector = calculate_storage.Collector(issue)
+    collector.report("A", [{"drive": "C:", "status": "unreachable"}])
+    with self.assertRaises(Exception):
+      collector.flush()
+    self.assertIn(("A", "C:"), collector.pending)
+
+  def test_collector_drops_malformed_results(self):
+    issue = MagicMock()
+    collector = calculate_storage.Collector(issue)
+    self.assertEqual(collector.report("A", [
+      {"drive": "C:", "status": "ok"},
+      {"drive": "D:", "status": "broken"},
+      {"drive": "E:", "status": "ok", "used": True, "total": 100, "percent": 1},
+      {"drive": "F:", "status": "unreachable"}
+    ]), 1)
+    self.assertEqual(list(collector.pending), [("A", "F:")])
+
+    # report を通らずに入った壊れた結果でも、他のホストの反映は止まらない
+    collector.pending[("B", "/data")] = {"drive": "/data", "status": "ok"}
+    with patch('calculate_storage.apply_result', side_effect=[None, KeyError("total")]), self.assertLogs(level='ERROR'):
+      self.assertEqual(collector.flush(), 1)
+    issue.update_issue_body.assert_called_once()
+    self.assertEqual(collector.pending, {})
+
+  def test_collector_server(self):
+    issue = MagicMock()
+    issue.computer_index = {"A": ["C:", "D:"]}
+    collector = calculate_storage.Collector(issue)
+    server = calculate_storage.create_collector_server(collector, "127.0.0.1", 0, token="secret")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+      with patch.dict(os.environ, {"CALCULATE_STORAGE_COLLECTOR_TOKEN": "secret"}):
+        # 時間のかかる flush の最中 (flush_lock を持っている間) でも待たずに返る
+        with collector.flush_lock:
+          self.assertEqual(calculate_storage.get_collector_drives(url, "A"), ["C:", "D:"])
+        self.assertTrue(calculate_storage.report_to_collector(url, "A", [{"drive": "C:", "status": "unreachable"}]))
+      self.assertEqual(list(collector.pending), [("A", "C:")])
+
+      with patch.dict(os.environ, {"CALCULATE_STORAGE_COLLECTOR_TOKEN": "secret"}):
+        with self.assertRaises(Exception) as context:
+          calculate_storage.report_to_collector(url, "A", [{"drive": "D:", "status": "ok"}])
+      self.assertIn("invalid report", str(context.exception))
+      self.assertEqual(list(collector.pending), [("A", "C:")])
+
+      with self.assertRaises(Exception) as context:
+        calculate_storage.get_collector_drives(url, "A")
+      self.assertIn("unauthorized", str(context.exception))
+
+      # 大きすぎる本文は読まずに断る
+      server.max_body = 16
+      with patch.dict(os.environ, {"CALCULATE_STORAGE_COLLECTOR_TOKEN": "secret"}):
+        with self.assertRaises(Exception) as context:
+          calculate_storage.report_to_collector(url, "A", [{"drive": "D:", "status": "unreachable"}])
+      self.assertIn("larger than 16 bytes", str(context.exception))
+    finally:
+      server.shutdown()
+      server.server_close()
+
+  def test_collector_requires_token_off_loopback(self):
+    self.assertEqual(calculate_storage.parse_listen_address(":8080"), ("127.0.0.1", 8080))
+    self.assertEqual(calculate_storage.parse_listen_address("0.0.0.0:8080"), ("0.0.0.0", 8080))
+    self.assertTrue(calculate_storage.is_loopback_host("localhost"))
+    self.assertTrue(calculate_storage.is_loopback_host("::1"))
+    self.assertFalse(calculate_storage.is_loopback_host("0.0.0.0"))
+    with self.assertRaises(Exception) as context:
+      calculate_storage.create_collector_server(MagicMock(), "0.0.0.0", 0)
+    self.assertIn("CALCULATE_STORAGE_COLLECTOR_TOKEN", str(context.exception))
+
+  @patch('calculate_storage.report_to_collector')
+  @patch('calculate_storage.get_collector_drives', return_value=["C"])
+  @patch('calculate_storage.save_results')
+  @patch('calculate_storage.psutil.disk_usage')
+  @patch('calculate_storage.get_real_hostname', return_value="TEST_COMPUTER")
+  @patch('calculate_storage.GitHubIssue')
+  def test_main_report_to_collector(self, MockGitHubIssue, mock_get_real_hostname, mock_disk_usage, mock_save_results, mock_get_collector_drives, mock_report_to_collector):
+    mock_disk_usage.return_value = DiskUsage(total=100, used=50, free=50, percent=50.0)
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      with patch.dict(os.environ, {"CALCULATE_STORAGE_LOG_DIR": tmpdir.name}):
+        calculate_storage.main(["--collector-url", "http://collector:8080"])
+    finally:
+      self._cleanup_logging_handlers()
+      tmpdir.cleanup()
+
+    MockGitHubIssue.assert_not_called()
+    mock_get_collector_drives.assert_called_once_with("http://collector:8080", "TEST_COMPUTER")
+    hostname, results = mock_report_to_collector.call_args.args[1:]
+    self.assertEqual(hostname, "TEST_COMPUTER")
+    self.assertEqual(results[0]["drive"], "C")
+    self.assertEqual(results[0]["used"], 50)
+
+  @patch('calculate_storage.setup_logging')
+  def test_run_daemon_cycles_until_stopped(self, mock_setup_logging):
+    stop_event = threading.Event()
+    cycles = []
+
+    def run_cycle():
+      cycles.append(len(cycles))
+      if len(cycles) == 2:
+        raise Exception("GitHub is down")
+      if len(cycles) == 3:
+        stop_event.set()
+
+    with self.assertLogs(level='ERROR') as log:
+      calculate_storage.run_daemon(run_cycle, 0, stop_event=stop_event)
+    self.assertTrue(any("GitHub is down" in message for message in log.output))
+    # 失敗したサイクルがあっても止まらない
+    self.assertEqual(cycles, [0, 1, 2])
+    self.assertEqual(mock_setup_logging.call_count, 3)
+
+  @unittest.skipIf(os.name == "nt", "signals are not delivered this way on Windows")
+  @patch('calculate_storage.setup_logging')
+  def test_run_daemon_stops_on_signal(self, mock_setup_logging):
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    cycles = []
+
+    def run_cycle():
+      cycles.append(1)
+      os.kill(os.getpid(), signal.SIGTERM)
+
+    calculate_storage.run_daemon(run_cycle, 60)
+    self.assertEqual(len(cycles), 1)
+    self.assertIs(signal.getsignal(signal.SIGTERM), previous_handler)
+
+  def test_setup_logging_rolls_over_date(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      first_day = calculate_storage.datetime.date(2024, 1, 1)
+      second_day = calculate_storage.datetime.date(2024, 1, 2)
+      with patch.dict(os.environ, {"CALCULATE_STORAGE_LOG_DIR": tmpdir.name}):
+        with patch('calculate_storage.datetime.date') as mock_date:
+          mock_date.today.return_value = first_day
+          first_path = calculate_storage.setup_logging()
+          self.assertEqual(calculate_storage.setup_logging(), first_path)
+          mock_date.today.return_value = second_day
+          second_path = calculate_storage.setup_logging()
+      self.assertNotEqual(first_path, second_path)
+      root_logger = calculate_storage.logging.getLogger()
+      file_handlers = [handler for handler in root_logger.handlers if getattr(handler, "name", None) == "calculate-storage-file"]
+      self.assertEqual(len(file_handlers), 1)
+      self.assertEqual(file_handlers[0].baseFilename, os.path.abspath(second_path))
+    finally:
+      self._cleanup_logging_handlers()
+      tmpdir.cleanup()
+
+  def test_setup_logging_queues_rotates_and_prunes(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      now = time.time()
+      expired_path = os.path.join(tmpdir.name, "2023-01-01.log.gz")
+      with open(expired_path, "wb") as f:
+        f.write(b"expired")
+      os.utime(expired_path, (now - 400 * 86400, now - 400 * 86400))
+      previous_path = os.path.join(tmpdir.name, "2024-01-01.log")
+      with open(previous_path, "w", encoding="utf-8") as f:
+        f.write("previous day\n")
+      os.utime(previous_path, (now - 86400, now - 86400))
+
+      env = {
+        "CALCULATE_STORAGE_LOG_DIR": tmpdir.name,
+        "CALCULATE_STORAGE_LOG_MAX_MB": "0.001",
+        "CALCULATE_STORAGE_LOG_BACKUPS": "2",
+        "CALCULATE_STORAGE_LOG_FORMAT": "json"
+      }
+      with patch.dict(os.environ, env):
+        log_path = calculate_storage.setup_logging()
+      root_logger = calculate_storage.logging.getLogger()
+      file_handler = next(handler for handler in root_logger.handlers if getattr(handler, "name", None) == "calculate-storage-file")
+
+      # ファイルへの書き込みが止まっていても、ログを出す側は待たない
+      release = threading.Event()
+      emit = file_handler.file_handler.emit
+      with patch.object(file_handler.file_handler, "emit", side_effect=lambda record: release.wait(5) and emit(record)):
+        start = time.perf_counter()
+        for i in range(50):
+          calculate_storage.logging.debug("message %d", i)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        release.set()
+        file_handler.flush()
+
+      names = set(os.listdir(tmpdir.name))
+      self.assertNotIn("2023-01-01.log.gz", names)
+      self.assertNotIn("2024-01-01.log", names)
+      with gzip.open(previous_path + ".gz", "rt", encoding="utf-8") as f:
+        self.assertEqual(f.read(), "previous day\n")
+      self.assertIn(os.path.basename(log_path) + ".2.gz", names)
+      self.assertNotIn(os.path.basename(log_path) + ".3.gz", names)
+      with gzip.open(log_path + ".1.gz", "rt", encoding="utf-8") as f:
+        rotated = [json.loads(line) for line in f]
+      with open(log_path, "r", encoding="utf-8") as f:
+        current = [json.loads(line) for line in f]
+      self.assertEqual(current[-1]["message"], "message 49")
+      self.assertEqual(current[-1]["level"], "DEBUG")
+      self.assertEqual(int(rotated[-1]["message"].split()[1]) + 1, int(current[0]["message"].split()[1]))
+    finally:
+      self._cleanup_logging_handlers()
+      tmpdir.cleanup()
+
+  @patch('calculate_storage.run_daemon')
+  @patch('calculate_storage.run_once')
+  @patch('calculate_storage.get_real_hostname', return_value="TEST_COMPUTER")
+  @patch('calculate_storage.get_github_token', return_value="test_token")
+  @patch('calculate_storage.GitHubIssue')
+  def test_main_daemon(self, MockGitHubIssue, mock_get_github_token, mock_get_real_hostname, mock_run_once, mock_run_daemon):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      with patch.dict(os.environ, {"CALCULATE_STORAGE_LOG_DIR": tmpdir.name}):
+        calculate_storage.main(["1", "--daemon", "--interval", "300"])
+    finally:
+      self._cleanup_logging_handlers()
+      tmpdir.cleanup()
+
+    MockGitHubIssue.assert_called_once()
+    run_cycle, interval, jitter = mock_run_daemon.call_args.args
+    self.assertEqual(interval, 300)
+    mock_run_once.assert_not_called()
+    run_cycle()
+    MockGitHubIssue.return_value.refresh.assert_called_once()
+    mock_run_once.assert_called_once()
+    self.assertEqual(mock_run_once.call_args.args[:2], (MockGitHubIssue.return_value, "TEST_COMPUTER"))
+    self.assertIsInstance(mock_run_once.call_args.args[2], calculate_storage.ResultSpool)
+
+  def test_heavy_modules_are_imported_lazily(self):
+    code = "\n".join([
+      "import sys, calculate_storage",
+      "try:",
+      "  calculate_storage.main(['--help'])",
+      "except SystemExit:",
+      "  pass",
+      "print('loaded=' + ','.join(m for m in ('psutil', 'requests', 'http.server', 'asyncio') if m in sys.modules))",
+    ])
+    result = subprocess.run(
+      [sys.executable, "-c", code],
+      cwd=os.path.dirname(os.path.abspath(calculate_storage.__file__)),
+      capture_output=True,
+      text=True,
+      check=True
+    )
+    self.assertIn("usage:", result.stdout)
+    self.assertEqual(result.stdout.strip().splitlines()[-1], "loaded=")
+    # モジュール属性として参照したときには読み込まれる
+    self.assertIs(calculate_storage.psutil, psutil)
+
+  @patch('calculate_storage.time.sleep')
+  def test_github_client_retry_after(self, mock_sleep):
+    with FakeGitHubServer({ISSUE: "Test issue body"}) as server:
+      server.actions = ["429"]
+      client = calculate_storage.GitHubClient("test_token", api_url=server.url, backoff_base=0)
+      self.assertEqual(client.get("/repos/owner/repo/issues/1").status_code, 200)
+    mock_sleep.assert_called_once_with(1.0)
+
+  def test_github_client_rate_limit_exhausted(self):
+    with FakeGitHubServer({ISSUE: "Test issue body"}) as server:
+      server.actions = ["ratelimit"]
+      client = calculate_storage.GitHubClient("test_token", api_url=server.url, backoff_base=0)
+      with self.assertRaises(calculate_storage.GitHubRateLimitError):
+        client.get("/repos/owner/repo/issues/1")
+      self.assertEqual(len(server.requests), 1)
+
+  @patch('calculate_storage.time.sleep')
+  def test_github_client_waits_when_quota_is_low(self, mock_sleep):
+    with FakeGitHubServer({ISSUE: "Test issue body"}) as server:
+      server.headers = {"X-RateLimit-Remaining": "2", "X-RateLimit-Reset": str(int(time.time()) + 30)}
+      client = calculate_storage.GitHubClient("test_token", api_url=server.url, backoff_base=0)
+      client.get("/repos/owner/repo/issues/1")
+      self.assertEqual(client.rate_limit_remaining, 2)
+      mock_sleep.assert_not_called()
+
+      client.get("/repos/owner/repo/issues/1")
+      mock_sleep.assert_called_once()
+      self.assertGreater(mock_sleep.call_args.args[0], 25)
+
+      # リセットまで長すぎる場合は待たずに後回しにする
+      server.headers = {"X-RateLimit-Remaining": "2", "X-RateLimit-Reset": str(int(time.time()) + 3600)}
+      client.get("/repos/owner/repo/issues/1")
+      with self.assertRaises(calculate_storage.GitHubRateLimitError):
+        client.get("/repos/owner/repo/issues/1")
+
+  def test_start_offset_spreads_fleet(self):
+    window = 600
+    hosts = [f"host-{i:04d}" for i in range(2000)]
+    offsets = [calculate_storage.get_start_offset(host, window) for host in hosts]
+    self.assertEqual(offsets, [calculate_storage.get_start_offset(host, window) for host in hosts])
+    self.assertTrue(all(0 <= offset < window for offset in offsets))
+    self.assertEqual(calculate_storage.get_start_offset("host-0000", 0), 0.0)
+
+    # 10 秒ごとのリクエスト数のピーク: オフセットなしでは全台が同じ枠に集中する
+    bucket_seconds = 10
+    buckets = [0] * (window // bucket_seconds)
+    for offset in offsets:
+      buckets[int(offset // bucket_seconds)] += 1
+    mean = len(hosts) / len(buckets)
+    self.assertLess(max(buckets), mean * 2)
+    self.assertGreater(min(buckets), 0)
+    self.assertLess(max(buckets), len(hosts) / 20)
+
+  def test_result_spool_coalesces_and_survives_torn_writes(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      spool = calculate_storage.ResultSpool(tmpdir.name, max_records=3)
+      spool.append("A", [{"drive": "C:", "status": "ok", "used": 1, "total": 10, "percent": 10.0, "update_result": True}])
+      spool.append("A", [
+        {"drive": "C:", "status": "ok", "used": 2, "total": 10, "percent": 20.0},
+        {"drive": "D:", "status": "unreachable"}
+      ])
+      # 書き込み途中で落ちた行
+      with open(spool.path, "a", encoding="utf-8") as f:
+        f.write('{"computer_name": "A", "drive": "E:"')
+
+      records = spool.load()
+      self.assertEqual(set(records), {("A", "C:"), ("A", "D:")})
+      self.assertEqual(records[("A", "C:")]["used"], 2)
+      self.assertNotIn("update_result", records[("A", "C:")])
+
+      # 読み込んだ後の追記は discard しても残る
+      spool.append("B", [{"drive": "/", "status": "unreachable"}])
+      spool.discard(records)
+      records = spool.load()
+      self.assertEqual(set(records), {("B", "/")})
+
+      # 上限を超えたら最新のものだけ残す
+      for drive in ["/a", "/b", "/c", "/d"]:
+        spool.append("B", [{"drive": drive, "status": "unreachable"}])
+      records = spool.load()
+      self.assertEqual(set(records), {("B", "/b"), ("B", "/c"), ("B", "/d")})
+    finally:
+      tmpdir.cleanup()
+
+  @patch('calculate_storage.save_results')
+  @patch('calculate_storage.probe_drives')
+  def test_run_once_spools_and_flushes(self, mock_probe_drives, mock_save_results):
+    probe = calculate_storage.DriveProbe("C")
+    probe.status = "ok"
+    probe.usage = CHANGED_USAGE
+    mock_probe_drives.return_value = [probe]
+    other_row = "| ✅ | test_computer | D | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#test_computer#D -->"
+    store = IssueBodyStore(ROW_BODY + "\n" + other_row)
+
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      spool = calculate_storage.ResultSpool(tmpdir.name)
+      spool.append("test_computer", [{"drive": "D", "status": "ok", "used": 3 * 1024 ** 3, "total": 100 * 1024 ** 3, "percent": 3}])
+      with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', side_effect=store.get_body):
+        issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+        with patch('calculate_storage.GitHubClient.patch', side_effect=Exception("Connection refused")):
+          with self.assertLogs(level='ERROR'):
+            calculate_storage.run_once(issue, "test_computer", spool)
+        records = spool.load()
+        self.assertEqual(set(records), {("test_computer", "C"), ("test_computer", "D")})
+
+        issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+        with patch('calculate_storage.GitHubClient.patch', side_effect=store.patch) as mock_patch:
+          calculate_storage.run_once(issue, "test_computer", spool)
+        mock_patch.assert_called_once()
+    finally:
+      tmpdir.cleanup()
+
+    self.assertIn("2.00 GB (2%)", store.body)
+    self.assertIn("3.00 GB (3%)", store.body)
+    self.assertFalse(os.path.exists(spool.path))
+
+  @patch('calculate_storage.record_history')
+  @patch('calculate_storage.save_results')
+  @patch('calculate_storage.probe_drives')
+  def test_run_once_scans_red_drives_after_publishing(self, mock_probe_drives, mock_save_results, mock_record_history):
+    red_usage = DiskUsage(total=100 * 1024 ** 3, used=95 * 1024 ** 3, free=5 * 1024 ** 3, percent=95)
+    probes = []
+    for drive in ("C", "D"):
+      probe = calculate_storage.DriveProbe(drive)
+      probe.status = "ok"
+      probe.usage = red_usage
+      probes.append(probe)
+    mock_probe_drives.return_value = probes
+    other_row = "| ✅ | test_computer | D | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#test_computer#D -->"
+    store = IssueBodyStore(ROW_BODY + "\n" + other_row)
+    published_before_scan = []
+
+    def scan_red_drive(drive, time_budget=None):
+      # 使用量は、スキャンを始める前に issue に反映されている
+      published_before_scan.append(store.body.count("95.00 GB (95%)") == 2)
+      time.sleep(0.3)
+      return calculate_storage.DirectoryUsage(drive, [(f"{drive}/logs", 90 * 1024 ** 3)], 95 * 1024 ** 3, 10, 2, 0, False, 0.3)
+
+    with patch.dict(os.environ, {"CALCULATE_STORAGE_SCAN_RED": "issue"}), patch('calculate_storage.scan_red_drive', side_effect=scan_red_drive):
+      with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', side_effect=store.get_body):
+        issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+        with patch('calculate_storage.GitHubClient.patch', side_effect=store.patch):
+          start = time.perf_counter()
+          calculate_storage.run_once(issue, "test_computer")
+          elapsed = time.perf_counter() - start
+
+    self.assertEqual(published_before_scan, [True, True])
+    # 🔴 のドライブは同時に調べる
+    self.assertLess(elapsed, 0.55)
+    self.assertIn("calculate-storage-scan#test_computer#C", store.body)
+    self.assertIn("calculate-storage-scan#test_computer#D", store.body)
+    scan_records = mock_save_results.call_args_list[1].args[1]
+    self.assertEqual([(record["drive"], record["status"]) for record in scan_records], [("C", "scan"), ("D", "scan")])
+
+  @patch('calculate_storage.save_results')
+  @patch('calculate_storage.probe_drives')
+  def test_run_once_publishes_when_history_is_corrupt(self, mock_probe_drives, mock_save_results):
+    probe = calculate_storage.DriveProbe("C")
+    probe.status = "ok"
+    probe.usage = CHANGED_USAGE
+    mock_probe_drives.return_value = [probe]
+    os.makedirs(os.path.join("history", "test_computer"))
+    with open(os.path.join("history", "test_computer", "drives.json"), "w", encoding="utf-8") as f:
+      f.write("{broken")
+    store = IssueBodyStore(ROW_BODY)
+
+    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', side_effect=store.get_body):
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+      with patch('calculate_storage.GitHubClient.patch', side_effect=store.patch), self.assertLogs(level='ERROR') as log:
+        calculate_storage.run_once(issue, "test_computer")
+
+    self.assertIn("2.00 GB (2%)", store.body)
+    self.assertTrue(any("Failed to record history" in message for message in log.output))
+
+  @patch('calculate_storage.save_results')
+  @patch('calculate_storage.psutil.disk_usage', return_value=CHANGED_USAGE)
+  @patch('calculate_storage.get_real_hostname', return_value="test_computer")
+  @patch('calculate_storage.get_github_token', return_value="test_token")
+  @patch('calculate_storage.GitHubClient.get', side_effect=calculate_storage.requests.ConnectionError("Connection refused"))
+  def test_main_offline_uses_cached_body_and_spools(self, mock_get, mock_get_github_token, mock_get_real_hostname, mock_disk_usage, mock_save_results):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      cache_dir = os.path.join(tmpdir.name, "cache")
+      spool_dir = os.path.join(tmpdir.name, "spool")
+      calculate_storage.IssueBodyCache(cache_dir).put("owner/repo", "1", '"etag"', ROW_BODY)
+      env = {
+        "CALCULATE_STORAGE_LOG_DIR": tmpdir.name,
+        "CALCULATE_STORAGE_CACHE_DIR": cache_dir,
+        "CALCULATE_STORAGE_SPOOL_DIR": spool_dir,
+        "GITHUB_REPOSITORY": "owner/repo"
+      }
+      with patch.dict(os.environ, env):
+        with self.assertLogs(level='ERROR') as log:
+          calculate_storage.main(["1"])
+      self.assertTrue(any("using cached body" in message for message in log.output))
+      records = calculate_storage.ResultSpool(spool_dir).load()
+      self.assertEqual(records[("test_computer", "C")]["used"], CHANGED_USAGE.used)
+    finally:
+      self._cleanup_logging_handlers()
+      tmpdir.cleanup()
+
+  @patch('calculate_storage.record_history')
+  @patch('calculate_storage.save_results')
+  @patch('calculate_storage.run_daemon')
+  @patch('calculate_storage.psutil.disk_usage', return_value=CHANGED_USAGE)
+  @patch('calculate_storage.get_real_hostname', return_value="test_computer")
+  @patch('calculate_storage.get_github_token', return_value="test_token")
+  @patch('calculate_storage.GitHubClient.get', side_effect=calculate_storage.requests.ConnectionError("Connection refused"))
+  def test_main_daemon_spools_when_refresh_fails(self, mock_get, mock_get_github_token, mock_get_real_hostname, mock_disk_usage, mock_run_daemon, mock_save_results, mock_record_history):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      cache_dir = os.path.join(tmpdir.name, "cache")
+      spool_dir = os.path.join(tmpdir.name, "spool")
+      calculate_storage.IssueBodyCache(cache_dir).put("owner/repo", "1", '"etag"', ROW_BODY)
+      env = {
+        "CALCULATE_STORAGE_LOG_DIR": tmpdir.name,
+        "CALCULATE_STORAGE_CACHE_DIR": cache_dir,
+        "CALCULATE_STORAGE_SPOOL_DIR": spool_dir,
+        "GITHUB_REPOSITORY": "owner/repo"
+      }
+      with patch.dict(os.environ, env):
+        calculate_storage.main(["1", "--daemon", "--sample-interval", "0"])
+        run_cycle = mock_run_daemon.call_args.args[0]
+        # 障害中のサイクルでも測って spool に残す
+        with self.assertLogs(level='ERROR') as log:
+          run_cycle()
+      self.assertTrue(any("Failed to refresh issue body" in message for message in log.output))
+      mock_save_results.assert_called()
+      records = calculate_storage.ResultSpool(spool_dir).load()
+      self.assertEqual(records[("test_computer", "C")]["used"], CHANGED_USAGE.used)
+    finally:
+      self._cleanup_logging_handlers()
+      tmpdir.cleanup()
+
+  def test_forecast_days_to_full(self):
+    day = 86400
+    series = {
+      # 1 日 1 GB ずつ増え、残り 10 GB
+      "C:": [(i * day, (80 + i) * 1024 ** 3, 100 * 1024 ** 3) for i in range(11)],
+      # 減っている
+      "D:": [(i * day, (50 - i) * 1024 ** 3, 100 * 1024 ** 3) for i in range(5)],
+      # 点が足りない
+      "E:": [(0, 1, 10)],
+    }
+    forecasts = calculate_storage.forecast_days_to_full(series)
+    self.assertAlmostEqual(forecasts["C:"], 10.0)
+    self.assertIsNone(forecasts["D:"])
+    self.assertIsNone(forecasts["E:"])
+
+  def test_forecast_from_results_marks_filling_drive(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      now = time.time()
+      today = datetime.datetime.fromtimestamp(now).strftime("%Y%m%d")
+      with open(os.path.join(tmpdir.name, f"test_computer_{today}.txt"), "w", encoding="utf-8") as f:
+        for i in range(1, 4):
+          f.write(json.dumps({"drive": "C", "status": "ok", "used": (2 - i * 0.1) * 1024 ** 3, "total": 100 * 1024 ** 3, "timestamp": now - i * 86400}) + "\n")
+        f.write(json.dumps({"drive": "C", "status": "unreachable", "timestamp": now}) + "\n")
+      with open(os.path.join(tmpdir.name, f"other_{today}.txt"), "w", encoding="utf-8") as f:
+        f.write(json.dumps({"drive": "C", "status": "ok", "used": 1, "total": 2, "timestamp": now}) + "\n")
+
+      series = calculate_storage.load_usage_series("test_computer", tmpdir.name, days=30, now=now)
+      self.assertEqual(list(series), ["C"])
+      self.assertEqual(len(series["C"]), 3)
+      self.assertEqual(calculate_storage.load_usage_series("test_computer", tmpdir.name, days=0.5, now=now), {})
+    finally:
+      tmpdir.cleanup()
+
+    with patch.dict(os.environ, {"CALCULATE_STORAGE_FULL_WITHIN_DAYS": "30"}), \
+        patch.object(calculate_storage.GitHubIssue, "_GitHubIssue__get_issue_body", return_value=ROW_BODY):
+      github_issue = calculate_storage.GitHubIssue("owner/repo", 1, "token")
+      github_issue.set_fill_forecast("test_computer", "C", 10.5)
+      self.assertTrue(github_issue.update_storage_row("test_computer", "C", CHANGED_USAGE))
+      row = github_issue.storage_rows[("test_computer", "C")]
+      self.assertEqual(row.checkmark, "🔴")
+      self.assertEqual(row.used, "2.00 GB (2%, full in ~10d)")
+
+      # 表示を変えても、次回の使用率の読み取りには影響しない
+      github_issue.set_fill_forecast("test_computer", "C", None)
+      self.assertTrue(github_issue.update_storage_row("test_computer", "C", CHANGED_USAGE))
+      self.assertEqual(github_issue.storage_rows[("test_computer", "C")].used, "2.00 GB (2%)")
+      self.assertEqual(github_issue.storage_rows[("test_computer", "C")].checkmark, "✅")
+
+  def test_iter_results_streams_in_date_order(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      files = {
+        "host_a_20240102.txt": [{"drive": "C", "status": "ok", "used": 3, "total": 10, "timestamp": 3}, "{broken"],
+        "host_a_20240101.txt": [{"drive": "C", "status": "ok", "used": 5, "total": 10, "timestamp": 1}, {"drive": "C", "status": "unreachable", "timestamp": 2}],
+        "host_b_20240101.txt": [{"drive": "D", "used": 1, "total": 2}],
+        "host_b_20240103.txt": [{"drive": "D", "status": "ok", "used": 2, "total": 2, "timestamp": 4}],
+        "notes.txt": ["ignored"],
+      }
+      for filename, lines in files.items():
+        with open(os.path.join(tmpdir.name, filename), "w", encoding="utf-8") as f:
+          for line in lines:
+            f.write((line if isinstance(line, str) else json.dumps(line)) + "\n")
+
+      records = list(calculate_storage.iter_results(tmpdir.name))
+      self.assertEqual([(record.hostname, record.date.strftime("%Y%m%d"), record.drive, record.used) for record in records], [
+        ("host_a", "20240101", "C", 5),
+        ("host_a", "20240101", "C", None),
+        ("host_b", "20240101", "D", 1),
+        ("host_a", "20240102", "C", 3),
+        ("host_b", "20240103", "D", 2),
+      ])
+      # 古い形式 (status / timestamp なし) はファイルの日付で補う
+      self.assertEqual(records[2].status, "ok")
+      self.assertEqual(records[2].timestamp, datetime.datetime(2024, 1, 1).timestamp())
+
+      self.assertEqual(list(calculate_storage.iter_results(tmpdir.name, workers=2)), records)
+      filtered = calculate_storage.iter_results(tmpdir.name, hosts=["host_a"], since=datetime.date(2024, 1, 2), until=datetime.date(2024, 1, 2))
+      self.assertEqual([record.used for record in filtered], [3])
+
+      summaries = calculate_storage.summarize_results(calculate_storage.iter_results(tmpdir.name))
+      self.assertEqual(summaries[("host_a", "C")], calculate_storage.ResultSummary(2, 3, 5, 3, 10, 3))
+      self.assertEqual(summaries[("host_b", "D")].count, 2)
+      self.assertEqual(calculate_storage.summarize_result_files(tmpdir.name, workers=2), summaries)
+
+      out = io.StringIO()
+      calculate_storage.run_results_command(["--dir", tmpdir.name, "--host", "host_b", "--summary"], out)
+      self.assertEqual([json.loads(line)["last_used"] for line in out.getvalue().splitlines()], [2])
+      out = io.StringIO()
+      calculate_storage.run_results_command(["--dir", tmpdir.name, "--since", "20240103"], out)
+      self.assertEqual([json.loads(line)["date"] for line in out.getvalue().splitlines()], ["20240103"])
+      with patch("sys.stderr", io.StringIO()), self.assertRaises(SystemExit):
+        calculate_storage.run_results_command(["--since", "2024-01-03"], out)
+    finally:
+      tmpdir.cleanup()
+
+  def test_scan_directory_usage(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      root = tmpdir.name
+      os.makedirs(os.path.join(root, "big", "nested", "deeper"))
+      os.makedirs(os.path.join(root, "small"))
+      sizes = {}
+      for path, size in (("big/nested/deeper/a.bin", 300000), ("big/b.bin", 200000), ("small/c.bin", 10000)):
+        full_path = os.path.join(root, path)
+        with open(full_path, "wb") as f:
+          f.write(b"x" * size)
+        sizes[path] = calculate_storage._get_allocated_size(os.stat(full_path))
+      # ハードリンクは 1 回だけ数える
+      os.link(os.path.join(root, "big", "b.bin"), os.path.join(root, "big", "b-link.bin"))
+
+      usage = calculate_storage.scan_directory_usage(root, top_n=2, depth=1, time_budget=30, max_entries=1000, max_workers=4)
+      self.assertFalse(usage.truncated)
+      self.assertEqual(usage.files, 3)
+      self.assertEqual([path for path, _ in usage.top_directories], [os.path.join(root, "big"), os.path.join(root, "small")])
+      big_size = usage.top_directories[0][1]
+      self.assertGreaterEqual(big_size, sizes["big/nested/deeper/a.bin"] + sizes["big/b.bin"])
+      self.assertLess(usage.top_directories[1][1], sizes["big/b.bin"])
+
+      deep = calculate_storage.scan_directory_usage(root, top_n=10, depth=3, time_budget=30, max_entries=1000, max_workers=2)
+      self.assertIn(os.path.join(root, "big", "nested", "deeper"), dict(deep.top_directories))
+      self.assertEqual(deep.total_size, usage.total_size)
+
+      # エントリ数の上限で打ち切る
+      limited = calculate_storage.scan_directory_usage(root, top_n=10, depth=1, time_budget=30, max_entries=1, max_workers=1)
+      self.assertTrue(limited.truncated)
+
+      # 別のファイルシステム (root と st_dev が違うディレクトリ) には入らない
+      real_stat = os.stat
+      root_path = os.path.abspath(root)
+      other_root = lambda path, **kwargs: os.stat_result((0, 0, real_stat(path).st_dev + 1) + (0,) * 7) if path == root_path else real_stat(path, **kwargs)
+      with patch("calculate_storage.os.stat", side_effect=other_root):
+        other = calculate_storage.scan_directory_usage(root, top_n=10, depth=1, time_budget=30, max_entries=1000, max_workers=2)
+      self.assertEqual(other.files, 0)
+      self.assertEqual(other.top_directories, [])
+    finally:
+      tmpdir.cleanup()
+
+  def test_scan_directory_usage_windows_dir_entries(self):
+    # Windows の DirEntry.stat() は st_dev / st_ino / st_nlink を返さないので、os.stat で取り直してハードリンクを 1 回だけ数える
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      root = tmpdir.name
+      os.makedirs(os.path.join(root, "big"))
+      with open(os.path.join(root, "big", "b.bin"), "wb") as f:
+        f.write(b"x" * 200000)
+      os.link(os.path.join(root, "big", "b.bin"), os.path.join(root, "big", "b-link.bin"))
+
+      with patch("calculate_storage.os.name", "nt"), patch("calculate_storage.os.scandir", side_effect=windows_scandir):
+        usage = calculate_storage.scan_directory_usage(root, top_n=10, depth=1, time_budget=30, max_entries=1000, max_workers=2)
+      self.assertEqual(usage.files, 1)
+      self.assertEqual(usage.total_size, calculate_storage.scan_directory_usage(root, top_n=10, depth=1, time_budget=30, max_entries=1000, max_workers=2).total_size)
+    finally:
+      tmpdir.cleanup()
+
+  def test_scan_directory_usage_cache(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      root = os.path.join(tmpdir.name, "root")
+      cache_dir = os.path.join(tmpdir.name, "cache")
+      for name in ("a", "b", "gone"):
+        os.makedirs(os.path.join(root, name, "sub"))
+        with open(os.path.join(root, name, "sub", "data.bin"), "wb") as f:
+          f.write(b"x" * 100000)
+
+      def scan(cache):
+        return calculate_storage.scan_directory_usage(root, top_n=10, depth=1, time_budget=30, max_entries=1000, max_workers=2, cache=cache)
+
+      cache = calculate_storage.DirectoryUsageCache(cache_dir, root, max_age=3600)
+      first = scan(cache)
+      self.assertEqual(first.cached_directories, 0)
+
+      # 保存したキャッシュを別のプロセスから読んでも、変わっていないディレクトリは読み直さない
+      cache = calculate_storage.DirectoryUsageCache(cache_dir, root, max_age=3600)
+      second = scan(cache)
+      self.assertEqual(second.cached_directories, 7)
+      self.assertEqual((second.total_size, second.files, second.top_directories), (first.total_size, first.files, first.top_directories))
+
+      # 追加されたファイルは、そのディレクトリの mtime が変わるので読み直す
+      with open(os.path.join(root, "a", "sub", "more.bin"), "wb") as f:
+        f.write(b"x" * 300000)
+      shutil.rmtree(os.path.join(root, "gone"))
+      third = scan(cache)
+      self.assertEqual(third.files, 3)
+      self.assertEqual(third.top_directories[0][0], os.path.join(root, "a"))
+      self.assertNotIn(os.path.join(root, "gone", "sub"), cache.entries)
+      self.assertEqual(third.cached_directories, 3)
+
+      # 期限切れのエントリは読み直す
+      expired = scan(calculate_storage.DirectoryUsageCache(cache_dir, root, max_age=0))
+      self.assertEqual(expired.cached_directories, 0)
+      self.assertEqual(expired.total_size, third.total_size)
+    finally:
+      tmpdir.cleanup()
+
+  def test_scan_directory_usage_cache_windows_dir_entries(self):
+    # Windows でも、一覧で見つけた子ディレクトリとキャッシュから作った子ディレクトリのキーが一致してキャッシュが当たる
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      root = tmpdir.name
+      for name in ("a", "b", "c"):
+        os.makedirs(os.path.join(root, name, "sub"))
+        with open(os.path.join(root, name, "sub", "data.bin"), "wb") as f:
+          f.write(b"x" * 100000)
+
+      cache = calculate_storage.DirectoryUsageCache(None, root, max_age=3600)
+      with patch("calculate_storage.os.name", "nt"), patch("calculate_storage.os.scandir", side_effect=windows_scandir):
+        first = calculate_storage.scan_directory_usage(root, top_n=10, depth=1, time_budget=30, max_entries=1000, max_workers=2, cache=cache)
+        second = calculate_storage.scan_directory_usage(root, top_n=10, depth=1, time_budget=30, max_entries=1000, max_workers=2, cache=cache)
+      self.assertEqual(first.cached_directories, 0)
+      self.assertEqual(second.cached_directories, 7)
+      self.assertEqual(second.total_size, first.total_size)
+    finally:
+      tmpdir.cleanup()
+
+  @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is only available on Linux")
+  def test_scan_directory_usage_cache_with_inotify(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    watcher = calculate_storage.DirectoryWatcher(max_watches=100)
+    try:
+      root = tmpdir.name
+      os.makedirs(os.path.join(root, "logs"))
+      log_path = os.path.join(root, "logs", "app.log")
+      with open(log_path, "wb") as f:
+        f.write(b"x" * 10000)
+
+      cache = calculate_storage.DirectoryUsageCache(None, root, max_age=0, watcher=watcher)
+      def scan():
+        return calculate_storage.scan_directory_usage(root, top_n=10, depth=1, time_budget=30, max_entries=1000, max_workers=1, cache=cache)
+      first = scan()
+
+      # 監視しているディレクトリは、期限切れでも変更がなければ読み直さない
+      self.assertEqual(scan().cached_directories, 2)
+
+      # ファイルへの追記はディレクトリの mtime を変えないが、inotify で拾う
+      with open(log_path, "ab") as f:
+        f.write(b"x" * 500000)
+      grown = scan()
+      self.assertEqual(grown.cached_directories, 1)
+      self.assertGreater(grown.total_size, first.total_size + 400000)
+    finally:
+      watcher.close()
+      tmpdir.cleanup()
+
+  @patch("calculate_storage.GitHubClient.patch")
+  def test_directory_usage_section_in_issue(self, mock_patch):
+    store = IssueBodyStore("# Storage\n\n" + ROW_BODY + "\n")
+    mock_patch.side_effect = store.patch
+    red_usage = DiskUsage(total=100 * 1024 ** 3, used=95 * 1024 ** 3, free=5 * 1024 ** 3, percent=95)
+    usage = calculate_storage.DirectoryUsage("C", [("C/<logs>", 90 * 1024 ** 3)], 95 * 1024 ** 3, 10, 2, 0, False, 1.5)
+    with patch.object(calculate_storage.GitHubIssue, "_GitHubIssue__get_issue_body", side_effect=store.get_body):
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+      issue.update_storage_row("test_computer", "C", red_usage)
+      calculate_storage.publish_directory_usage(issue, "test_computer", "C", usage)
+      self.assertTrue(issue.update_issue_body())
+      lines = store.body.split("\n")
+      self.assertTrue(lines[2].startswith("| 🔴 | test_computer | C |"))
+      self.assertEqual(lines[3], "")
+      self.assertIn("<code>C/&lt;logs&gt;</code>", lines[4])
+      self.assertTrue(lines[4].endswith("<!-- calculate-storage-scan#test_computer#C -->"))
+      self.assertEqual(lines[5], "")
+      self.assertEqual(len(issue.get_computer_drives("test_computer")), 1)
+
+      # 🔴 でなくなったら消す
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+      issue.update_storage_row("test_computer", "C", CHANGED_USAGE)
+      calculate_storage.publish_directory_usage(issue, "test_computer", "C", None)
+      self.assertTrue(issue.update_issue_body())
+      self.assertNotIn("calculate-storage-scan", store.body)
+
+  def test_discover_mounts_dedupes_and_caches(self):
+    Partition = namedtuple("Partition", "device mountpoint fstype opts")
+    partitions = [
+      Partition("/dev/sda1", "/", "ext4", "rw"),
+      Partition("/dev/sda1", "/mnt/bind", "ext4", "rw,bind"),
+      Partition("/dev/sdb1", "/data", "xfs", "rw"),
+      Partition("/dev/mapper/data", "/srv/data", "xfs", "rw"),
+      Partition("server:/export", "/nfs", "nfs4", "rw"),
+      Partition("server:/export", "/nfs-again", "nfs4", "rw"),
+      Partition("tmpfs", "/run", "tmpfs", "rw"),
+      Partition("overlay", "/var/lib/docker/overlay2/x/merged", "overlay", "rw"),
+      Partition("/dev/sr0", "/media/cdrom", "iso9660", "ro,cdrom"),
+    ]
+    st_devs = {"/": 1, "/mnt/bind": 1, "/data": 2, "/srv/data": 2, "/nfs": 3, "/nfs-again": 3}
+    stat_calls = []
+    real_stat = os.stat
+
+    def fake_stat(path, *args, **kwargs):
+      if path not in st_devs:
+        return real_stat(path, *args, **kwargs)
+      stat_calls.append(path)
+      return os.stat_result((0, 0, st_devs[path]) + (0,) * 7)
+
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      calculate_storage._discovered_mounts.clear()
+      with patch("calculate_storage.psutil.disk_partitions", return_value=partitions) as mock_disk_partitions, \
+          patch("calculate_storage.os.stat", side_effect=fake_stat):
+        mounts = calculate_storage.discover_mounts(tmpdir.name)
+        mock_disk_partitions.assert_called_once_with(all=True)
+        self.assertEqual(mounts, [
+          calculate_storage.DiscoveredMount("/", "/dev/sda1", "ext4", ["/mnt/bind"]),
+          calculate_storage.DiscoveredMount("/data", "/dev/sdb1", "xfs", ["/srv/data"]),
+          calculate_storage.DiscoveredMount("/nfs", "server:/export", "nfs4", ["/nfs-again"]),
+        ])
+        self.assertNotIn("/nfs", stat_calls)
+
+        # マウントの一覧が同じなら、別のプロセスでもファイルのキャッシュを使って stat しない
+        calculate_storage._discovered_mounts.clear()
+        stat_calls.clear()
+        self.assertEqual(calculate_storage.discover_mounts(tmpdir.name), mounts)
+        self.assertEqual(stat_calls, [])
+    finally:
+      calculate_storage._discovered_mounts.clear()
+      tmpdir.cleanup()
+
+  @patch("calculate_storage.record_history")
+  @patch("calculate_storage.save_results")
+  @patch("calculate_storage.probe_drives")
+  def test_run_once_discovers_new_mounts(self, mock_probe_drives, mock_save_results, mock_record_history):
+    def probe(drives):
+      probes = []
+      for drive in drives:
+        drive_probe = calculate_storage.DriveProbe(drive)
+        drive_probe.status = "ok"
+        drive_probe.usage = CHANGED_USAGE
+        probes.append(drive_probe)
+      return probes
+    mock_probe_drives.side_effect = probe
+
+    body = "\n".join([
+      "| Status | Computer | Drive | Used | Size |",
+      "| :-: | :-: | :-: | :-: | :-: |",
+      "| ✅ | test_computer | / | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#test_computer#/ -->",
+      "| ✅ | test_computer | /mnt/bind | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#test_computer#/mnt/bind -->",
+      "| ✅ | other | C | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#other#C -->",
+      "",
+      "footer",
+    ])
+    store = IssueBodyStore(body)
+    mounts = [
+      calculate_storage.DiscoveredMount("/", "/dev/sda1", "ext4", ["/mnt/bind"]),
+      calculate_storage.DiscoveredMount("/data", "/dev/sdb1", "xfs", []),
+    ]
+    with patch("calculate_storage.discover_mounts", return_value=mounts), \
+        patch("calculate_storage.forecast_probes", return_value={}), \
+        patch.object(calculate_storage.GitHubIssue, "_GitHubIssue__get_issue_body", side_effect=store.get_body), \
+        patch("calculate_storage.GitHubClient.patch", side_effect=store.patch):
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+      results = calculate_storage.run_once(issue, "test_computer", discover=True)
+
+    # / と /mnt/bind は同じファイルシステムなので 1 回だけ測る
+    mock_probe_drives.assert_called_once_with(["/", "/data"])
+    self.assertEqual(sorted(result["drive"] for result in results), ["/", "/data", "/mnt/bind"])
+    lines = store.body.split("\n")
+    self.assertEqual(lines[4], "| ✅ | test_computer | /data | 2.00 GB (2%) | 100.00 GB (xfs) | <!-- calculate-storage#test_computer#/data -->")
+    self.assertIn("2.00 GB (2%)", lines[3])
+    self.assertTrue(lines[5].startswith("| ✅ | other | C |"))
+    self.assertEqual(lines[-1], "footer")
+
+    # 追加した行は次回から普通の行として読める
+    with patch.object(calculate_storage.GitHubIssue, "_GitHubIssue__get_issue_body", side_effect=store.get_body):
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+    self.assertEqual(issue.get_computer_drives("test_computer"), ["/", "/mnt/bind", "/data"])
+
+  def test_rebalance_shards(self):
+    def row(hostname, drive):
+      return f"| ✅ | {hostname} | {drive} | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#{hostname}#{drive} -->"
+
+    hostnames = [f"host-{i}" for i in range(12)]
+    bodies = {
+      "1": "\n".join(["# Storage", "", *calculate_storage.GitHubIssue.table_header] + [row(hostname, drive) for hostname in hostnames for drive in ("C", "D")] + [
+        "",
+        "<details>host-0</details> <!-- calculate-storage-scan#host-0#C -->",
+      ]),
+      "2": "",
+      "3": "",
+      "4": "",
+    }
+    patches = []
+
+    def get_body(issue):
+      return bodies[str(issue.issue_number)]
+
+    def patch_body(client, path, json=None, headers=None, retry=True):
+      number = path.rsplit("/", 1)[1]
+      patches.append(number)
+      bodies[number] = json["body"]
+      response = MagicMock()
+      response.status_code = 200
+      return response
+
+    def open_index():
+      return calculate_storage.GitHubIssue("test_repo", "1", "test_token")
+
+    def hosts_in(number):
+      return {key[0] for key in calculate_storage.GitHubIssue("test_repo", number, "test_token").storage_rows}
+
+    with patch.object(calculate_storage.GitHubIssue, "_GitHubIssue__get_issue_body", autospec=True, side_effect=get_body), \
+        patch("calculate_storage.GitHubClient.patch", autospec=True, side_effect=patch_body):
+      moves = calculate_storage.rebalance_shards(open_index(), add_shards=[2, 3])
+      self.assertEqual(len(moves), len(hostnames))
+      index = open_index()
+      self.assertEqual(index.storage_rows, {})
+      shards, hosts = calculate_storage.parse_shard_index(index)
+      self.assertEqual(shards, ["2", "3"])
+      self.assertEqual(set(hosts), set(hostnames))
+      self.assertEqual(hosts_in("2") | hosts_in("3"), set(hostnames))
+      self.assertEqual(hosts_in("2") & hosts_in("3"), set())
+      self.assertGreater(len(hosts_in("2")), 0)
+      self.assertGreater(len(hosts_in("3")), 0)
+      self.assertTrue(bodies["2"].startswith(calculate_storage.GitHubIssue.table_header[0]))
+      self.assertNotIn("calculate-storage-scan", bodies["1"])
+      self.assertIn("calculate-storage-scan#host-0#C", bodies[hosts["host-0"]])
+
+      # 各ホストは自分のシャードだけを読み書きする
+      shard_issue = calculate_storage.open_shard_issue(index, "host-5")
+      self.assertEqual(str(shard_issue.issue_number), hosts["host-5"])
+      self.assertEqual(shard_issue.get_computer_drives("host-5"), ["C", "D"])
+      patches.clear()
+      shard_issue.update_storage_row("host-5", "C", CHANGED_USAGE)
+      shard_issue.update_issue_body()
+      self.assertEqual(patches, [hosts["host-5"]])
+      self.assertLess(len(bodies[hosts["host-5"]]), len(bodies["2"]) + len(bodies["3"]))
+
+      # シャードを増やしても、割り当て済みのホストは動かない
+      self.assertEqual(calculate_storage.rebalance_shards(open_index(), add_shards=[4]), [])
+      self.assertEqual(hosts_in("4"), set())
+      # 割り当てをやり直すと、一部のホストだけが新しいシャードに移る
+      moves = calculate_storage.rebalance_shards(open_index(), reset_pins=True)
+      self.assertTrue(all(to == "4" for _, _, to in moves))
+      self.assertEqual(hosts_in("4"), {hostname for hostname, _, _ in moves})
+
+      # シャードを外すと、そのホストは残りのシャードに移る
+      calculate_storage.rebalance_shards(open_index(), remove_shards=[2])
+      self.assertEqual(hosts_in("2"), set())
+      self.assertEqual(hosts_in("3") | hosts_in("4"), set(hostnames))
+      self.assertEqual(calculate_storage.parse_shard_index(open_index())[0], ["3", "4"])
+      self.assertLess(bodies["1"].index("- Shard #4"), bodies["1"].index("- host-0:"))
+
+  @patch('calculate_storage.record_history')
+  @patch('calculate_storage.save_results')
+  @patch('calculate_storage.probe_drives')
+  def test_run_once_records_timings_and_prometheus_textfile(self, mock_probe_drives, mock_save_results, mock_record_history):
+    ok_probe = calculate_storage.DriveProbe("C")
+    ok_probe.status = "ok"
+    ok_probe.usage = CHANGED_USAGE
+    ok_probe.elapsed = 0.25
+    stale_probe = calculate_storage.DriveProbe("D")
+    stale_probe.status = "unreachable"
+    stale_probe.elapsed = 10.0
+    mock_probe_drives.return_value = [ok_probe, stale_probe]
+    other_row = "| ✅ | test_computer | D | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#test_computer#D -->"
+    store = IssueBodyStore(ROW_BODY + "\n" + other_row)
+
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      textfile_path = os.path.join(tmpdir.name, "textfile", "calculate_storage.prom")
+      with patch.dict(os.environ, {"CALCULATE_STORAGE_PROMETHEUS_TEXTFILE": textfile_path, "CALCULATE_STORAGE_VERIFY_DELAY": "0"}), \
+          patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', side_effect=store.get_body):
+        issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+        # GitHub への書き込みに失敗しても、測った値と所要時間は textfile に残る
+        with patch('calculate_storage.GitHubClient.patch', side_effect=Exception("Connection refused")):
+          with self.assertRaises(Exception):
+            calculate_storage.run_once(issue, "test_computer")
+        with open(textfile_path, "r", encoding="utf-8") as f:
+          failed_text = f.read()
+        self.assertIn('calculate_storage_disk_used_bytes{host="test_computer",drive="C"} 2147483648.0', failed_text)
+
+        with patch('calculate_storage.GitHubClient.patch', side_effect=store.patch):
+          calculate_storage.run_once(issue, "test_computer")
+        with open(textfile_path, "r", encoding="utf-8") as f:
+          text = f.read()
+      self.assertEqual(os.listdir(os.path.dirname(textfile_path)), ["calculate_storage.prom"])
+    finally:
+      tmpdir.cleanup()
+
+    self.assertIn('calculate_storage_disk_reachable{host="test_computer",drive="D"} 0.0', text)
+    self.assertIn('calculate_storage_probe_duration_seconds{host="test_computer",drive="D"} 10.0', text)
+    self.assertNotIn('calculate_storage_disk_used_bytes{host="test_computer",drive="D"}', text)
+    self.assertIn("# TYPE calculate_storage_phase_duration_seconds gauge", text)
+    for phase in ("probe", "forecast", "render", "write", "verify"):
+      self.assertIn(f'calculate_storage_phase_duration_seconds{{host="test_computer",phase="{phase}"}}', text)
+    # 最初の run_once の前に行った取得・解析は、最初の実行の所要時間に含める
+    self.assertNotIn('phase="parse"', text)
+    self.assertIn('phase="parse"', failed_text)
+
+    # ドライブごとの結果の後に、実行ごとの所要時間を結果ファイルに残す
+    drive_results, run_record = [call.args[1] for call in mock_save_results.call_args_list[-2:]]
+    self.assertEqual([result["elapsed"] for result in drive_results], [0.25, 10.0])
+    self.assertEqual(run_record[0]["status"], "run")
+    self.assertIn("write", run_record[0]["timings"])
+
+  def test_render_prometheus_textfile_escapes_labels(self):
+    results = [{"drive": 'C:\\"x"', "status": "ok", "used": 1, "total": 2, "percent": 50.0, "days_to_full": None, "elapsed": None}]
+    text = calculate_storage.render_prometheus_textfile("host\n1", results, {}, now=100)
+    self.assertIn('calculate_storage_disk_used_bytes{host="host\\n1",drive="C:\\\\\\"x\\""} 1.0', text)
+    self.assertNotIn("days_to_full", text)
+    self.assertNotIn("probe_duration_seconds", text)
+    self.assertTrue(text.endswith('calculate_storage_last_run_timestamp_seconds{host="host\\n1"} 100.0\n'))
+
+  def test_fleet_benchmark_has_no_lost_updates(self):
+    # 偽の GitHub API に対して複数ホストを同時に更新させ、書き込んだ行が 1 つも消えていないことを確かめる
+    root_dir = os.path.dirname(os.path.abspath(calculate_storage.__file__))
+    result = subprocess.run(
+      [sys.executable, os.path.join(root_dir, "benchmarks", "bench_fleet.py"), "--hosts", "8", "--latency", "0.01", "--jitter", "0.01", "--verify-delay", "0.1", "--json"],
+      cwd=root_dir,
+      capture_output=True,
+      text=True
+    )
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    self.assertEqual(report["hosts"], 8)
+    self.assertEqual(report["failed_hosts"], 0)
+    self.assertEqual(report["lost_updates"], 0)
+    self.assertEqual(result.returncode, 0)
+
+  @patch('calculate_storage.record_history')
+  @patch('calculate_storage.save_results')
+  @patch('calculate_storage.probe_drives')
+  def test_run_targets_probes_once_and_updates_concurrently(self, mock_probe_drives, mock_save_results, mock_record_history):
+    def probe_drives(drives):
+      probes = []
+      for drive in drives:
+        probe = calculate_storage.DriveProbe(drive)
+        probe.status = "ok"
+        probe.usage = CHANGED_USAGE
+        probes.append(probe)
+      return probes
+
+    mock_probe_drives.side_effect = probe_drives
+    other_row = "| ✅ | test_computer | D | 1.00 GB (1%) | 100.00 GB (SSD) | <!-- calculate-storage#test_computer#D -->"
+    self.assertEqual(calculate_storage.parse_issue_target("#3", "owner/repo"), ("owner/repo", "3"))
+    self.assertEqual(calculate_storage.parse_issue_target("other/repo#12", "owner/repo"), ("other/repo", "12"))
+    with self.assertRaises(ValueError):
+      calculate_storage.parse_issue_target("other/repo#x", "owner/repo")
+    targets = [calculate_storage.IssueTarget(f"owner/repo{i}", "1") for i in range(3)]
+
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      with FakeGitHubServer({("owner/repo0", 1): ROW_BODY}) as server0, FakeGitHubServer({("owner/repo1", 1): ROW_BODY + "\n" + other_row}) as server1, FakeGitHubServer({("owner/repo2", 1): other_row}) as server2:
+        servers = [server0, server1, server2]
+        clients = {target: calculate_storage.GitHubClient("test_token", api_url=server.url, max_retries=0, backoff_base=0) for target, server in zip(targets, servers)}
+        cache = calculate_storage.IssueBodyCache()
+        # どの issue も最初の GET に 0.5 秒かかる。順番に処理すると 1.5 秒以上かかる
+        for server in servers:
+          server.actions = ["slow"]
+        start = time.perf_counter()
+        outcomes = asyncio.run(calculate_storage.run_targets(targets, "test_computer", "test_token", cache, tmpdir.name, clients=clients))
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(outcomes, {target: True for target in targets})
+        self.assertLess(elapsed, 1.2)
+        mock_probe_drives.assert_called_once_with(["C", "D"])
+        self.assertIn("| test_computer | C | 2.00 GB (2%)", server0.get_body("owner/repo0", 1))
+        self.assertNotIn("| test_computer | D |", server0.get_body("owner/repo0", 1))
+        self.assertIn("| test_computer | D | 2.00 GB (2%)", server1.get_body("owner/repo1", 1))
+        self.assertIn("| test_computer | D | 2.00 GB (2%)", server2.get_body("owner/repo2", 1))
+
+        # 1 つの issue に書き込めなくても、他の issue は更新し、失敗した issue の分だけ spool に残す
+        server2.actions = ["503"] * 10
+        outcomes = asyncio.run(calculate_storage.run_targets(targets, "test_computer", "test_token", cache, tmpdir.name, clients=clients))
+        self.assertEqual(outcomes, {targets[0]: True, targets[1]: True, targets[2]: False})
+        self.assertEqual(set(calculate_storage.get_target_spool(tmpdir.name, targets[2]).load()), {("test_computer", "D")})
+        self.assertEqual(calculate_storage.get_target_spool(tmpdir.name, targets[0]).load(), {})
+    finally:
+      tmpdir.cleanup()
+
+  def test_sample_ring_summarizes_since_mark(self):
+    ring = calculate_storage.SampleRing(4)
+    for sample in ((0.0, 100, 1000), (10.0, 700, 2000), (20.0, 800, 3000)):
+      ring.append(*sample)
+    self.assertEqual(ring.summarize(0), calculate_storage.SampleSummary(3, 20.0, 60.0, 100.0))
+    self.assertEqual(ring.summarize(1), calculate_storage.SampleSummary(2, 10.0, 10.0, 100.0))
+    self.assertIsNone(ring.summarize(2))
+
+    # 上書きされたサンプルは使わない。配列の大きさは変わらない
+    for sample in ((30.0, 400, 3500), (40.0, 400, 100), (50.0, 500, 200)):
+      ring.append(*sample)
+    self.assertEqual(len(ring.timestamps), 4)
+    summary = ring.summarize(0)
+    self.assertEqual((summary.samples, summary.elapsed, summary.peak_fill_rate), (4, 30.0, 10.0))
+    # カウンタが巻き戻ったら書き込み速度は出さない
+    self.assertIsNone(summary.write_throughput)
+
+  @patch('calculate_storage.psutil.disk_partitions')
+  @patch('calculate_storage.psutil.disk_io_counters')
+  @patch('calculate_storage.psutil.disk_usage')
+  def test_usage_sampler_stays_within_cpu_budget(self, mock_disk_usage, mock_disk_io_counters, mock_disk_partitions):
+    used = iter(range(10 ** 9, 2 * 10 ** 9, 10 ** 6))
+    written = iter(range(0, 10 ** 9, 10 ** 5))
+
+    def disk_usage(drive):
+      # 1 回の取得に 5ms の CPU 時間がかかるドライブ
+      end = time.thread_time() + 0.005
+      while time.thread_time() < end:
+        pass
+      return DiskUsage(total=10 ** 10, used=next(used), free=0, percent=10.0)
+
+    IoCounters = namedtuple("IoCounters", "write_bytes")
+    Partition = namedtuple("Partition", "device mountpoint fstype opts")
+    mock_disk_usage.side_effect = disk_usage
+    mock_disk_io_counters.side_effect = lambda perdisk: {"sda1": IoCounters(next(written))}
+    mock_disk_partitions.return_value = [Partition("/dev/sda1", "C", "ext4", "rw")]
+
+    # 間隔は 1ms でも、CPU 予算 5% なら 1 回 5ms の取得は 100ms 以上あけて行う
+    sampler = calculate_storage.UsageSampler(0.001, capacity=16, cpu_budget=0.05)
+    start = time.monotonic()
+    sampler.watch(["C"])
+    try:
+      while sampler.polls < 3 and time.monotonic() - start < 10:
+        time.sleep(0.01)
+      elapsed = time.monotonic() - start
+    finally:
+      sampler.close()
+    self.assertGreaterEqual(sampler.polls, 3)
+    self.assertGreaterEqual(elapsed, 0.2)
+
+    summaries = sampler.collect()
+    self.assertGreaterEqual(summaries["C"].samples, 3)
+    self.assertGreater(summaries["C"].peak_fill_rate, 0)
+    self.assertGreater(summaries["C"].write_throughput, 0)
+    # 次の collect は、前回の最後のサンプルより後だけを見る
+    self.assertEqual(sampler.collect(), {})
+
+  @patch('calculate_storage.probe_drives')
+  def test_sampled_fill_rate_in_results_and_issue_row(self, mock_probe_drives):
+    probe = calculate_storage.DriveProbe("C")
+    probe.status = "ok"
+    probe.usage = CHANGED_USAGE
+    mock_probe_drives.return_value = [probe]
+    sampler = MagicMock()
+    # 20 GB/分 で増えたドライブ
+    sampler.collect.return_value = {"C": calculate_storage.SampleSummary(10, 600.0, 20 * 1024 ** 3 / 60, 100 * 1024 ** 2)}
+
+    results = calculate_storage.measure_drives("test_computer", ["C"], {"C": ["E"]}, sampler=sampler)
+    sampler.watch.assert_called_once_with(["C"])
+    self.assertEqual([result["drive"] for result in results], ["C", "E"])
+    for result in results:
+      self.assertEqual(result["samples"], 10)
+      self.assertEqual(result["write_throughput"], 100 * 1024 ** 2)
+    text = calculate_storage.render_prometheus_textfile("test_computer", results, {})
+    self.assertIn('calculate_storage_disk_write_bytes_per_second{host="test_computer",drive="C"} 104857600.0', text)
+
+    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', return_value=ROW_BODY):
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+    calculate_storage.apply_result(issue, "test_computer", results[0])
+    self.assertEqual(issue.storage_rows[("test_computer", "C")].used, "2.00 GB (2%, peak +20.00 GB/min, writes 100.00 MB/s)")
+    # しきい値 (1 GB/分) 未満なら表示しない
+    calculate_storage.apply_result(issue, "test_computer", dict(results[0], peak_fill_rate=1024 ** 2))
+    self.assertEqual(issue.storage_rows[("test_computer", "C")].used, "2.00 GB (2%)")
+
+  def test_parse_body_rows_and_marked_lines(self):
+    body = "\n".join([
+      "| Status | Computer | Drive | Used | Size |",
+      "Some text",
+      "| ✅ | pc | C | 1.00 GB (1%) | 2.00 GB (HDD) | <!-- calculate-storage#pc#C -->",
+      "<details>x</details> <!-- calculate-storage-scan#pc#C -->",
+      # 目印が複数ある行は、キーの付いた行が優先され、一番右で合う目印が使われる
+      "a <!-- calculate-storage-host#h --> b <!-- calculate-storage#pc#D -->",
+      "x <!-- calculate-storage-bad --> y <!-- calculate-storage#pc#E --> z",
+      "| no marker",
+    ])
+    with patch.object(calculate_storage.GitHubIssue, '_GitHubIssue__get_issue_body', return_value=body):
+      issue = calculate_storage.GitHubIssue("test_repo", 1, "test_token")
+    self.assertEqual(list(issue.storage_rows), [("pc", "C")])
+    self.assertEqual(issue.storage_rows[("pc", "C")].raw, "| ✅ | pc | C | 1.00 GB (1%) | 2.00 GB (HDD) |")
+    self.assertEqual(issue.get_marked_lines("scan"), {"pc#C": "<details>x</details>"})
+    self.assertEqual(issue.get_marked_lines("host"), {"h --> b <!-- calculate-storage#pc#D": "a"})
+
+  def test_hot_path_benchmark_compare_fails_on_regression(self):
+    # 小さな規模で実際に測り、2 倍遅くなった結果と比べると失敗することを確かめる
+    root_dir = os.path.dirname(os.path.abspath(calculate_storage.__file__))
+    script = os.path.join(root_dir, "benchmarks", "bench_hot_paths.py")
+    tmpdir = tempfile.TemporaryDirectory()
+    try:
+      current_path = os.path.join(tmpdir.name, "current.json")
+      slower_path = os.path.join(tmpdir.name, "slower.json")
+      result = subprocess.run([sys.executable, script, "run", "--hosts", "3", "--min-time", "0.001", "--repeat", "1", "--output", current_path], cwd=tmpdir.name, capture_output=True, text=True)
+      self.assertEqual(result.returncode, 0, result.stderr)
+      with open(current_path, "r", encoding="utf-8") as f:
+        current = json.load(f)
+      self.assertEqual(set(current["benchmarks"]), {
+        "get_human_readable_size",
+        "save_results/records=4",
+        "get_storage_rows/hosts=3",
+        "update_storage_row/hosts=3",
+        "update_issue_body/hosts=3",
+      })
+      for benchmark in current["benchmarks"].values():
+        benchmark["seconds"] *= 2
+      with open(slower_path, "w", encoding="utf-8") as f:
+        json.dump(current, f)
+
+      result = subprocess.run([sys.executable, script, "compare", current_path, slower_path, "--tolerance", "0.5"], capture_output=True, text=True)
+      self.assertEqual(result.returncode, 1)
+      self.assertIn("update_issue_body/hosts=3", result.stdout)
+      self.assertIn("REGRESSION", result.stdout)
+      result = subprocess.run([sys.executable, script, "compare", slower_path, current_path], capture_output=True, text=True)
+      self.assertEqual(result.returncode, 0)
+    finally:
+      tmpdir.cleanup()
+
   @patch('calculate_storage.os.name', 'nt')
   @patch('calculate_storage.os.environ', {'COMPUTERNAME': 'TEST_WINDOWS'})
   def test_get_real_hostname_windows(self):